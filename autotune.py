@@ -0,0 +1,179 @@
+# Module: autotune
+#
+# Tuning of the SolverConfig of each difficulty class over a set of levels:
+#    candidates   - the configurations of the search space, optionally sampled
+#    run_jobs     - solves (level, config) pairs in parallel processes, each
+#                   killed when it passes the time cap
+#    halving      - successive halving of the candidates of one class
+#
+# Successive halving evaluates every candidate on a few levels with a short
+# time cap, keeps the best 1/eta of them and evaluates those again on eta
+# times more levels with an eta times longer cap, until one is left or the
+# levels of the class run out. A candidate is scored by its penalized mean
+# time (PAR2: an unsolved level counts twice the cap), ties broken by the
+# order of the candidates; the levels are shuffled with a fixed seed, so a
+# run is reproducible given the same machine load.
+#
+# The result is written as JSON, {"configs": {class: config}, ...}, read by
+# solver.load_configs and, through SOLVER_CONFIG, by the client.
+
+import argparse
+import itertools
+import json
+import math
+import multiprocessing
+import queue
+import random
+import time
+import traceback
+
+from mapa import Map
+from sokoban_domain import BoxDomain
+from solver import CLASSES, CONFIGS, DifficultyModel, SolverConfig, features, solve
+
+# valores de cada parametro explorados
+SPACE = {
+    'strategy'    : ['greedy', 'a*'],
+    'pattern_size': [0, 2, 3],
+    'matching'    : [True, False],
+    'hierarchy'   : [False, True],
+}
+
+def candidates(space=SPACE, sample=None, seed=0):
+    '''
+    @param space, the values of each SolverConfig parameter
+    @param sample, number of configurations drawn from the space (all if None)
+    @param seed, seed of the draw
+    returns the list of candidate SolverConfig, the default ones of the classes first
+    '''
+    names = sorted(space)
+    configs = [SolverConfig(**dict(zip(names, values))) for values in itertools.product(*[space[name] for name in names])]
+    if sample is not None and sample < len(configs):
+        configs = random.Random(seed).sample(configs, sample)
+    defaults = [config.to_dict() for config in CONFIGS.values()]
+    configs.sort(key=lambda config: config.to_dict() not in defaults)
+    return configs
+
+# resolve um nivel; o erro, se a pesquisa falhar, segue com o resultado
+def _job(filename, config, results, idx):
+    start = time.time()
+    try:
+        search = solve(filename, config)
+    except Exception:
+        results.put((idx, False, time.time() - start, traceback.format_exc()))
+        return
+    results.put((idx, search.plan is not None, time.time() - start, None))
+
+def run_jobs(jobs, processes, cap, log=print):
+    '''
+    @param jobs, a list of (level file, SolverConfig)
+    @param processes, number of jobs run at the same time
+    @param cap, seconds after which a job is killed and counted as unsolved
+    returns the list of (solved, seconds) of the jobs; a job that fails is
+    logged as an error and counted as unsolved
+    '''
+    results = multiprocessing.Queue()
+    outcome = [(False, cap)] * len(jobs)
+    pending = list(enumerate(jobs))
+    running = dict()    # indice -> (processo, instante de inicio)
+    try:
+        while pending or running:
+            while pending and len(running) < processes:
+                idx, (filename, config) = pending.pop(0)
+                # nao daemonico: a pesquisa pode criar os seus proprios processos
+                process = multiprocessing.Process(target=_job, args=(filename, config, results, idx))
+                process.start()
+                running[idx] = (process, time.monotonic())
+
+            try:
+                idx, solved, elapsed, error = results.get(timeout=0.05)
+                outcome[idx] = (solved, min(elapsed, cap))
+                if error:
+                    log(f"  error: {jobs[idx][0]} with {jobs[idx][1]}\n{error}")
+                if idx in running:
+                    running.pop(idx)[0].join()
+            except queue.Empty:
+                pass
+
+            now = time.monotonic()
+            for idx, (process, started) in list(running.items()):
+                if now - started > cap:
+                    process.terminate()
+                    process.join()
+                    del running[idx]
+                elif not process.is_alive() and process.exitcode != 0:
+                    log(f"  error: {jobs[idx][0]} with {jobs[idx][1]}: exit code {process.exitcode}")
+                    del running[idx]
+    finally:
+        for process, _ in running.values():
+            process.terminate()
+            process.join()
+    return outcome
+
+# tempo medio penalizado: um nivel por resolver conta o dobro do limite
+def par2(outcome, cap):
+    return sum(elapsed if solved else 2 * cap for solved, elapsed in outcome) / max(len(outcome), 1)
+
+def halving(levels, configs, processes, cap=2.0, eta=3, first=2, log=print):
+    '''
+    @param levels, the level files of the class, already shuffled
+    @param configs, the candidate SolverConfig
+    @param processes, jobs run at the same time
+    @param cap, time cap of the first round, in seconds
+    @param eta, the fraction kept (1/eta) and the growth of levels and cap per round
+    @param first, levels of the first round
+    returns (best SolverConfig, its score, the rounds as a list of dicts)
+    '''
+    survivors = list(range(len(configs)))
+    count  = min(first, len(levels))
+    rounds = []
+    while True:
+        subset = levels[:count]
+        jobs = [(filename, configs[idx]) for idx in survivors for filename in subset]
+        outcome = run_jobs(jobs, processes, cap, log)
+        scores = {idx: par2(outcome[pos*len(subset):(pos+1)*len(subset)], cap) for pos, idx in enumerate(survivors)}
+        ranked = sorted(survivors, key=lambda idx: (scores[idx], idx))
+        rounds.append({'levels': len(subset), 'cap': cap, 'scores': [(configs[idx].to_dict(), scores[idx]) for idx in ranked]})
+        log(f"  {len(survivors)} configs on {len(subset)} levels, cap {cap:g}s: best {scores[ranked[0]]:.2f}s {configs[ranked[0]]}")
+
+        if len(ranked) == 1 or count == len(levels):
+            return configs[ranked[0]], scores[ranked[0]], rounds
+        survivors = ranked[:max(1, math.ceil(len(ranked) / eta))]
+        count = min(count * eta, len(levels))
+        cap *= eta
+
+def classify(filenames, model):
+    classes = {name: [] for name, _ in CLASSES}
+    for filename in filenames:
+        classes[model.classify(features(Map(filename), BoxDomain(filename)))].append(filename)
+    return classes
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("levels", nargs="+", help="level files")
+    parser.add_argument("--output", help="file where the tuned configs are written", default="solver.json")
+    parser.add_argument("--model", help="difficulty model used to split the levels in classes")
+    parser.add_argument("--processes", help="jobs run at the same time", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--cap", help="time cap of the first round, in seconds", type=float, default=2.0)
+    parser.add_argument("--eta", help="1/eta of the configs survive each round", type=int, default=3)
+    parser.add_argument("--first", help="levels of the first round", type=int, default=2)
+    parser.add_argument("--sample", help="number of configs drawn from the search space", type=int)
+    parser.add_argument("--seed", help="seed of the sampling and of the level order", type=int, default=0)
+    args = parser.parse_args()
+
+    model = DifficultyModel.load(args.model) if args.model else DifficultyModel()
+    configs = candidates(sample=args.sample, seed=args.seed)
+    result = {'seed': args.seed, 'eta': args.eta, 'configs': dict(), 'rounds': dict()}
+    for name, levels in classify(args.levels, model).items():
+        if not levels:
+            result['configs'][name] = CONFIGS[name].to_dict()
+            continue
+        random.Random(args.seed).shuffle(levels)
+        print(f"{name}: {len(levels)} levels, {len(configs)} configs")
+        best, score, rounds = halving(levels, configs, args.processes, args.cap, args.eta, args.first)
+        result['configs'][name] = best.to_dict()
+        result['rounds'][name] = rounds
+
+    with open(args.output, "w") as outfile:
+        json.dump(result, outfile, indent=1)
+    print(f"configs written to {args.output}")
@@ -0,0 +1,123 @@
+"""Fan-out of game frames to viewers without blocking the game loop."""
+import asyncio
+import json
+import logging
+from collections import deque
+
+import websockets
+
+from protocol import DELTAS, FULL_STATES
+
+logger = logging.getLogger("Broadcast")
+logger.setLevel(logging.INFO)
+
+DROP_OLDEST = "drop-oldest"
+KEYFRAME_ONLY = "keyframe-only"
+POLICIES = [DROP_OLDEST, KEYFRAME_ONLY]
+
+
+class Subscriber:
+    """A viewer connection with a bounded queue of outgoing messages.
+
+    Messages are written by a task of its own, so a slow viewer only delays
+    itself. When the queue is full the policy decides what is lost:
+    drop-oldest discards the oldest frame, keyframe-only discards every
+    queued frame that is not a keyframe and accepts only keyframes until
+    the viewer has caught up with half of the queue.
+    """
+
+    def __init__(self, websocket, player=None, maxsize=32, policy=DROP_OLDEST, protocol=FULL_STATES):
+        assert policy in POLICIES, f"Unknown policy {policy}"
+        self.ws = websocket
+        self.player = player  # name of the player to watch, None follows new games
+        self.protocol = protocol
+        self.maxsize = maxsize
+        self.policy = policy
+        self.dropped = 0
+        self._queue = deque()
+        self._catching_up = False
+        self._ready = asyncio.Event()
+        self._task = asyncio.ensure_future(self._writer())
+
+    def offer(self, message, keyframe=False):
+        """Queue an encoded message, never waiting for the viewer."""
+        if self.policy == KEYFRAME_ONLY:
+            if len(self._queue) >= self.maxsize:
+                kept = deque(item for item in self._queue if item[1])
+                self.dropped += len(self._queue) - len(kept)
+                self._queue = kept
+                self._catching_up = True
+            if self._catching_up and not keyframe:
+                self.dropped += 1
+                return
+        while len(self._queue) >= self.maxsize:
+            self._drop_oldest()
+
+        self._queue.append((message, keyframe))
+        self._ready.set()
+
+    def _drop_oldest(self):
+        for item in self._queue:
+            if not item[1]:
+                self._queue.remove(item)
+                break
+        else:
+            self._queue.popleft()
+        self.dropped += 1
+
+    async def _writer(self):
+        try:
+            while True:
+                await self._ready.wait()
+                while self._queue:
+                    message, _ = self._queue.popleft()
+                    if self._catching_up and len(self._queue) <= self.maxsize // 2:
+                        self._catching_up = False
+                    await self.ws.send(message)
+                self._ready.clear()
+        except websockets.exceptions.ConnectionClosed:
+            logger.debug("Viewer gone, %s frames dropped", self.dropped)
+
+    def close(self):
+        """Stop writing to this viewer."""
+        self._task.cancel()
+
+
+class Broadcaster:
+    """Set of subscribers receiving the same stream, encoded once per frame."""
+
+    def __init__(self):
+        self._subscribers = set()
+
+    def __len__(self):
+        return len(self._subscribers)
+
+    def __iter__(self):
+        return iter(self._subscribers)
+
+    def add(self, subscriber):
+        self._subscribers.add(subscriber)
+
+    def discard(self, subscriber):
+        self._subscribers.discard(subscriber)
+
+    def publish(self, message, keyframe=False):
+        """Hand a message (str, or dict encoded here once) to every subscriber."""
+        if not self._subscribers:
+            return
+        if not isinstance(message, str):
+            message = json.dumps(message)
+        for subscriber in self._subscribers:
+            subscriber.offer(message, keyframe)
+
+    def publish_frame(self, frame):
+        """Hand a game frame to every subscriber, in the protocol each one uses.
+
+        Full states are keyframes for delta subscribers, and deltas are never
+        encoded when nobody asked for them.
+        """
+        for subscriber in self._subscribers:
+            if subscriber.protocol >= DELTAS:
+                subscriber.offer(frame.encode(subscriber.protocol), frame.keyframe)
+            else:
+                subscriber.offer(frame.full)
@@ -5,6 +5,7 @@ import os
 
 import websockets
 from mapa import Map
+from protocol import PROTOCOL_VERSION, StateDecoder
 
 # Next 4 lines are not needed for AI agents, please remove them from your code!
 import pygame
@@ -18,7 +19,10 @@ async def agent_loop(server_address="localhost:8000", agent_name="student"):
     async with websockets.connect(f"ws://{server_address}/player") as websocket:
 
         # Receive information about static game properties
-        await websocket.send(json.dumps({"cmd": "join", "name": agent_name}))
+        await websocket.send(
+            json.dumps({"cmd": "join", "name": agent_name, "protocol": PROTOCOL_VERSION})
+        )
+        decoder = StateDecoder()
 
         # Next 3 lines are not needed for AI agent
         SCREEN = pygame.display.set_mode((299, 123))
@@ -27,11 +31,13 @@ async def agent_loop(server_address="localhost:8000", agent_name="student"):
 
         while True:
             try:
-                update = json.loads(
+                update = decoder.update(json.loads(
                     await websocket.recv()
-                )  # receive game update, this must be called timely or your game will get out of sync with the server
+                ))  # receive game update, this must be called timely or your game will get out of sync with the server
 
-                if "map" in update:
+                if update is None:
+                    pass  # delta received before a keyframe
+                elif "map" in update:
                     # we got a new level
                     game_properties = update
                     mapa = Map(update["map"])
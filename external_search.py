@@ -0,0 +1,283 @@
+# Module: external_search
+#
+# Best-first search with the frontier and the closed set on disk,
+# over the SearchDomain/SearchProblem interface of tree_search:
+#    ExternalSearch - runs one search with a fixed memory budget
+#
+# Nodes are grouped in buckets by their priority value (f = g + h for
+# 'a*'). Generated nodes are buffered in memory and, when the buffer is
+# full, sorted by state key and written to run files. The bucket with
+# the lowest value is expanded in passes: its runs are merged through
+# memory-mapped reads, duplicates are removed while merging (delayed
+# duplicate detection) and so are the states found in the sorted runs
+# of the closed set. The survivors are expanded and become a new closed
+# run, with the key of their parent, from which the plan is rebuilt at
+# the end by re-running the actions of the domain.
+#
+# States are written with SearchDomain.pack and read back with
+# SearchDomain.unpack; open run records are
+#    key | parent key | cost | depth | length | packed state
+# with big-endian numbers, so sorting the raw records sorts them by key.
+
+import heapq
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+from hashlib import blake2b
+
+from parallel_search import priority
+
+OPEN   = struct.Struct('>QQdIH')
+CLOSED = struct.Struct('>QQ')
+
+# chave de 64 bits de um estado
+def state_key(domain, state):
+    key = domain.hash(state)
+    if isinstance(key, int):
+        return key & 0xFFFFFFFFFFFFFFFF
+    return int.from_bytes(blake2b(str(key).encode(), digest_size=8).digest(), 'big')
+
+# registos de um ficheiro de runs abertos, lidos por mmap
+def open_records(path):
+    with open(path, 'rb') as infile:
+        if os.fstat(infile.fileno()).st_size == 0:
+            return
+        with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            offset = 0
+            while offset < len(data):
+                end = offset + OPEN.size + OPEN.unpack_from(data, offset)[4]
+                yield data[offset:end]
+                offset = end
+
+# registos (chave, chave do pai) de um ficheiro de runs fechados
+def closed_records(path):
+    with open(path, 'rb') as infile:
+        if os.fstat(infile.fileno()).st_size == 0:
+            return
+        with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for offset in range(0, len(data), CLOSED.size):
+                yield CLOSED.unpack_from(data, offset)
+
+# chave do pai de um estado num run fechado (pesquisa binaria), ou None
+def closed_parent(path, key):
+    with open(path, 'rb') as infile:
+        if os.fstat(infile.fileno()).st_size == 0:
+            return None
+        with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            low, high = 0, len(data) // CLOSED.size
+            while low < high:
+                middle = (low + high) // 2
+                found, parent = CLOSED.unpack_from(data, middle * CLOSED.size)
+                if found == key:
+                    return parent
+                if found < key:
+                    low = middle + 1
+                else:
+                    high = middle
+    return None
+
+# registos de runs ordenados pela chave, sem duplicados: fica o de menor custo
+def unique(records):
+    best = None
+    for record in records:
+        if best is not None and record[:8] == best[:8]:
+            if OPEN.unpack_from(record)[2] < OPEN.unpack_from(best)[2]:
+                best = record
+            continue
+        if best is not None:
+            yield best
+        best = record
+    if best is not None:
+        yield best
+
+class ExternalSearch:
+    '''
+    @param problem, the SearchProblem to solve
+    @param strategy, 'a*' (optimal) or any other SearchTree strategy
+    @param memory, number of generated nodes kept in memory before spilling to disk
+    @param directory, where run files are written (a temporary directory by default)
+    @param max_runs, closed runs merged into one when there are more than this
+    '''
+    def __init__(self, problem, strategy='a*', memory=1000000, directory=None, max_runs=16):
+        self.problem   = problem
+        self.strategy  = strategy
+        self.memory    = memory
+        self.directory = directory
+        self.max_runs  = max_runs
+        self.solution  = None
+        self.expanded  = 0
+
+        self.buffers  = dict()    # valor -> registos em memoria
+        self.buffered = 0
+        self.runs     = dict()    # valor -> ficheiros de runs abertos
+        self.closed   = []        # ficheiros de runs fechados
+        self.counter  = 0
+
+    @property
+    def visited_ones(self):
+        return self.expanded
+
+    @property
+    def length(self):
+        if self.solution:
+            return len(self.solution[1])
+        return None
+
+    @property
+    def cost(self):
+        if self.solution:
+            return self.solution[0]
+        return None
+
+    @property
+    def plan(self):
+        if self.solution:
+            return self.solution[1]
+        return None
+
+    @property
+    def path(self):
+        if self.solution:
+            state = self.problem.initial
+            path  = [state]
+            for action in self.solution[1]:
+                state = self.problem.domain.result(state, action)
+                path.append(state)
+            return path
+        return None
+
+    def _filename(self, kind):
+        self.counter += 1
+        return os.path.join(self.workdir, f'{kind}{self.counter}.run')
+
+    def _push(self, value, key, parent, cost, depth, state):
+        packed = self.problem.domain.pack(state)
+        self.buffers.setdefault(value, []).append(OPEN.pack(key, parent, cost, depth, len(packed)) + packed)
+        self.buffered += 1
+        if self.buffered >= self.memory:
+            self._spill()
+
+    # escreve os registos em memoria em runs ordenados, um por valor
+    def _spill(self, values=None):
+        for value in list(self.buffers if values is None else values):
+            records = self.buffers.pop(value, None)
+            if not records:
+                continue
+            records.sort()
+            path = self._filename('open')
+            with open(path, 'wb') as outfile:
+                outfile.write(b''.join(records))
+            self.runs.setdefault(value, []).append(path)
+            self.buffered -= len(records)
+
+    # junta os runs fechados num unico run
+    def _compact_closed(self):
+        path = self._filename('closed')
+        with open(path, 'wb') as outfile:
+            for record in heapq.merge(*[closed_records(run) for run in self.closed]):
+                outfile.write(CLOSED.pack(*record))
+        for run in self.closed:
+            os.remove(run)
+        self.closed = [path]
+
+    # uma passagem sobre o bucket de menor valor: juntar os runs, eliminar
+    # duplicados e estados fechados, expandir os restantes
+    def _expand(self, value):
+        problem = self.problem
+        domain  = problem.domain
+        self._spill([value])
+        runs = self.runs.pop(value)
+
+        closed = heapq.merge(*[closed_records(run) for run in self.closed])
+        done   = next(closed, None)
+        path   = self._filename('closed')
+        outfile = open(path, 'wb')
+        self.closed.append(path)
+        goal = None
+
+        for record in unique(heapq.merge(*[open_records(run) for run in runs])):
+            key, parent, cost, depth, _ = OPEN.unpack_from(record)
+            while done is not None and done[0] < key:
+                done = next(closed, None)
+            if done is not None and done[0] == key:
+                continue
+            outfile.write(CLOSED.pack(key, parent))
+            self.expanded += 1
+
+            state = domain.unpack(record[OPEN.size:])
+            if problem.goal_test(state):
+                goal = (key, cost)
+                break
+
+            actions = domain.actions(state)
+            if actions == -1:
+                continue
+            for action in actions:
+                newstate = domain.result(state, action)
+                newcost  = cost + domain.cost(state, action)
+                newvalue = priority(self.strategy, depth + 1, newcost, domain.heuristic(newstate, problem.goal))
+                self._push(newvalue, state_key(domain, newstate), key, newcost, depth + 1, newstate)
+
+        outfile.close()
+        closed.close()
+        for run in runs:
+            os.remove(run)
+        if len(self.closed) > self.max_runs:
+            self._compact_closed()
+        return goal
+
+    # refaz o plano a partir das chaves dos pais guardadas nos runs fechados
+    def _rebuild(self, key):
+        keys = [key]
+        while True:
+            for run in self.closed:
+                parent = closed_parent(run, key)
+                if parent is not None:
+                    break
+            else:
+                raise RuntimeError(f"state key {key:016x} is in no closed run")
+            if parent == key:
+                break
+            keys.append(parent)
+            key = parent
+        keys.reverse()
+
+        domain = self.problem.domain
+        state  = self.problem.initial
+        plan   = []
+        for key in keys[1:]:
+            for action in domain.actions(state):
+                newstate = domain.result(state, action)
+                if state_key(domain, newstate) == key:
+                    break
+            else:
+                raise RuntimeError(f"no action leads to the state with key {key:016x}")
+            plan.append(action)
+            state = newstate
+        return plan
+
+    def search(self):
+        problem = self.problem
+        domain  = problem.domain
+        self.workdir = self.directory or tempfile.mkdtemp(prefix='search-')
+        os.makedirs(self.workdir, exist_ok=True)
+        try:
+            key = state_key(domain, problem.initial)
+            self._push(priority(self.strategy, 0, 0, domain.heuristic(problem.initial, problem.goal)),
+                       key, key, 0, 0, problem.initial)
+
+            while self.buffers or self.runs:
+                value = min(set(self.buffers) | set(self.runs))
+                goal  = self._expand(value)
+                if goal:
+                    key, cost = goal
+                    self.solution = (cost, self._rebuild(key))
+                    return self.path
+            return None
+        finally:
+            for run in [run for runs in self.runs.values() for run in runs] + self.closed:
+                os.remove(run)
+            if self.directory is None:
+                shutil.rmtree(self.workdir, ignore_errors=True)
@@ -5,6 +5,7 @@ import logging
 
 from mapa import Map, Tiles
 from consts import GameStatus
+from protocol import STEP_ONLY
 
 logger = logging.getLogger("Game")
 logger.setLevel(logging.DEBUG)
@@ -35,6 +36,8 @@ class Game:
         self._step = 0
         self._total_steps = 0
         self._state = {}
+        self._delta = {}
+        self._box_moved = None
         self._papertrail = ""  # keeps track of all steps made by the player
         self._moves = 0
         self._pushes = 0
@@ -51,6 +54,11 @@ class Game:
             "map": f"levels/{self.level}.xsb",
         }
 
+    @property
+    def step(self):
+        """Step within the current level."""
+        return self._step
+
     @property
     def papertrail(self):
         """String containing all pressed keys by agent."""
@@ -129,6 +137,8 @@ class Game:
         # actually update map
         self.map.set_tile(npos, ctile)
         self.map.clear_tile(cur)
+        if ctile & Tiles.BOX == Tiles.BOX:
+            self._box_moved = (cur, npos)
         return True
 
     def update_keeper(self):
@@ -153,14 +163,9 @@ class Game:
 
         return GameStatus.RUNNING
 
-    async def next_frame(self):
-        """Calculate next frame."""
-        await asyncio.sleep(1.0 / GAME_SPEED)
-
-        if not self._running:
-            logger.info("Waiting for player 1")
-            return
-
+    def tick(self):
+        """Advance the game logic by one frame."""
+        self._box_moved = None
         self._step += 1
         if self._step >= self._timeout:
             self.stop()
@@ -168,7 +173,57 @@ class Game:
         if self._step % 100 == 0:
             logger.debug("[%s] SCORE %s", self._step, self.score)
 
-        game_status = self.update_keeper()
+        return self.update_keeper()
+
+    def simulate(self, keys):
+        """Apply a sequence of keys synchronously, one key per frame.
+
+        Runs the same logic as next_frame without sleeping and without building
+        the state, returning the final score tuple and the result of each level
+        played, including the step (within the level) where it was completed.
+        The level left in progress, by the end of the keys or by a timeout, is
+        reported as not completed. The game must be running (have a player).
+        """
+        assert self._running, "Game.simulate needs a running game, create it with a player"
+        levels = []
+        for key in keys:
+            if not self._running:
+                break
+            level, step = self.level, self._step + 1
+            self.keypress(key)
+            if self.tick() == GameStatus.NEW_MAP:
+                levels.append({"level": level, "completed": True, "step": step})
+
+        # after the last level the completed map stays loaded
+        if not self.map.completed:
+            levels.append(
+                {"level": self.level, "completed": False, "step": self._step, "box_on_goal": self.map.on_goal}
+            )
+        return self.score, levels
+
+    async def next_frame(self, wait=True):
+        """Calculate next frame.
+
+        With wait=False the frame is computed immediately (lockstep mode).
+        """
+        if wait:
+            await asyncio.sleep(1.0 / GAME_SPEED)
+
+        if not self._running:
+            logger.info("Waiting for player 1")
+            return
+
+        keeper, score = self.map.keeper, self.score
+        game_status = self.tick()
+
+        self._delta = {"step": self._step}
+        if self.map.keeper != keeper:
+            self._delta["keeper"] = self.map.keeper
+        if self._box_moved:
+            self._delta["box"] = self._box_moved
+        increments = [now - before for now, before in zip(self.score, score)]
+        if increments != STEP_ONLY:
+            self._delta["score"] = increments
 
         self._state = {
             "player": self._player_name,
@@ -186,3 +241,8 @@ class Game:
         """Contains the state of the Game."""
         # logger.debug(self._state)
         return json.dumps(self._state)
+
+    @property
+    def delta(self):
+        """Changes made by the last frame: keeper, moved box and score increments."""
+        return json.dumps(self._delta, separators=(",", ":"))
@@ -0,0 +1,339 @@
+# Module: hierarchy
+#
+# Two-level planning for levels made of rooms joined by corridors:
+#    Decomposition      - rooms and tunnels of a BoxDomain level
+#    StageDomain        - a BoxDomain restricted to some rooms, goals and boxes
+#    HierarchicalSearch - plans the flow of boxes between rooms on the
+#                         abstract graph, then solves one stage per room
+#
+# A tunnel cell is a free cell with walls on two opposite sides and free
+# cells on the other two; the rooms are the connected parts of the map
+# once the tunnels are taken out, and every tunnel joins the rooms at
+# its ends. Each box is assigned a goal (greedily, by push distance) and
+# its flow is the path of rooms from the room of the box to the room of
+# the goal. A room must be filled before any other goal room that the
+# flows towards it go through, so that those rooms aren't blocked yet;
+# the rooms are filled in that order. Each stage is a SearchTree search,
+# from the end of the previous one, in a StageDomain holding only the
+# goals of the room and the boxes assigned to them, over the rooms their
+# flows and the keeper go through (over the whole map if that isn't
+# enough); every other cell, and every other box, is a wall. The stage
+# plans are joined into the plan of the level. If a stage fails, the
+# level is searched as a whole, by a ParallelSearch if it has workers.
+
+from collections import deque
+
+from parallel_search import ParallelSearch
+from sokoban_domain import BoxDomain, LRUCache
+from tree_search import SearchProblem, SearchTree
+
+class Decomposition:
+    '''
+    @param domain, the BoxDomain of the level
+    '''
+    def __init__(self, domain):
+        ncells = len(domain.wallmask)
+        width  = domain.width
+        free   = [not domain.wallmask[cell] for cell in range(ncells)]
+
+        def is_free(cell):
+            return 0 <= cell < ncells and free[cell]
+
+        self.tunnel = bytearray(ncells)
+        for cell in range(ncells):
+            if not free[cell]:
+                continue
+            x = cell % width
+            left  = x > 0 and is_free(cell - 1)
+            right = x < width - 1 and is_free(cell + 1)
+            up    = is_free(cell - width)
+            down  = is_free(cell + width)
+            if (left and right and not up and not down) or (up and down and not left and not right):
+                self.tunnel[cell] = 1
+
+        # salas: componentes ligadas das celulas livres que nao sao tunel
+        self.room_of = [-1] * ncells
+        self.rooms   = []
+        for start in range(ncells):
+            if not free[start] or self.tunnel[start] or self.room_of[start] != -1:
+                continue
+            room = len(self.rooms)
+            self.room_of[start] = room
+            cells, frontier = [], [start]
+            while frontier:
+                cell = frontier.pop()
+                cells.append(cell)
+                for _, neighbour in domain.neighbours[cell]:
+                    if not self.tunnel[neighbour] and self.room_of[neighbour] == -1:
+                        self.room_of[neighbour] = room
+                        frontier.append(neighbour)
+            self.rooms.append(cells)
+
+        # tuneis: componentes ligadas das celulas de tunel, com as salas que ligam
+        self.tunnels = []
+        self.links   = [set() for _ in self.rooms]
+        seen = bytearray(ncells)
+        for start in range(ncells):
+            if not self.tunnel[start] or seen[start]:
+                continue
+            seen[start] = 1
+            cells, rooms, frontier = [], set(), [start]
+            while frontier:
+                cell = frontier.pop()
+                cells.append(cell)
+                for _, neighbour in domain.neighbours[cell]:
+                    if self.tunnel[neighbour]:
+                        if not seen[neighbour]:
+                            seen[neighbour] = 1
+                            frontier.append(neighbour)
+                    elif self.room_of[neighbour] != -1:
+                        rooms.add(self.room_of[neighbour])
+            self.tunnels.append((cells, rooms))
+            for room in rooms:
+                self.links[room] |= rooms - {room}
+
+        # uma celula de tunel pertence, no grafo abstrato, a uma das salas que liga
+        for cells, rooms in self.tunnels:
+            if rooms:
+                for cell in cells:
+                    self.room_of[cell] = min(rooms)
+
+    # caminho de salas entre duas salas no grafo abstrato (pesquisa em largura)
+    def route(self, origin, destination):
+        parents  = {origin: None}
+        frontier = deque([origin])
+        while frontier:
+            room = frontier.popleft()
+            if room == destination:
+                path = []
+                while room is not None:
+                    path.append(room)
+                    room = parents[room]
+                return path[::-1]
+            for neighbour in self.links[room]:
+                if neighbour not in parents:
+                    parents[neighbour] = room
+                    frontier.append(neighbour)
+        return None
+
+class StageDomain(BoxDomain):
+    '''
+    @param domain, the BoxDomain of the level
+    @param cells, the free cells of the stage, every other cell is a wall
+    @param goals, the goals of the stage
+    '''
+    def __init__(self, domain, cells, goals):
+        self.count = 0
+        self.matching_deadlocks = domain.matching_deadlocks
+
+        self.level    = domain.level
+        self.size     = domain.size
+        self.width    = domain.width
+        self.celltype = domain.celltype
+
+        cells = set(cells)
+        goals = set(goals)
+        self.wallmask = bytearray(len(domain.wallmask))
+        self.goalmask = bytearray(len(domain.wallmask))
+        self.walls = []
+        self.goals = []
+        self.floor = []
+        for y in range(self.size[1]):
+            for x in range(self.width):
+                cell = y * self.width + x
+                if domain.wallmask[cell] or cell not in cells:
+                    self.wallmask[cell] = 1
+                    self.walls.append((x, y))
+                elif (x, y) in goals:
+                    self.goalmask[cell] = 1
+                    self.goals.append((x, y))
+                else:
+                    self.floor.append((x, y))
+        self.build_tables()
+
+        self.regions     = LRUCache(domain.regions.maxsize)
+        self.paths       = LRUCache(domain.paths.maxsize)
+        self.matchings   = LRUCache(domain.matchings.maxsize)
+        self.frozen_rows = LRUCache(domain.frozen_rows.maxsize)
+        self.pattern_rests = LRUCache(domain.pattern_rests.maxsize)
+        self.zobrist_box    = domain.zobrist_box
+        self.zobrist_keeper = domain.zobrist_keeper
+        self.patterns = None
+
+class HierarchicalSearch:
+    '''
+    @param problem, the SearchProblem to solve, over a BoxDomain
+    @param strategy, the SearchTree strategy of every stage
+    @param workers, processes of the search of the whole level when a stage fails
+    '''
+    def __init__(self, problem, strategy='greedy', workers=1):
+        self.problem  = problem
+        self.strategy = strategy
+        self.workers  = workers
+        self.decomposition = Decomposition(problem.domain)
+        self.stages   = []
+        self.solution = None
+        self.expanded = 0
+
+    @property
+    def visited_ones(self):
+        return self.expanded
+
+    @property
+    def length(self):
+        if self.solution:
+            return len(self.solution[1])
+        return None
+
+    @property
+    def cost(self):
+        if self.solution:
+            return self.solution[0]
+        return None
+
+    @property
+    def plan(self):
+        if self.solution:
+            return self.solution[1]
+        return None
+
+    @property
+    def path(self):
+        if self.solution:
+            state = self.problem.initial
+            path  = [state]
+            for action in self.solution[1]:
+                state = self.problem.domain.result(state, action)
+                path.append(state)
+            return path
+        return None
+
+    # emparelhamento guloso, por distancia de empurroes, das caixas com os objetivos
+    def assignment(self, boxes, goals=None):
+        '''
+        @param boxes, the boxes to assign
+        @param goals, the goals they can be assigned to (every goal if None)
+        returns a dict with the box assigned to each goal that got one
+        '''
+        domain = self.problem.domain
+        goals  = domain.goals if goals is None else goals
+        rows   = {goal: row for goal, row in zip(domain.goals, domain.distanceToGoal)}
+        edges  = sorted((rows[goal][domain.cell(box)], box, goal) for box in boxes for goal in goals)
+        usedboxes, assigned = set(), dict()
+        for distance, box, goal in edges:
+            if distance == float('inf') or box in usedboxes or goal in assigned:
+                continue
+            usedboxes.add(box)
+            assigned[goal] = box
+        return assigned
+
+    # fluxos de caixas entre salas: cada caixa vai para o objetivo mais proximo livre
+    def flows(self, boxes):
+        domain  = self.problem.domain
+        room_of = self.decomposition.room_of
+        return [self.decomposition.route(room_of[domain.cell(box)], room_of[domain.cell(goal)])
+                for goal, box in self.assignment(boxes).items()]
+
+    # ordem de enchimento das salas com objetivos: uma sala antes das salas com
+    # objetivos por onde passam os fluxos que lhe chegam
+    def room_order(self, boxes):
+        domain  = self.problem.domain
+        room_of = self.decomposition.room_of
+        goals   = dict()
+        for goal in domain.goals:
+            goals.setdefault(room_of[domain.cell(goal)], []).append(goal)
+
+        before = {room: set() for room in goals}
+        for flow in self.flows(boxes):
+            if flow is None:
+                continue
+            for room in flow[:-1]:
+                if room in goals and room != flow[-1]:
+                    before[room].add(flow[-1])
+
+        order = []
+        while before:
+            ready = [room for room in before if before[room] <= set(order)] or [min(before, key=lambda room: len(before[room]))]
+            for room in sorted(ready):
+                order.append(room)
+                del before[room]
+        return [goals[room] for room in order]
+
+    def _stage(self, state, goals, filled):
+        '''
+        @param state, the state the stage starts from
+        @param goals, the goals to fill in this stage
+        @param filled, the goals filled by the previous stages
+        returns the SearchTree of the stage after searching, over the rooms
+        on the way of its boxes and then, if that fails, over the whole map;
+        None if the goals of the stage can't all be assigned a box
+        '''
+        domain  = self.problem.domain
+        room_of = self.decomposition.room_of
+        boxes   = [box for box in state[1] if box not in filled]
+        assigned = self.assignment(boxes, [goal for goal in domain.goals if goal not in filled])
+        if any(goal not in assigned for goal in goals):
+            return None
+
+        stageboxes = [assigned[goal] for goal in goals]
+        walls = set(domain.cell(box) for box in state[1] if box not in stageboxes)
+        free  = [cell for cell in range(len(room_of)) if cell not in walls]
+        regions = [free]
+
+        # salas por onde passam as caixas do estagio e o keeper ate elas; se
+        # nao chegarem (a caixa tem de dar a volta por outra sala), o mapa todo
+        keeper = room_of[domain.cell(state[0])]
+        rooms  = {keeper}
+        for goal in goals:
+            box, target = room_of[domain.cell(assigned[goal])], room_of[domain.cell(goal)]
+            routes = [self.decomposition.route(box, target), self.decomposition.route(keeper, box) if keeper != -1 else []]
+            if -1 in (box, target) or None in routes:
+                rooms = None
+                break
+            for route in routes:
+                rooms.update(route)
+        if rooms is not None:
+            cells = [cell for cell in free if room_of[cell] in rooms or room_of[cell] == -1]
+            if len(cells) < len(free):
+                regions.insert(0, cells)
+
+        for cells in regions:
+            stage = StageDomain(domain, cells, goals)
+            tree = SearchTree(SearchProblem(stage, [state[0], stageboxes], [None, list(goals)]), self.strategy)
+            tree.search()
+            self.expanded += tree.visited_ones
+            if tree.solution is not None:
+                break
+        return tree
+
+    def search(self):
+        domain = self.problem.domain
+        state  = self.problem.initial
+        plan, cost, filled = [], 0, set()
+        self.stages = self.room_order(state[1])
+        # com uma so sala com objetivos, o estagio seria o nivel inteiro
+        for goals in self.stages if len(self.stages) > 1 else []:
+            tree = self._stage(state, goals, filled)
+            if tree is None or tree.solution is None:
+                plan = None
+                break
+            # o plano do estagio vale no nivel inteiro: as paredes do estagio contem as do nivel
+            for action in tree.plan:
+                state = domain.result(state, action)
+            plan += tree.plan
+            cost += tree.cost
+            filled.update(goals)
+
+        if plan is None or not self.problem.goal_test(state):
+            # um estagio falhou: pesquisa global
+            if self.workers > 1:
+                tree = ParallelSearch(self.problem, self.strategy, self.workers)
+            else:
+                tree = SearchTree(self.problem, self.strategy)
+            tree.search()
+            self.expanded += tree.visited_ones
+            if tree.solution is None:
+                return None
+            plan, cost = tree.plan, tree.cost
+        self.solution = (cost, plan)
+        return self.path
@@ -0,0 +1,359 @@
+"""Load generator for the game server.
+
+Runs a fleet of simulated players and passive viewers in one asyncio
+process against a server and reports what they observed:
+
+ - tick jitter, how far the interval between two frames of a game strays
+   from the 1/fps the server announced (meaningless with --lockstep),
+ - key-to-state latency, from sending a key until the next frame arrives,
+ - messages and bytes received per second, by players and by viewers,
+ - server CPU usage, read from /proc when the server pid is known.
+
+Players either press random keys or replay stored plans, a JSON object
+mapping level numbers to key strings, as written by --make-plans. Players
+rejoin when their game ends, so the load holds for the whole run.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import time
+
+import websockets
+
+from protocol import PROTOCOL_VERSION, StateDecoder
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+)
+logger = logging.getLogger("LoadTest")
+logger.setLevel(logging.INFO)
+
+KEYS = "wasd"
+
+
+def percentile(values, fraction):
+    """Value below which the given fraction of the sorted values fall."""
+    if not values:
+        return None
+    index = min(len(values) - 1, int(fraction * len(values)))
+    return values[index]
+
+
+def summary(values, scale=1000):
+    """Mean and percentiles of a list of durations, in ms by default."""
+    if not values:
+        return None
+    values = sorted(values)
+    return {
+        "count": len(values),
+        "mean": scale * sum(values) / len(values),
+        "p50": scale * percentile(values, 0.5),
+        "p90": scale * percentile(values, 0.9),
+        "p99": scale * percentile(values, 0.99),
+        "max": scale * values[-1],
+    }
+
+
+def cpu_seconds(pid):
+    """User plus system CPU time used so far by a process, None if unknown."""
+    try:
+        with open(f"/proc/{pid}/stat", "r") as infile:
+            fields = infile.read().rsplit(")", 1)[1].split()
+    except (OSError, IndexError):
+        return None
+    # utime and stime are fields 14 and 15 of stat, counted after the ")"
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def level_of(mapfile):
+    """Level number of a map file name as sent in game info messages."""
+    return int(os.path.splitext(os.path.basename(mapfile))[0])
+
+
+class Stats:
+    """Counters and samples shared by every bot of one kind."""
+
+    def __init__(self):
+        self.messages = 0
+        self.bytes = 0
+        self.games = 0
+        self.intervals = []
+        self.latencies = []
+        self.errors = 0
+
+    def received(self, message):
+        self.messages += 1
+        self.bytes += len(message)
+
+
+class Player:
+    """Simulated player, pressing random keys or replaying stored plans."""
+
+    def __init__(self, name, address, stats, plans=None, upload=False):
+        self.name = name
+        self.address = address
+        self.stats = stats
+        self.plans = plans or {}
+        self.upload = upload
+        self.keys = ""
+        self.pending_plans = 0  # plans sent whose report hasn't come back
+
+    def next_key(self):
+        if self.keys:
+            key, self.keys = self.keys[0], self.keys[1:]
+            return key
+        if self.plans:
+            return ""  # plan over, wait for the next level
+        return random.choice(KEYS)
+
+    async def play(self):
+        """Play one game, until the server disconnects us."""
+        async with websockets.connect(f"ws://{self.address}/player") as websocket:
+            await websocket.send(
+                json.dumps({"cmd": "join", "name": self.name, "protocol": PROTOCOL_VERSION})
+            )
+            decoder = StateDecoder()
+            self.pending_plans = 0
+            period = None
+            last_frame = None
+            sent = None
+
+            async for message in websocket:
+                now = time.perf_counter()
+                self.stats.received(message)
+                update = decoder.update(json.loads(message))
+                if update is None:
+                    continue
+                if "plan" in update:
+                    # the report of a plan can follow the upload of the next level's plan
+                    self.pending_plans = max(self.pending_plans - 1, 0)
+                    if not self.pending_plans:
+                        # the plan is over: a lockstep server waits for our keys again
+                        await websocket.send(json.dumps({"cmd": "key", "key": self.next_key()}))
+                        sent = time.perf_counter()
+                    continue
+                if "map" in update:
+                    period = 1.0 / update["fps"]
+                    last_frame = None
+                    self.keys = self.plans.get(level_of(update["map"]), "")
+                    if self.upload and self.keys:
+                        await websocket.send(json.dumps({"cmd": "plan", "keys": self.keys}))
+                        self.pending_plans += 1
+                        self.keys = ""
+                    else:
+                        # a lockstep server waits for a key before the first frame
+                        await websocket.send(json.dumps({"cmd": "key", "key": ""}))
+                    continue
+
+                if last_frame is not None:
+                    self.stats.intervals.append(abs(now - last_frame - period))
+                last_frame = now
+                if sent is not None:
+                    self.stats.latencies.append(now - sent)
+                    sent = None
+
+                if not self.pending_plans:
+                    await websocket.send(json.dumps({"cmd": "key", "key": self.next_key()}))
+                    sent = time.perf_counter()
+        self.stats.games += 1
+
+    async def run(self):
+        """Play games back to back."""
+        while True:
+            try:
+                await self.play()
+            except websockets.exceptions.ConnectionClosedOK:
+                self.stats.games += 1  # game over while we were sending
+            except (OSError, websockets.exceptions.WebSocketException) as err:
+                self.stats.errors += 1
+                logger.warning("<%s> %s", self.name, err)
+                await asyncio.sleep(1)
+
+
+class Viewer:
+    """Passive viewer, counting what the server broadcasts."""
+
+    def __init__(self, address, stats, player=None):
+        self.address = address
+        self.stats = stats
+        self.player = player
+
+    async def watch(self):
+        async with websockets.connect(f"ws://{self.address}/viewer") as websocket:
+            join = {"cmd": "join", "protocol": PROTOCOL_VERSION}
+            if self.player:
+                join["player"] = self.player
+            await websocket.send(json.dumps(join))
+            last_frame = None
+
+            async for message in websocket:
+                now = time.perf_counter()
+                self.stats.received(message)
+                if last_frame is not None:
+                    self.stats.intervals.append(now - last_frame)
+                last_frame = now
+
+    async def run(self):
+        while True:
+            try:
+                await self.watch()
+            except (OSError, websockets.exceptions.WebSocketException) as err:
+                self.stats.errors += 1
+                logger.debug("Viewer %s", err)
+            await asyncio.sleep(1)
+
+
+async def load(args, plans):
+    """Run the fleet for args.duration seconds and gather the report."""
+    address = f"{args.server}:{args.port}"
+    players, viewers = Stats(), Stats()
+    bots = [
+        Player(f"bot{i}", address, players, plans, args.upload)
+        for i in range(args.players)
+    ]
+    bots += [
+        Viewer(address, viewers, f"bot{i % args.players}" if args.follow and args.players else None)
+        for i in range(args.viewers)
+    ]
+
+    cpu_start = cpu_seconds(args.server_pid) if args.server_pid else None
+    start = time.perf_counter()
+    tasks = [asyncio.ensure_future(bot.run()) for bot in bots]
+    await asyncio.sleep(args.duration)
+    elapsed = time.perf_counter() - start
+    cpu_end = cpu_seconds(args.server_pid) if args.server_pid else None
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    report = {
+        "players": args.players,
+        "viewers": args.viewers,
+        "duration": elapsed,
+        "games": players.games,
+        "errors": players.errors + viewers.errors,
+        "tick_jitter_ms": summary(players.intervals),
+        "key_to_state_ms": summary(players.latencies),
+        "viewer_interval_ms": summary(viewers.intervals),
+        "player_messages_per_s": players.messages / elapsed,
+        "player_bytes_per_s": players.bytes / elapsed,
+        "viewer_messages_per_s": viewers.messages / elapsed,
+        "viewer_bytes_per_s": viewers.bytes / elapsed,
+        "server_cpu": None,
+    }
+    if cpu_start is not None and cpu_end is not None:
+        report["server_cpu"] = (cpu_end - cpu_start) / elapsed
+    return report
+
+
+def print_report(report):
+    print(f"{report['players']} players, {report['viewers']} viewers for {report['duration']:.1f}s")
+    print(f"games finished: {report['games']}, connection errors: {report['errors']}")
+    for name in ["tick_jitter_ms", "key_to_state_ms", "viewer_interval_ms"]:
+        values = report[name]
+        if values is None:
+            print(f"{name:20} -")
+        else:
+            print(
+                f"{name:20} mean {values['mean']:7.2f}  p50 {values['p50']:7.2f}  "
+                f"p90 {values['p90']:7.2f}  p99 {values['p99']:7.2f}  max {values['max']:7.2f}"
+            )
+    print(
+        f"players: {report['player_messages_per_s']:.0f} msg/s, {report['player_bytes_per_s'] / 1024:.1f} KiB/s"
+    )
+    print(
+        f"viewers: {report['viewer_messages_per_s']:.0f} msg/s, {report['viewer_bytes_per_s'] / 1024:.1f} KiB/s"
+    )
+    if report["server_cpu"] is not None:
+        print(f"server cpu: {100 * report['server_cpu']:.1f}%")
+
+
+def make_plans(levels):
+    """Solve the given levels, returning the key string of each one."""
+    from consts import Tiles
+    from mapa import Map
+    from sokoban_domain import BoxDomain
+    from tree_search import SearchProblem, SearchTree
+
+    plans = {}
+    for level in levels:
+        filename = f"levels/{level}.xsb"
+        mapa = Map(filename)
+        initial = [mapa.keeper, mapa.boxes]
+        goal = [None, mapa.filter_tiles([Tiles.MAN_ON_GOAL, Tiles.BOX_ON_GOAL, Tiles.GOAL])]
+        tree = SearchTree(SearchProblem(BoxDomain(filename), initial, goal), "greedy")
+        if tree.search() is None:
+            logger.warning("No plan for level %s", level)
+            continue
+        plans[level] = "".join(key for _, path in tree.plan for key in path)
+        logger.info("Level %s: %s keys", level, len(plans[level]))
+    return plans
+
+
+def levels_range(text):
+    """Parse a level range such as 1-20."""
+    first, _, last = text.partition("-")
+    return range(int(first), int(last or first) + 1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--server", help="IP address of the server", default="localhost")
+    parser.add_argument("--port", help="TCP port", type=int, default=8000)
+    parser.add_argument("--players", help="simulated players", type=int, default=8)
+    parser.add_argument("--viewers", help="passive viewers", type=int, default=0)
+    parser.add_argument(
+        "--follow", help="each viewer watches one of the players", action="store_true"
+    )
+    parser.add_argument("--duration", help="seconds to run", type=float, default=30)
+    parser.add_argument("--plans", help="JSON file with stored plans to replay")
+    parser.add_argument(
+        "--upload", help="send stored plans with the plan command", action="store_true"
+    )
+    parser.add_argument("--make-plans", help="solve levels and write the plans to this file")
+    parser.add_argument("--levels", help="levels for --make-plans", type=levels_range, default="1-10")
+    parser.add_argument("--server-pid", help="pid of the server, to measure its CPU", type=int)
+    parser.add_argument(
+        "--spawn",
+        help="start server.py on the given port, passing the remaining arguments",
+        nargs=argparse.REMAINDER,
+    )
+    parser.add_argument("--json", help="also write the report to this file")
+    args = parser.parse_args()
+
+    if args.make_plans:
+        with open(args.make_plans, "w") as outfile:
+            json.dump(make_plans(args.levels), outfile)
+        sys.exit(0)
+
+    plans = None
+    if args.plans:
+        with open(args.plans, "r") as infile:
+            plans = {int(level): keys for level, keys in json.load(infile).items()}
+
+    server = None
+    if args.spawn is not None:
+        server = subprocess.Popen(
+            [sys.executable, "server.py", "--port", str(args.port), "--grading-server", ""]
+            + args.spawn
+        )
+        args.server_pid = server.pid
+        time.sleep(1)
+
+    try:
+        loop = asyncio.get_event_loop()
+        report = loop.run_until_complete(load(args, plans))
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as outfile:
+            json.dump(report, outfile, indent=2)
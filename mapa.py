@@ -1,8 +1,5 @@
 """Generic representation of the Game Map."""
 import logging
-from functools import reduce
-from operator import add
-
 from consts import Tiles, TILES
 
 logger = logging.getLogger("Map")
@@ -37,6 +34,32 @@ class Map:
             while len(line) < self.hor_tiles:
                 self._map[y].append(Tiles.FLOOR)
 
+        self._build_indexes()
+
+    def _build_indexes(self):
+        """Scan the map once to index boxes and goals, kept updated by set/clear_tile."""
+        self._boxes = set()
+        self._empty_goals = set()
+        self._on_goal = 0
+        for y, line in enumerate(self._map):
+            for x, tile in enumerate(line):
+                self._index((x, y), tile)
+
+    def _index(self, pos, tile, count=1):
+        """Add (count=1) or remove (count=-1) a tile from the indexes."""
+        if tile & Tiles.BOX == Tiles.BOX:
+            if count > 0:
+                self._boxes.add(pos)
+            else:
+                self._boxes.discard(pos)
+            if tile & Tiles.GOAL:
+                self._on_goal += count
+        elif tile & Tiles.GOAL and tile != Tiles.WALL:
+            if count > 0:
+                self._empty_goals.add(pos)
+            else:
+                self._empty_goals.discard(pos)
+
     def __str__(self):
         map_str = ""
         screen = {tile: symbol for symbol, tile in TILES.items()}
@@ -57,6 +80,7 @@ class Map:
             max([len(line) for line in self._map]),
             len(self._map),
         )  # X, Y
+        self._build_indexes()
 
     @property
     def size(self):
@@ -66,21 +90,12 @@ class Map:
     @property
     def completed(self):
         """Map is completed when there are no empty_goals!"""
-        return self.empty_goals == []
+        return not self._empty_goals
 
     @property
     def on_goal(self):
-        """Number of boxes on goal.
-
-           Counts per line and counts all lines using reduce
-        """
-        return reduce(
-            add,
-            [
-                reduce(lambda a, b: a + int(b is Tiles.BOX_ON_GOAL), l, 0)
-                for l in self._map
-            ],
-        )
+        """Number of boxes on goal."""
+        return self._on_goal
 
     def filter_tiles(self, list_to_filter):
         """Util to retrieve list of coordinates of given tiles."""
@@ -101,13 +116,13 @@ class Map:
 
     @property
     def boxes(self):
-        """List of coordinates of the boxes."""
-        return self.filter_tiles([Tiles.BOX, Tiles.BOX_ON_GOAL])
+        """List of coordinates of the boxes (in the same order as filter_tiles)."""
+        return sorted(self._boxes, key=lambda pos: (pos[1], pos[0]))
 
     @property
     def empty_goals(self):
         """List of coordinates of the empty goals locations."""
-        return self.filter_tiles([Tiles.GOAL, Tiles.MAN_ON_GOAL])
+        return sorted(self._empty_goals, key=lambda pos: (pos[1], pos[0]))
 
     def get_tile(self, pos):
         """Retrieve tile at position pos."""
@@ -117,9 +132,11 @@ class Map:
     def set_tile(self, pos, tile):
         """Set the tile at position pos to tile."""
         x, y = pos
+        self._index(pos, self._map[y][x], -1)
         self._map[y][x] = (
             tile & 0b1110 | self._map[y][x]
         )  # the 0b1110 mask avoid carring ON_GOAL to new tiles
+        self._index(pos, self._map[y][x])
 
         if (
             tile & Tiles.MAN == Tiles.MAN
@@ -129,7 +146,9 @@ class Map:
     def clear_tile(self, pos):
         """Remove mobile entity from pos."""
         x, y = pos
+        self._index(pos, self._map[y][x], -1)
         self._map[y][x] = self._map[y][x] & 0b1  # lesser bit carries ON_GOAL
+        self._index(pos, self._map[y][x])
 
     def is_blocked(self, pos):
         """Determine if mobile entity can be placed at pos."""
@@ -0,0 +1,285 @@
+# Module: parallel_search
+#
+# Hash-distributed best-first search (HDA*) over the
+# SearchDomain/SearchProblem interface of tree_search:
+#    ParallelSearch - runs one search over several worker processes
+#
+# Every state is owned by the worker selected by the hash of its key.
+# A worker expands only the states it owns; generated children that
+# belong to other workers are buffered and shipped in batches through
+# the owner's queue. A node carries the key of its parent rather than
+# its whole plan: each worker keeps the parent key and action of the
+# states it expanded, and once the search stops the plan is traced back
+# by asking the owner of each key for its parent.
+#
+# With the 'a*' strategy the search goes on until no worker holds a node
+# cheaper than the best solution found, so the returned plan is optimal
+# when the domain's heuristic is admissible. BoxDomain's greedy matching
+# distance is not (it may overestimate), so its plans are only as short
+# as the sequential a* ones. With any other strategy the first solution
+# stops every worker.
+
+import heapq
+import multiprocessing
+import queue
+import time
+import zlib
+
+# worker que e dono de uma chave de estado
+def owner(key, workers):
+    if isinstance(key, int):
+        return key % workers
+    return zlib.crc32(str(key).encode()) % workers
+
+# valor de ordenacao de um no na lista de abertos
+def priority(strategy, depth, cost, heuristic):
+    if strategy == 'breadth':
+        return depth
+    elif strategy == 'uniform':
+        return cost
+    elif strategy == 'greedy':
+        return heuristic
+    return cost + heuristic
+
+class _Control:
+    '''
+    Shared counters used to detect global termination: the search is over
+    when every worker is idle and every batch sent has been received.
+    '''
+    def __init__(self, ctx, workers):
+        self.lock      = ctx.Lock()
+        self.sent      = ctx.Value('q', 0, lock=False)
+        self.received  = ctx.Value('q', 0, lock=False)
+        self.idle      = ctx.Array('b', workers, lock=False)
+        self.incumbent = ctx.Value('d', float('inf'))
+        self.stop      = ctx.Event()
+
+    def quiescent(self):
+        with self.lock:
+            return all(self.idle) and self.sent.value == self.received.value
+
+def _worker(wid, problem, strategy, batch, inboxes, results, control):
+    domain  = problem.domain
+    workers = len(inboxes)
+    inbox   = inboxes[wid]
+    optimal = strategy == 'a*'
+
+    open_nodes = []
+    best_cost  = dict()
+    parents    = dict()     # chave -> (chave do pai, acao)
+    outgoing   = [[] for _ in range(workers)]
+    counter    = 0
+    expanded   = 0
+
+    def push(node):
+        nonlocal counter
+        value, cost, key, state, depth, parent, action = node
+        if optimal and value >= control.incumbent.value:
+            return
+        if key in best_cost and best_cost[key] <= cost:
+            return
+        heapq.heappush(open_nodes, (value, counter, cost, key, state, depth, parent, action))
+        counter += 1
+
+    def send(dest):
+        with control.lock:
+            control.sent.value += 1
+        inboxes[dest].put(outgoing[dest])
+        outgoing[dest] = []
+
+    def receive(block):
+        try:
+            nodes = inbox.get(timeout=0.01) if block else inbox.get_nowait()
+        except queue.Empty:
+            return False
+        with control.lock:
+            control.received.value += 1
+            control.idle[wid] = 0
+        for node in nodes:
+            push(node)
+        return True
+
+    key = domain.hash(problem.initial)
+    if owner(key, workers) == wid:
+        push((priority(strategy, 0, 0, domain.heuristic(problem.initial, problem.goal)), 0, key, problem.initial, 0, None, None))
+
+    while not control.stop.is_set():
+        while receive(False):
+            pass
+
+        if optimal:
+            while open_nodes and open_nodes[0][0] >= control.incumbent.value:
+                heapq.heappop(open_nodes)
+
+        if open_nodes == []:
+            for dest in range(workers):
+                if outgoing[dest]:
+                    send(dest)
+            with control.lock:
+                control.idle[wid] = 1
+            receive(True)
+            continue
+
+        _, _, cost, key, state, depth, parent, action = heapq.heappop(open_nodes)
+        if key in best_cost and best_cost[key] <= cost:
+            continue
+        best_cost[key] = cost
+        parents[key] = (parent, action)
+
+        if problem.goal_test(state):
+            with control.incumbent.get_lock():
+                improved = cost < control.incumbent.value
+                if improved:
+                    control.incumbent.value = cost
+            if improved:
+                results.put(("solution", cost, key))
+            if not optimal:
+                control.stop.set()
+            continue
+
+        expanded += 1
+        actions = domain.actions(state)
+        if actions == -1:
+            continue
+
+        for action in actions:
+            newstate = domain.result(state, action)
+            newcost  = cost + domain.cost(state, action)
+            value    = priority(strategy, depth + 1, newcost, domain.heuristic(newstate, problem.goal))
+            newkey   = domain.hash(newstate)
+            node     = (value, newcost, newkey, newstate, depth + 1, key, action)
+            dest     = owner(newkey, workers)
+            if dest == wid:
+                push(node)
+            else:
+                outgoing[dest].append(node)
+                if len(outgoing[dest]) >= batch:
+                    send(dest)
+
+    results.put(("stats", wid, expanded))
+
+    # responde aos pedidos do pai de uma chave ate receber None; os lotes
+    # de nos ainda por ler sao descartados
+    while True:
+        message = inbox.get()
+        if message is None:
+            break
+        if isinstance(message, tuple):
+            results.put(("parent",) + parents[message[1]])
+    for box in inboxes:
+        box.cancel_join_thread()
+
+class ParallelSearch:
+    '''
+    @param problem, the SearchProblem to solve; its domain must be picklable
+    @param strategy, 'a*' (optimal with an admissible heuristic) or any other SearchTree strategy
+    @param workers, number of worker processes (defaults to the cpu count)
+    @param batch, number of nodes shipped together to another worker
+    '''
+    def __init__(self, problem, strategy='a*', workers=None, batch=64):
+        self.problem  = problem
+        self.strategy = strategy
+        self.workers  = workers or multiprocessing.cpu_count()
+        self.batch    = batch
+        self.solution = None
+        self.expanded = 0
+
+    @property
+    def visited_ones(self):
+        return self.expanded
+
+    @property
+    def length(self):
+        if self.solution:
+            return len(self.solution[1])
+        return None
+
+    @property
+    def cost(self):
+        if self.solution:
+            return self.solution[0]
+        return None
+
+    @property
+    def plan(self):
+        if self.solution:
+            return self.solution[1]
+        return None
+
+    @property
+    def path(self):
+        if self.solution:
+            state = self.problem.initial
+            path  = [state]
+            for action in self.solution[1]:
+                state = self.problem.domain.result(state, action)
+                path.append(state)
+            return path
+        return None
+
+    def _collect(self, results, stats, best):
+        try:
+            while True:
+                message = results.get_nowait()
+                if message[0] == "stats":
+                    stats[message[1]] = message[2]
+                elif not best or message[1] < best[0]:
+                    best[:] = message[1:]
+        except queue.Empty:
+            pass
+
+    # plano da raiz ate a chave, pedindo a cada dono o pai e a acao da chave
+    def _trace(self, key, inboxes, results, procs):
+        plan = []
+        while True:
+            inboxes[owner(key, self.workers)].put(("parent", key))
+            while True:
+                try:
+                    _, parent, action = results.get(timeout=0.1)
+                    break
+                except queue.Empty:
+                    if not all(proc.is_alive() for proc in procs):
+                        return None
+            if parent is None:
+                plan.reverse()
+                return plan
+            plan.append(action)
+            key = parent
+
+    def search(self):
+        ctx     = multiprocessing.get_context()
+        control = _Control(ctx, self.workers)
+        inboxes = [ctx.Queue() for _ in range(self.workers)]
+        results = ctx.Queue()
+        procs   = [ctx.Process(target=_worker, daemon=True,
+                               args=(wid, self.problem, self.strategy, self.batch, inboxes, results, control))
+                   for wid in range(self.workers)]
+        for proc in procs:
+            proc.start()
+
+        stats = dict()
+        best  = []      # custo e chave da melhor solucao
+        while not control.stop.is_set():
+            self._collect(results, stats, best)
+            if control.quiescent() or not any(proc.is_alive() for proc in procs):
+                control.stop.set()
+            time.sleep(0.01)
+
+        while len(stats) < self.workers and any(proc.is_alive() for proc in procs):
+            self._collect(results, stats, best)
+            time.sleep(0.01)
+        self._collect(results, stats, best)
+
+        if best:
+            plan = self._trace(best[1], inboxes, results, procs)
+            if plan is not None:
+                self.solution = (best[0], plan)
+        for inbox in inboxes:
+            inbox.put(None)
+        for proc in procs:
+            proc.join(1)
+            if proc.is_alive():
+                proc.terminate()
+
+        self.expanded = sum(stats.values())
+        return self.path
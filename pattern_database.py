@@ -0,0 +1,293 @@
+# Module: pattern_database
+#
+# Pattern databases for the BoxDomain heuristic:
+#    PatternDatabase - exact push costs of every placement of a small
+#                      subset of boxes (2 to 4), the other boxes removed
+#
+# The table is built by a retrograde breadth-first search: starting from
+# every placement of the subset on goals, with the keeper in any region,
+# boxes are pulled one cell at a time. The first time a placement is
+# reached gives its cost, the minimum over the keeper positions. Costs
+# are kept in an array('B') indexed by the combination of the cells of
+# the boxes (UNREACHABLE when the boxes can't all reach goals, costs
+# above MAX_COST stored as MAX_COST, still a lower bound), optionally
+# built with a pool of worker processes on the larger layers and cached
+# on disk by a hash of the walls and goals of the map. A build that goes
+# past max_states search states is dropped for a pattern one box smaller;
+# the cache keeps an empty table for it, so it isn't tried again.
+#
+# estimate() combines the table into a heuristic: the boxes of a state
+# are grouped in disjoint subsets, chosen greedily by how much their
+# table cost exceeds the sum of the distances of each box alone, and
+# the costs of the groups are added. Given an LRU of the groups with a
+# gain among all the boxes but one, by the Zobrist key of those boxes, a
+# state only looks up the groups holding the box that moved from its
+# parent instead of every C(boxes, size) group.
+
+from array import array
+from itertools import combinations
+import hashlib
+import multiprocessing
+import os
+import tempfile
+
+UNREACHABLE   = 255
+MAX_COST      = 254     # custos maiores ficam guardados como MAX_COST
+MAX_STATES    = 150000  # estados da pesquisa retrograda antes de desistir do tamanho
+PARALLEL_SIZE = 2000    # fronteiras menores sao expandidas no processo principal
+CACHE_DIR     = os.path.join(tempfile.gettempdir(), 'sokoban-pdb')
+
+_tables = dict()        # tabelas ja carregadas neste processo, por ficheiro
+_grid   = None          # grelha usada pelos processos do pool
+
+# coeficientes binomiais C(n, r) para r ate size
+def binomials(n, size):
+    table = [[0] * (size + 1) for _ in range(n + 1)]
+    for i in range(n + 1):
+        table[i][0] = 1
+        for r in range(1, min(i, size) + 1):
+            table[i][r] = table[i-1][r-1] + table[i-1][r]
+    return table
+
+# etiquetas das zonas do keeper: para cada celula, a menor celula alcancavel
+def regions(grid, boxes):
+    ncells, wallmask, neighbours, _ = grid
+    blocked = bytearray(wallmask)
+    for box in boxes:
+        blocked[box] = 1
+    labels = array('i', [-1]) * ncells
+    for start in range(ncells):
+        if blocked[start]:
+            continue
+        blocked[start] = 1
+        frontier = [start]
+        while frontier:
+            cell = frontier.pop()
+            labels[cell] = start
+            for neighbour in neighbours[cell]:
+                if not blocked[neighbour]:
+                    blocked[neighbour] = 1
+                    frontier.append(neighbour)
+    return labels
+
+# estados anteriores (por um puxao) de uma lista de estados (caixas, zona)
+def predecessors(grid, states):
+    steps = grid[3]
+    result = []
+    labels = dict()
+    for boxes, region in states:
+        if boxes not in labels:
+            labels[boxes] = regions(grid, boxes)
+        current = labels[boxes]
+        for box in boxes:
+            for direction, keeper in steps[box].items():
+                # o keeper, na zona, puxa a caixa para a sua celula e recua
+                behind = steps[keeper].get(direction)
+                if current[keeper] != region or behind is None or current[behind] == -1:
+                    continue
+                newboxes = tuple(sorted([other for other in boxes if other != box] + [keeper]))
+                newlabels = labels.get(newboxes)
+                if newlabels is None:
+                    newlabels = labels[newboxes] = regions(grid, newboxes)
+                result.append((newboxes, newlabels[behind]))
+    return result
+
+def _init_worker(grid):
+    global _grid
+    _grid = grid
+
+def _predecessors(states):
+    return predecessors(_grid, states)
+
+class PatternDatabase:
+    '''
+    @param domain, the BoxDomain of the level
+    @param size, number of boxes in each pattern (2 to 4), lowered while the
+    build goes past max_states (size 2 is always built)
+    @param workers, processes used to build the table; a pool can't be started
+    from a daemonic process, so only callers that own their process should ask
+    for more than 1
+    @param cache_dir, directory of the tables cached on disk (None disables it)
+    @param max_states, states of the retrograde search after which a build is dropped
+    '''
+    def __init__(self, domain, size=2, workers=1, cache_dir=CACHE_DIR, max_states=MAX_STATES):
+        assert 2 <= size <= 4, "patterns have 2 to 4 boxes"
+        self.workers    = workers
+        self.max_states = max_states
+        ncells          = len(domain.wallmask)
+
+        # celulas onde pode estar uma caixa: livres e sem deadlock simples
+        self.live  = [cell for cell in range(ncells) if not domain.wallmask[cell] and not domain.deadmask[cell]]
+        self.index = array('i', [-1]) * ncells
+        for idx, cell in enumerate(self.live):
+            self.index[cell] = idx
+
+        # distancia de cada celula ao objetivo mais proximo (a caixa sozinha)
+        self.single = array('d', [min(row[cell] for row in domain.distanceToGoal) if domain.distanceToGoal else 0
+                                  for cell in range(ncells)])
+
+        steps = [dict() for _ in range(ncells)]
+        for cell in range(ncells):
+            for direction, neighbour in domain.neighbours[cell]:
+                steps[cell][direction] = neighbour
+        self.grid  = (ncells, bytes(domain.wallmask),
+                      [[neighbour for _, neighbour in domain.neighbours[cell]] for cell in range(ncells)], steps)
+        self.goals = [domain.cell(goal) for goal in domain.goals]
+        self.zobrist = domain.zobrist_box
+
+        digest = hashlib.sha1()
+        digest.update(str(domain.width).encode())
+        digest.update(bytes(domain.wallmask))
+        digest.update(bytes(domain.goalmask))
+
+        # o maior tamanho, ate size, cuja tabela cabe em max_states
+        for size in range(size, 1, -1):
+            self.size      = size
+            self.binomials = binomials(len(self.live), size)
+            self.filename  = os.path.join(cache_dir, f"{digest.hexdigest()}-{size}.pdb") if cache_dir else None
+            self.table     = self.load(bounded=size > 2)
+            if self.table:
+                break
+
+    # indice de um conjunto ordenado de celulas vivas (sistema combinatorio),
+    # ou None se alguma celula nao e viva
+    def combination(self, cells):
+        index = self.index
+        if any(index[cell] == -1 for cell in cells):
+            return None
+        return sum(self.binomials[index[cell]][r + 1] for r, cell in enumerate(cells))
+
+    # tabela da cache (do processo ou do disco) ou construida; vazia se passou do limite
+    def load(self, bounded=True):
+        if self.filename and self.filename in _tables:
+            return _tables[self.filename]
+        table = None
+        if self.filename and os.path.isfile(self.filename):
+            table = array('B')
+            with open(self.filename, 'rb') as infile:
+                table.frombytes(infile.read())
+            if len(table) not in (0, self.binomials[len(self.live)][self.size]):
+                table = None
+        if table is None:
+            table = self.build(self.max_states if bounded else None)
+            if self.filename:
+                os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+                tmpfile = f"{self.filename}.{os.getpid()}.tmp"
+                with open(tmpfile, 'wb') as outfile:
+                    outfile.write(table.tobytes())
+                os.replace(tmpfile, self.filename)
+        if self.filename:
+            _tables[self.filename] = table
+        return table
+
+    # pesquisa retrograda em largura a partir das colocacoes nos objetivos;
+    # devolve uma tabela vazia se passar de max_states estados
+    def build(self, max_states=None):
+        table = array('B', [UNREACHABLE]) * self.binomials[len(self.live)][self.size]
+        frontier = []
+        for boxes in combinations(sorted(self.goals), self.size):
+            labels = regions(self.grid, boxes)
+            frontier += [(boxes, region) for region in set(labels) if region != -1]
+        seen = set(frontier)
+        for boxes, _ in frontier:
+            table[self.combination(boxes)] = 0
+
+        pool  = None
+        depth = 0
+        try:
+            while frontier:
+                depth += 1
+                # a camada e expandida aos pedacos, para o limite de estados ser
+                # verificado antes de a camada inteira estar feita
+                states, frontier = frontier, []
+                if len(states) >= PARALLEL_SIZE and self.workers > 1:
+                    if pool is None:
+                        pool = multiprocessing.Pool(self.workers, _init_worker, (self.grid,))
+                    chunk = -(-len(states) // (4 * self.workers))
+                    layer = pool.imap(_predecessors, [states[i:i+chunk] for i in range(0, len(states), chunk)])
+                else:
+                    layer = (predecessors(self.grid, states[i:i+PARALLEL_SIZE])
+                             for i in range(0, len(states), PARALLEL_SIZE))
+
+                for found in layer:
+                    for state in found:
+                        if state in seen:
+                            continue
+                        seen.add(state)
+                        frontier.append(state)
+                        idx = self.combination(state[0])
+                        if idx is not None and table[idx] == UNREACHABLE:
+                            table[idx] = min(depth, MAX_COST)
+                    if max_states is not None and len(seen) > max_states:
+                        return array('B')
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+        return table
+
+    # custo de colocar as caixas dadas (celulas) nos objetivos, ou None se impossivel
+    def cost(self, cells):
+        idx = self.combination(sorted(cells))
+        if idx is None:
+            return None
+        value = self.table[idx]
+        return None if value == UNREACHABLE else value
+
+    def estimate(self, cells, infinite=100000000, rests=None, key=None):
+        '''
+        @param cells, the cells of the boxes of a state
+        @param rests, an LRUCache of the groups with a gain among all the boxes
+        but one, by the Zobrist key of those boxes (None to compute every group)
+        @param key, the Zobrist key of the boxes (BoxDomain.boxes_key), with rests
+        returns the sum of the costs of disjoint groups of boxes, chosen
+        greedily by how much their cost exceeds the boxes moved alone, or
+        infinite if some group of boxes can't be placed on goals
+        '''
+        total = sum(self.single[cell] for cell in cells)
+        if total == float('inf'):
+            return infinite
+        if len(cells) < self.size:
+            return total
+
+        # um filho difere do pai numa caixa: os grupos sem ela ja foram
+        # calculados com o pai, falta so ver os grupos que a incluem
+        gains = None
+        if rests is not None:
+            for moved in cells:
+                known = rests.get(key ^ self.zobrist[moved])
+                if known is not None:
+                    others = sorted(cell for cell in cells if cell != moved)
+                    gains  = self.gains([tuple(sorted(group + (moved,))) for group in combinations(others, self.size - 1)])
+                    if gains is None:
+                        return infinite
+                    gains += known
+                    break
+        if gains is None:
+            gains = self.gains(combinations(sorted(cells), self.size))
+            if gains is None:
+                return infinite
+        if rests is not None:
+            for cell in cells:
+                rests.put(key ^ self.zobrist[cell], [gain for gain in gains if cell not in gain[1]])
+
+        used = set()
+        for gain, group in sorted(gains, reverse=True):
+            if used.isdisjoint(group):
+                used.update(group)
+                total += gain
+        return total
+
+    # (ganho, grupo) dos grupos de celulas ordenadas cujo custo excede o das
+    # caixas sozinhas, ou None se algum grupo nao chega aos objetivos
+    def gains(self, groups):
+        gains = []
+        for group in groups:
+            idx = self.combination(group)
+            value = UNREACHABLE if idx is None else self.table[idx]
+            if value == UNREACHABLE:
+                return None
+            gain = value - sum(self.single[cell] for cell in group)
+            if gain > 0:
+                gains.append((gain, group))
+        return gains
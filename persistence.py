@@ -0,0 +1,202 @@
+"""Score persistence and grading upload, kept off the game loop."""
+import asyncio
+import fcntl
+import json
+import logging
+import os
+
+import requests
+from requests import RequestException
+
+from consts import MAX_HIGHSCORES
+
+logger = logging.getLogger("Persistence")
+logger.setLevel(logging.INFO)
+
+HIGHSCORE_FILE = "highscores.json"
+SCORE_LOG_FILE = "highscores.log"
+GRADING_SPOOL_FILE = "grading.spool"
+
+
+def top_scores(highscores):
+    """The highscores view: MAX_HIGHSCORES entries, sorted by score."""
+    return sorted(highscores, key=lambda s: s[1])[:MAX_HIGHSCORES]
+
+
+class ScoreLog:
+    """Append-only log of final scores, compacted now and then into the highscores file.
+
+    Scores are visible in highscores as soon as they are recorded, the disk
+    writes happen in a background task on the default executor. The log and
+    the compaction are guarded by a file lock, so several server processes
+    can share them.
+    """
+
+    def __init__(
+        self,
+        highscores_file=HIGHSCORE_FILE,
+        log_file=SCORE_LOG_FILE,
+        compact_every=60,
+    ):
+        self.highscores_file = highscores_file
+        self.log_file = log_file
+        self.compact_every = compact_every
+        self.highscores = top_scores(self._load())
+        self._pending = asyncio.Queue()
+
+    def _load(self):
+        highscores = []
+        if os.path.isfile(self.highscores_file):
+            with open(self.highscores_file, "r") as infile:
+                highscores = [tuple(entry) for entry in json.load(infile)]
+        if os.path.isfile(self.log_file):
+            with open(self.log_file, "r") as infile:
+                highscores += [tuple(json.loads(line)) for line in infile if line.strip()]
+        return highscores
+
+    def record(self, name, score):
+        """Add a (name, score) entry, without touching the disk."""
+        entry = (name, score)
+        self.highscores = top_scores(self.highscores + [entry])
+        self._pending.put_nowait(entry)
+
+    def _append(self, entries):
+        with open(self.log_file, "a") as outfile:
+            fcntl.flock(outfile, fcntl.LOCK_EX)
+            for entry in entries:
+                outfile.write(json.dumps(entry) + "\n")
+            outfile.flush()
+
+    def compact(self):
+        """Fold the log into the highscores file and empty the log."""
+        with open(self.log_file, "a+") as log:
+            fcntl.flock(log, fcntl.LOCK_EX)
+            highscores = top_scores(self._load())
+            tmpfile = self.highscores_file + ".tmp"
+            with open(tmpfile, "w") as outfile:
+                json.dump(highscores, outfile)
+            os.replace(tmpfile, self.highscores_file)
+            log.truncate(0)
+        return highscores
+
+    async def run(self):
+        """Background task writing recorded scores and compacting the log."""
+        loop = asyncio.get_event_loop()
+        while True:
+            try:
+                entries = [
+                    await asyncio.wait_for(self._pending.get(), self.compact_every)
+                ]
+                while not self._pending.empty():
+                    entries.append(self._pending.get_nowait())
+                await loop.run_in_executor(None, self._append, entries)
+            except asyncio.TimeoutError:
+                await loop.run_in_executor(None, self.compact)
+            except OSError as err:
+                logger.error("Could not store scores: %s", err)
+
+
+class GradingUploader:
+    """Background uploader of game records to the grading server.
+
+    Records wait in a local spool file until the grading server accepts
+    them, so they survive restarts. The spool is only appended to, and the
+    records accepted by the server are cut from its head; both happen under
+    a file lock, so the server processes sharing a spool never upload the
+    same record twice nor drop each other's records. Uploads are done in
+    batches from the default executor and retried with exponential backoff.
+    """
+
+    def __init__(
+        self,
+        url,
+        spool_file=GRADING_SPOOL_FILE,
+        batch=10,
+        timeout=10,
+        retry_delay=1,
+        max_retry_delay=300,
+    ):
+        self.url = url
+        self.spool_file = spool_file
+        self.lock_file = spool_file + ".lock"
+        self.batch = batch
+        self.timeout = timeout
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self._pending = asyncio.Queue()
+
+    def submit(self, record):
+        """Queue a game record for upload, without touching the disk."""
+        self._pending.put_nowait(record)
+
+    def _lock(self):
+        lock = open(self.lock_file, "a")
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return lock
+
+    def _append(self, records):
+        with self._lock():
+            with open(self.spool_file, "a") as outfile:
+                for record in records:
+                    outfile.write(json.dumps(record) + "\n")
+
+    def _upload(self):
+        """Post the head of the spool and cut what was accepted.
+
+        Returns (records tried, records sent, records left in the spool).
+        The lock is held while posting, so a record is only ever sent by
+        one process.
+        """
+        with self._lock():
+            if not os.path.isfile(self.spool_file):
+                return 0, 0, 0
+            with open(self.spool_file, "r") as infile:
+                lines = [line for line in infile if line.strip()]
+            records = [json.loads(line) for line in lines[: self.batch]]
+            sent = self._post(records)
+            if sent:
+                tmpfile = self.spool_file + ".tmp"
+                with open(tmpfile, "w") as outfile:
+                    outfile.writelines(lines[sent:])
+                os.replace(tmpfile, self.spool_file)
+            return len(records), sent, len(lines) - sent
+
+    def _post(self, records):
+        """Send records in order, returning how many were accepted."""
+        sent = 0
+        for record in records:
+            try:
+                requests.post(self.url, json=record, timeout=self.timeout).raise_for_status()
+            except RequestException as err:
+                logger.error(err)
+                break
+            sent += 1
+        return sent
+
+    async def run(self):
+        """Background task spooling the submitted records and uploading the spool."""
+        loop = asyncio.get_event_loop()
+        delay = self.retry_delay
+        waiting = os.path.isfile(self.spool_file)  # left over by a previous run
+        unspooled = []
+        while True:
+            if not waiting and not unspooled:
+                unspooled.append(await self._pending.get())
+            while not self._pending.empty():
+                unspooled.append(self._pending.get_nowait())
+            try:
+                if unspooled:
+                    await loop.run_in_executor(None, self._append, unspooled)
+                    unspooled = []
+                tried, sent, left = await loop.run_in_executor(None, self._upload)
+            except OSError as err:
+                logger.error("Could not spool game records: %s", err)
+                tried, sent, left = 1, 0, 1
+            waiting = left > 0
+
+            if sent < tried:
+                logger.warning("Could not save score to server, retrying in %ss", delay)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.max_retry_delay)
+            else:
+                delay = self.retry_delay
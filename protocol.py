@@ -0,0 +1,97 @@
+"""State stream protocol versions.
+
+Version 1 sends the full game state every frame. Version 2 sends a full
+state (keyframe) every KEYFRAME_INTERVAL frames and on every new level,
+and in between only what the frame changed:
+
+    {"step": 42, "keeper": [3, 4], "box": [[3, 4], [3, 5]], "score": [0, 1, 1, 1, 0]}
+
+"keeper" and "box" (from, to) are only present when they moved, and
+"score" holds the increments of the score tuple, omitted when only the
+step count went up. Clients ask for a version with the "protocol" field
+of the join command and the server answers with the version it will use
+in the "protocol" field of the first game info message.
+"""
+
+FULL_STATES = 1
+DELTAS = 2
+PROTOCOL_VERSION = DELTAS
+
+KEYFRAME_INTERVAL = 50
+STEP_ONLY = [0, 0, 0, 1, 0]  # score increments of a frame where only time passed
+
+
+def negotiate(data):
+    """Protocol version to use with a client, given its join command."""
+    try:
+        requested = int(data.get("protocol", FULL_STATES))
+    except (TypeError, ValueError):
+        requested = FULL_STATES
+    return max(FULL_STATES, min(requested, PROTOCOL_VERSION))
+
+
+class Frame:
+    """The encodings of one game frame, each produced at most once."""
+
+    def __init__(self, game, keyframe):
+        self.keyframe = keyframe
+        self._game = game
+        self._full = None
+        self._delta = None
+
+    @property
+    def full(self):
+        if self._full is None:
+            self._full = self._game.state
+        return self._full
+
+    @property
+    def delta(self):
+        if self._delta is None:
+            self._delta = self._game.delta
+        return self._delta
+
+    def encode(self, protocol):
+        """Message to send to a client using the given protocol version."""
+        if protocol >= DELTAS and not self.keyframe:
+            return self.delta
+        return self.full
+
+
+class StateDecoder:
+    """Rebuilds full game states from a version 1 or version 2 stream."""
+
+    def __init__(self):
+        self.state = None
+
+    def update(self, message):
+        """Decode a message.
+
+        Game info messages are returned unchanged, states (full or rebuilt
+        from a delta) are returned as full states, and None is returned for
+        deltas that can't be applied until the next keyframe arrives.
+        """
+        if "boxes" in message:
+            self.state = message
+            return message
+        if "step" not in message:
+            return message
+
+        if self.state is None or message["step"] != self.state["step"] + 1:
+            self.state = None  # lost a frame, wait for a keyframe
+            return None
+
+        state = dict(self.state)
+        state["step"] = message["step"]
+        if "keeper" in message:
+            state["keeper"] = message["keeper"]
+        if "box" in message:
+            origin, destination = [list(pos) for pos in message["box"]]
+            state["boxes"] = [
+                destination if list(box) == origin else box for box in state["boxes"]
+            ]
+        increments = message.get("score", STEP_ONLY)
+        state["score"] = [now + inc for now, inc in zip(state["score"], increments)]
+        self.state = state
+        return state
+
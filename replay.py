@@ -0,0 +1,231 @@
+"""Replay validator for game records.
+
+Replays the papertrail of grading records (as sent by the server, one JSON
+object per line, like the grading spool) against levels/*.xsb without the
+game loop, recomputing the score and finding the first key the game could
+not have recorded.
+
+The papertrail holds a "," each time a level starts followed by the keys
+pressed on it, blocked moves included. Keys are replayed on a flat board,
+padded with walls so that every move is a single index addition, and the
+records are spread over a process pool.
+
+The papertrail carries no idle frames, so the step count can't be replayed:
+the total_steps of the record is used when present, otherwise the number of
+keys, the least the game could have taken.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import sys
+
+from consts import Tiles
+from game import reduce_score
+from mapa import Map
+
+logger = logging.getLogger("Replay")
+logger.setLevel(logging.INFO)
+
+SCORE_FIELDS = ["puzzles", "total_moves", "total_pushes", "total_steps", "box_on_goal"]
+
+_levels = {}  # level number -> Board, or None when there is no such level
+
+
+class Board:
+    """A level in flat form: cells are y * width + x of the map padded with walls."""
+
+    __slots__ = ["width", "walls", "goals", "boxes", "keeper", "empty_goals"]
+
+    def __init__(self, mapa):
+        hor_tiles, ver_tiles = mapa.size
+        self.width = hor_tiles + 2
+        size = self.width * (ver_tiles + 2)
+        self.walls = bytearray(b"\x01" * size)
+        self.goals = bytearray(size)
+        self.boxes = bytearray(size)
+
+        for y in range(ver_tiles):
+            for x in range(hor_tiles):
+                tile = mapa.get_tile((x, y))
+                cell = self.cell((x, y))
+                if tile == Tiles.WALL:
+                    continue
+                self.walls[cell] = 0
+                self.goals[cell] = tile & Tiles.GOAL
+                self.boxes[cell] = 1 if tile & Tiles.BOX else 0
+
+        self.keeper = self.cell(mapa.keeper)
+        self.empty_goals = sum(1 for goal, box in zip(self.goals, self.boxes) if goal and not box)
+
+    def cell(self, pos):
+        x, y = pos
+        return (y + 1) * self.width + x + 1
+
+    @property
+    def on_goal(self):
+        return sum(self.goals) - self.empty_goals
+
+
+def level_board(level):
+    """Board of a level, parsed once per process; None if the level doesn't exist."""
+    if level not in _levels:
+        try:
+            _levels[level] = Board(Map(f"levels/{level}.xsb"))
+        except FileNotFoundError:
+            _levels[level] = None
+    return _levels[level]
+
+
+def play(board, keys, offset):
+    """Replay the keys of one level, with the same rules as Game.move.
+
+    Returns (moves, pushes, empty_goals, boxes on goal, invalid) where invalid
+    is None or (papertrail offset, reason).
+    """
+    width = board.width
+    walls, goals = board.walls, board.goals
+    boxes = bytearray(board.boxes)
+    keeper = board.keeper
+    empty_goals = board.empty_goals
+    directions = {"w": -width, "a": -1, "s": width, "d": 1}
+    moves = pushes = 0
+
+    for index, key in enumerate(keys):
+        if empty_goals == 0 and index > 0:
+            return moves, pushes, empty_goals, sum(goals) - empty_goals, (
+                offset + index, "keys after the level was completed")
+        direction = directions.get(key)
+        if direction is None:
+            return moves, pushes, empty_goals, sum(goals) - empty_goals, (
+                offset + index, f"invalid key {key!r}")
+
+        ahead = keeper + direction
+        if walls[ahead]:
+            continue
+        if boxes[ahead]:
+            beyond = ahead + direction
+            if walls[beyond] or boxes[beyond]:
+                continue
+            boxes[ahead] = 0
+            boxes[beyond] = 1
+            empty_goals += goals[ahead] - goals[beyond]
+            pushes += 1
+        moves += 1
+        keeper = ahead
+
+    return moves, pushes, empty_goals, sum(goals) - empty_goals, None
+
+
+def replay(papertrail, start=1, total_steps=None):
+    """Replay a papertrail starting on level start.
+
+    Returns a dict with the recomputed "score" tuple, its "reduced" value,
+    and "invalid": None or the offset in the papertrail of the first key the
+    game could not have recorded, explained in "reason".
+    """
+    result = {"score": None, "reduced": None, "invalid": None, "reason": None}
+    if not papertrail.startswith(","):
+        result["invalid"], result["reason"] = 0, "papertrail must start with ','"
+        return result
+
+    segments = papertrail[1:].split(",")
+    moves = pushes = keys = on_goal = 0
+    offset = 1
+    for number, segment in enumerate(segments):
+        level = start + number
+        last = number == len(segments) - 1
+        board = level_board(level)
+        if board is None:
+            if segment or not last:
+                result["invalid"], result["reason"] = offset, f"level {level} doesn't exist"
+                break
+            continue  # game won, the score keeps the last board
+
+        level_moves, level_pushes, empty_goals, on_goal, invalid = play(board, segment, offset)
+        moves += level_moves
+        pushes += level_pushes
+        keys += len(segment)
+        if invalid:
+            result["invalid"], result["reason"] = invalid
+            break
+        if empty_goals and not last:
+            result["invalid"], result["reason"] = offset + len(segment), f"level {level} left before completed"
+            break
+        if not empty_goals and last and segment:
+            result["invalid"], result["reason"] = offset + len(segment), f"level {level} completed without moving on"
+            break
+        offset += len(segment) + 1
+
+    steps = total_steps if total_steps is not None else keys
+    result["score"] = (len(segments), moves, pushes, steps, on_goal)
+    result["reduced"] = reduce_score(*result["score"])
+    return result
+
+
+def validate(record, start=None):
+    """Replay a grading record and compare the result with its stored score.
+
+    The starting level is derived from the final level and the number of
+    levels in the papertrail unless given. Fields of the record that differ
+    from the replay are listed in "mismatch".
+    """
+    papertrail = record["papertrail"]
+    if start is None:
+        start = record.get("level", 1) - papertrail.count(",") + 1
+    result = replay(papertrail, start, record.get("total_steps"))
+    result["player"] = record.get("player")
+    result["start"] = start
+    result["mismatch"] = [
+        field
+        for field, value in zip(SCORE_FIELDS, result["score"])
+        if field in record and record[field] != value
+    ]
+    return result
+
+
+def validate_all(records, start=None, processes=None, chunksize=64):
+    """Validate records over a process pool, yielding results in order."""
+    with multiprocessing.Pool(processes) as pool:
+        for result in pool.imap(_validate, ((record, start) for record in records), chunksize):
+            yield result
+
+
+def _validate(args):
+    return validate(*args)
+
+
+def read_records(filenames):
+    """Grading records stored one JSON object per line."""
+    for filename in filenames:
+        with open(filename, "r") as infile:
+            for line in infile:
+                if line.strip():
+                    yield json.loads(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("records", nargs="+", help="files with one grading record per line")
+    parser.add_argument("--start", help="first level of every game", type=int)
+    parser.add_argument("--processes", help="worker processes", type=int)
+    parser.add_argument("--json", help="write every result to this file, one per line")
+    args = parser.parse_args()
+
+    total = invalid = mismatched = 0
+    output = open(args.json, "w") if args.json else None
+    for result in validate_all(read_records(args.records), args.start, args.processes):
+        total += 1
+        if result["invalid"] is not None:
+            invalid += 1
+            print(f"{result['player']}: invalid at {result['invalid']}, {result['reason']}")
+        elif result["mismatch"]:
+            mismatched += 1
+            print(f"{result['player']}: {', '.join(result['mismatch'])} differ, replayed {result['score']}")
+        if output:
+            output.write(json.dumps(result) + "\n")
+    if output:
+        output.close()
+
+    print(f"{total} records, {invalid} invalid, {mismatched} with a different score")
+    sys.exit(1 if invalid or mismatched else 0)
@@ -3,18 +3,19 @@ import argparse
 import asyncio
 import json
 import logging
-import os.path
+import multiprocessing
 import random
-from collections import namedtuple
+from collections import deque, namedtuple
 from functools import reduce
 from operator import add
 
-import requests
-from requests import RequestException
 import websockets
 
-from consts import MAX_HIGHSCORES, GameStatus
-from game import Game, reduce_score, TIMEOUT
+from broadcast import Broadcaster, Subscriber, POLICIES, DROP_OLDEST
+from consts import GameStatus
+from game import Game, reduce_score, GAME_SPEED, TIMEOUT
+from persistence import GradingUploader, ScoreLog
+from protocol import Frame, KEYFRAME_INTERVAL, negotiate
 
 logging.basicConfig(
     level=logging.DEBUG, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
@@ -25,54 +26,187 @@ wslogger.setLevel(logging.WARN)
 logger = logging.getLogger("Server")
 logger.setLevel(logging.INFO)
 
-Player = namedtuple("Player", ["name", "ws"])
-
-HIGHSCORE_FILE = "highscores.json"
+Player = namedtuple("Player", ["name", "ws", "protocol"])
+
+
+class Session:
+    """A game played by one player, with its own tick task and viewers."""
+
+    def __init__(self, server, player, lockstep=False):
+        self.server = server
+        self.player = player
+        self.lockstep = lockstep
+        self.game = Game(server.level, server.timeout, player.name)
+        self.viewers = Broadcaster()
+        self.plan = deque()  # keys uploaded with the plan command
+        self.played = 0  # keys of the current plan already played
+        self._playerkey = False
+        self._keypressed = asyncio.Event()
+
+    def keypress(self, key):
+        """Forward a key from the player to the game."""
+        self.game.keypress(key)
+        self._playerkey = self._playerkey or key != ""
+        self._keypressed.set()
+
+    def submit_plan(self, keys, append=False):
+        """Buffer keys to be played one per frame, replacing the current plan."""
+        if not append:
+            self.plan.clear()
+            self.played = 0
+        self.plan.extend(keys)
+        self._keypressed.set()
+
+    def plan_report(self):
+        """Message telling the player how far the plan got."""
+        report = {
+            "plan": {
+                "played": self.played,
+                "remaining": len(self.plan),
+                "level": self.game.level,
+                "step": self.game.step,
+            }
+        }
+        return json.dumps(report)
+
+    def disconnected(self):
+        """Player is gone, don't leave a lockstep game waiting."""
+        self._keypressed.set()
+
+    async def send_info(self, game_info, highscores=False, protocol=None):
+        """Send game info to viewer and player (announcing the protocol to the player)."""
+        if highscores:
+            game_info["highscores"] = self.server.scores.highscores
+            game_info["player"] = self.player.name
+
+        message = json.dumps(game_info)
+        self.viewers.publish(message, keyframe=True)
+        if protocol:
+            message = json.dumps(dict(game_info, protocol=protocol))
+        await self.player.ws.send(message)
+
+    async def run(self):
+        """Run the game until it is over or the player leaves."""
+        player = self.player
+        try:
+            logger.info("Starting game for <%s>", player.name)
+
+            game_info = self.game.info()
+            await self.send_info(game_info, protocol=player.protocol)
+
+            if self.server.grading:
+                game_record = dict()
+                game_record["player"] = player.name
+                game_record["papertrail"] = self.game.papertrail
+
+            keyframe = True  # the stream always starts with a full state
+            while self.game.running:
+                if self.lockstep:
+                    # advance as soon as the player answers the last update,
+                    # or right away while there is an uploaded plan to play
+                    if not self.plan:
+                        await self._keypressed.wait()
+                    self._keypressed.clear()
+                    await asyncio.sleep(0)  # let the other sessions run
+                else:
+                    await asyncio.sleep(1.0 / GAME_SPEED)
+
+                planned = bool(self.plan) and not self._playerkey
+                if planned:
+                    self.game.keypress(self.plan.popleft())
+                    self.played += 1
+                self._playerkey = False
+                game_status = await self.game.next_frame(wait=False)
+
+                report = None
+                if (game_status == GameStatus.NEW_MAP and (self.plan or self.played)) or (
+                    planned and not self.plan
+                ):
+                    # a plan never carries over levels; the buffer is reset before
+                    # yielding, so a plan already sent for the next level isn't lost
+                    report = self.plan_report()
+                    self.plan.clear()
+                    self.played = 0
+
+                if game_status == GameStatus.NEW_MAP:
+                    game_info = self.game.info()
+                    await self.send_info(game_info)
+
+                frame = Frame(
+                    self.game,
+                    keyframe
+                    or game_status == GameStatus.NEW_MAP
+                    or self.game.step % KEYFRAME_INTERVAL == 0,
+                )
+                keyframe = False
+                self.viewers.publish_frame(frame)
+                await player.ws.send(frame.encode(player.protocol))
+
+                if report:
+                    await player.ws.send(report)
+            self.server.save_highscores(player.name, self.game.score)
+
+            game_info = self.game.info()
+            game_info["score"] = self.game.score
+            await self.send_info(game_info, highscores=True)
+
+            logger.info("Disconnecting <%s>", player.name)
+        except websockets.exceptions.ConnectionClosed:
+            player = None
+        finally:
+            if self.server.grading:
+                game_record["puzzles"], game_record["total_moves"], game_record["total_pushes"], game_record["total_steps"], game_record["box_on_goal"] = self.game.score
+                game_record["papertrail"] = self.game.papertrail
+                game_record["level"] = self.game.level
+                self.server.grading.submit(game_record)
+
+            if player:
+                await player.ws.close()
 
 
 class GameServer:
-    """Network Game Server."""
-
-    def __init__(self, level, timeout, grading=None):
+    """Network Game Server, running many game sessions concurrently."""
+
+    def __init__(
+        self,
+        level,
+        timeout,
+        grading=None,
+        lockstep=False,
+        max_sessions=8,
+        viewer_queue=32,
+        viewer_policy=DROP_OLDEST,
+    ):
         self.game = Game(level, timeout)
         self.players = asyncio.Queue()
-        self.viewers = set()
-        self.current_player = None
-        self.grading = grading
-        self._level = level
-        self._timeout = timeout
-
-        self._highscores = []
-        if os.path.isfile(HIGHSCORE_FILE):
-            with open(HIGHSCORE_FILE, "r") as infile:
-                self._highscores = json.load(infile)
-
-    def save_highscores(self, score):
-        """Update highscores, storing to file."""
+        self.sessions = {}  # player websocket -> Session
+        self.viewers = {}  # viewer websocket -> Subscriber
+        self.grading = GradingUploader(grading) if grading else None
+        self.lockstep = lockstep
+        self.max_sessions = max_sessions
+        self.viewer_queue = viewer_queue
+        self.viewer_policy = viewer_policy
+        self.level = level
+        self.timeout = timeout
+
+        self.scores = ScoreLog()
+
+    def save_highscores(self, name, score):
+        """Update highscores, stored to file in the background."""
         logger.debug("Save highscores")
         logger.info(
             "FINAL SCORE <%s>: %s puzzles with %s moves and %s pushes in %s steps, currently %s boxes on goal",
-            self.current_player.name,
+            name,
             *score,
         )
 
-        self._highscores.append((self.current_player.name, reduce_score(*score),))
-        self._highscores = sorted(self._highscores, key=lambda s: s[1])[:MAX_HIGHSCORES]
-
-        with open(HIGHSCORE_FILE, "w") as outfile:
-            json.dump(self._highscores, outfile)
+        self.scores.record(name, reduce_score(*score))
 
-    async def send_info(self, game_info, highscores=False):
-        """Send game info to viewer and player."""
-        if highscores:
-            game_info["highscores"] = self._highscores
-            game_info["player"] = self.current_player.name
-
-        if self.viewers:
-            await asyncio.wait(
-                [client.send(json.dumps(game_info)) for client in self.viewers]
-            )
-        await self.current_player.ws.send(json.dumps(game_info))
+    def watch(self, subscriber, session):
+        """Move a viewer to the given session."""
+        for other in self.sessions.values():
+            other.viewers.discard(subscriber)
+        session.viewers.add(subscriber)
 
     async def incomming_handler(self, websocket, path):
         """Process new clients arriving at the server."""
@@ -82,83 +216,111 @@ class GameServer:
                 if data["cmd"] == "join":
                     if path == "/player":
                         logger.info("<%s> has joined", data["name"])
-                        await self.players.put(Player(data["name"], websocket))
+                        await self.players.put(
+                            Player(data["name"], websocket, negotiate(data))
+                        )
 
                     if path == "/viewer":
                         logger.info("Viewer connected")
-                        self.viewers.add(websocket)
+                        subscriber = Subscriber(
+                            websocket,
+                            data.get("player"),
+                            self.viewer_queue,
+                            self.viewer_policy,
+                            negotiate(data),
+                        )
+                        self.viewers[websocket] = subscriber
                         game_info = self.game.info()
-                        await websocket.send(json.dumps(game_info))
-
-                if data["cmd"] == "key" and self.current_player.ws == websocket:
-                    logger.debug((self.current_player.name, data))
+                        for session in reversed(list(self.sessions.values())):
+                            if subscriber.player in (None, session.player.name):
+                                self.watch(subscriber, session)
+                                game_info = session.game.info()
+                                break
+                        game_info["protocol"] = subscriber.protocol
+                        subscriber.offer(json.dumps(game_info), keyframe=True)
+
+                session = self.sessions.get(websocket)
+                if data["cmd"] == "key" and session:
+                    logger.debug((session.player.name, data))
                     if len(data["key"]) > 0:
-                        self.game.keypress(data["key"][0])
+                        session.keypress(data["key"][0])
                     else:
-                        self.game.keypress("")
+                        session.keypress("")
+
+                if data["cmd"] == "plan" and session:
+                    logger.debug("<%s> sent a plan of %s keys", session.player.name, len(data["keys"]))
+                    session.submit_plan(data["keys"], data.get("append", False))
 
         except websockets.exceptions.ConnectionClosed as closed_reason:
             logger.info("Client disconnected: %s", closed_reason)
+        finally:
             if websocket in self.viewers:
-                self.viewers.remove(websocket)
+                subscriber = self.viewers.pop(websocket)
+                subscriber.close()
+                for session in self.sessions.values():
+                    session.viewers.discard(subscriber)
+            if websocket in self.sessions:
+                self.sessions[websocket].disconnected()
+
+    async def play(self, session, slot):
+        """Run a session, freeing its slot when it is over."""
+        try:
+            await session.run()
+        finally:
+            del self.sessions[session.player.ws]
+            slot.release()
 
     async def mainloop(self):
-        """Main loop, runing the Game."""
+        """Main loop, starting a Session for each player up to max_sessions."""
+        asyncio.ensure_future(self.scores.run())
+        if self.grading:
+            asyncio.ensure_future(self.grading.run())
+
+        slots = asyncio.Semaphore(self.max_sessions)
         while True:
             logger.info("Waiting for player")
-            self.current_player = await self.players.get()
+            player = await self.players.get()
 
-            if self.current_player.ws.closed:
-                logger.error("<%s> disconnect while waiting", self.current_player.name)
+            if player.ws.closed:
+                logger.error("<%s> disconnect while waiting", player.name)
                 continue
 
-            try:
-                logger.info("Starting game for <%s>", self.current_player.name)
-                self.game = Game(self._level, self._timeout, self.current_player.name)
-
-                game_info = self.game.info()
-                await self.send_info(game_info)
+            await slots.acquire()
+            if player.ws.closed:
+                logger.error("<%s> disconnect while waiting", player.name)
+                slots.release()
+                continue
 
-                if self.grading:
-                    game_record = dict()
-                    game_record["player"] = self.current_player.name
-                    game_record["papertrail"] = self.game.papertrail
+            session = Session(self, player, self.lockstep)
+            self.sessions[player.ws] = session
+            for subscriber in self.viewers.values():
+                if subscriber.player in (None, player.name):
+                    self.watch(subscriber, session)
+            asyncio.ensure_future(self.play(session, slots))
+
+
+def serve(args):
+    """Run a GameServer on the current process event loop."""
+    g = GameServer(
+        args.level,
+        args.timeout,
+        args.grading_server,
+        args.lockstep,
+        args.max_sessions,
+        args.viewer_queue,
+        args.viewer_policy,
+    )
 
-                while self.game.running:
-                    game_status = await self.game.next_frame()
+    game_loop_task = asyncio.ensure_future(g.mainloop())
 
-                    if game_status == GameStatus.NEW_MAP:
-                        game_info = self.game.info()
-                        await self.send_info(game_info)
+    logger.info("Listenning @ %s:%s", args.bind, args.port)
+    websocket_server = websockets.serve(
+        g.incomming_handler, args.bind, args.port, reuse_port=args.workers > 1
+    )
 
-                    state = self.game.state
-                    await self.current_player.ws.send(state)
-                    if self.viewers:
-                        await asyncio.wait(
-                            [client.send(state) for client in self.viewers]
-                        )
-                self.save_highscores(self.game.score)
-
-                game_info = self.game.info()
-                game_info["score"] = self.game.score
-                await self.send_info(game_info, highscores=True)
-
-                logger.info("Disconnecting <%s>", self.current_player.name)
-            except websockets.exceptions.ConnectionClosed:
-                self.current_player = None
-            finally:
-                try:
-                    if self.grading:
-                        game_record["puzzles"], game_record["total_moves"], game_record["total_pushes"], game_record["total_steps"], game_record["box_on_goal"] = self.game.score
-                        game_record["papertrail"] = self.game.papertrail
-                        game_record["level"] = self.game.level
-                        requests.post(self.grading, json=game_record)
-                except RequestException as err:
-                    logger.error(err)
-                    logger.warning("Could not save score to server")
-
-                if self.current_player:
-                    await self.current_player.ws.close()
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(asyncio.gather(websocket_server, game_loop_task))
+    loop.close()
 
 
 if __name__ == "__main__":
@@ -175,18 +337,40 @@ if __name__ == "__main__":
         help="url of grading server",
         default="http://bomberman-aulas.ws.atnog.av.it.pt/game",
     )
+    parser.add_argument(
+        "--max-sessions", help="games played at the same time", type=int, default=8
+    )
+    parser.add_argument(
+        "--workers", help="processes sharing the port", type=int, default=1
+    )
+    parser.add_argument(
+        "--viewer-queue", help="frames queued per viewer", type=int, default=32
+    )
+    parser.add_argument(
+        "--viewer-policy",
+        help="what to drop when a viewer falls behind",
+        choices=POLICIES,
+        default=DROP_OLDEST,
+    )
+    parser.add_argument(
+        "--lockstep",
+        help="advance the game as soon as the player sends a key",
+        action="store_true",
+    )
     args = parser.parse_args()
 
     if args.seed > 0:
         random.seed(args.seed)
 
-    g = GameServer(args.level, args.timeout, args.grading_server)
-
-    game_loop_task = asyncio.ensure_future(g.mainloop())
-
-    logger.info("Listenning @ %s:%s", args.bind, args.port)
-    websocket_server = websockets.serve(g.incomming_handler, args.bind, args.port)
-
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(asyncio.gather(websocket_server, game_loop_task))
-    loop.close()
\ No newline at end of file
+    if args.workers > 1:
+        # shard sessions across processes sharing the port (SO_REUSEPORT)
+        workers = [
+            multiprocessing.Process(target=serve, args=(args,))
+            for _ in range(args.workers)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    else:
+        serve(args)
@@ -1,8 +1,11 @@
-from tree_search import SearchDomain, SearchProblem, SearchTree
+from tree_search import SearchDomain
+from pattern_database import PatternDatabase
 
 from mapa import Map
 from consts import Tiles, TILES
-import copy
+from array import array
+from collections import OrderedDict
+import random
 
 def directions():
     return list("wasd")
@@ -34,95 +37,272 @@ def prior_pos(pos, action):
     elif action == "d":
         return cx - 1, cy
 
-def manhattan_distance(pos1, pos2):
-    return abs(pos1[0] - pos2[0]) + abs(pos1[1] - pos2[1])
+class LRUCache:
+    '''
+    Bounded mapping that drops the least recently used entry when full
+    '''
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is not None:
+            self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
 
 class BoxDomain(SearchDomain):
-    def __init__(self, filename):
+    def __init__(self, filename, regions_cache=4096, paths_cache=512, pattern_size=0, pattern_workers=1,
+                 matchings_cache=16384, frozen_cache=256, matching_deadlocks=True, rests_cache=65536):
         self.count = 0
+        self.matching_deadlocks = matching_deadlocks
 
         self.level = filename
         mapa = Map(filename)
-
-        for box in mapa.boxes:
-            mapa.clear_tile(box)
-        mapa.clear_tile(mapa.keeper)
-
-        self.walls = mapa.filter_tiles([Tiles.WALL])
-        self.goals = mapa.empty_goals
-        self.floor = mapa.filter_tiles([Tiles.FLOOR])
         self.size  = mapa.size
-       
-        self.distanceToGoal = dict()
-        for goal in self.goals:
-            tmp = dict()
-            self.distanceToGoal[goal] = tmp
-            for pos in (self.floor + self.goals):
-                tmp[pos] = float('inf')
-
-        queue = []
-        for goal in self.goals:
-            self.distanceToGoal[goal][goal] = 0
-            queue[:0] = (goal),
-            while queue != []:
-                pos = queue.pop()
+        self.width = mapa.size[0]
+        ncells     = self.width * mapa.size[1]
+        self.celltype = 'H' if ncells <= 1 << 16 else 'L'
+
+        # grelha plana carregada uma unica vez: celula = y * largura + x
+        self.wallmask = bytearray(ncells)
+        self.goalmask = bytearray(ncells)
+        self.walls = []
+        self.goals = []
+        self.floor = []
+        for y in range(mapa.size[1]):
+            for x in range(self.width):
+                tile = mapa.get_tile((x, y))
+                if tile == Tiles.WALL:
+                    self.wallmask[y * self.width + x] = 1
+                    self.walls.append((x, y))
+                elif tile & Tiles.GOAL:
+                    self.goalmask[y * self.width + x] = 1
+                    self.goals.append((x, y))
+                else:
+                    self.floor.append((x, y))
+
+        self.build_tables()
+
+        # caches indexadas pela chave das caixas: zonas alcancaveis pelo keeper,
+        # arvores de caminhos do keeper a partir de uma celula e emparelhamentos
+        # das caixas com os objetivos
+        self.regions   = LRUCache(regions_cache)
+        self.paths     = LRUCache(paths_cache)
+        self.matchings = LRUCache(matchings_cache)
+
+        # distancias recalculadas com as caixas fixas em objetivos como paredes,
+        # indexadas pelo conjunto dessas caixas
+        self.frozen_rows = LRUCache(frozen_cache)
+
+        # grupos de caixas com ganho na base de dados de padroes, indexados pela
+        # chave das caixas menos uma (ver PatternDatabase.estimate)
+        self.pattern_rests = LRUCache(rests_cache)
+
+        # chaves de Zobrist: uma por (celula, caixa) e uma por zona do keeper,
+        # identificada pela menor celula alcancavel
+        zobrist = random.Random(0)
+        self.zobrist_box    = [zobrist.getrandbits(64) for _ in range(ncells)]
+        self.zobrist_keeper = [zobrist.getrandbits(64) for _ in range(ncells)]
+
+        # base de dados de padroes de pattern_size caixas (0 para nao usar)
+        self.patterns = PatternDatabase(self, pattern_size, pattern_workers) if pattern_size else None
+
+    def build_tables(self):
+        '''
+        computes the tables derived from the walls and the goals: pulls, push
+        distances to the goals, dead cells, areas, keeper neighbours and the
+        goals reachable from each cell
+        '''
+        ncells = len(self.wallmask)
+
+        # transicoes de "puxar" uma caixa: para cada celula, as celulas de onde
+        # uma caixa pode ser empurrada para ela e onde fica o keeper (fora de paredes)
+        self.pulls = [[] for _ in range(ncells)]
+        for y in range(self.size[1]):
+            for x in range(self.width):
                 for dir in directions():
-                    boxpos = new_pos(pos, dir)
+                    boxpos = new_pos((x, y), dir)
                     playerpos = new_pos(boxpos, dir)
-                    if(not mapa.is_blocked(boxpos) and not mapa.is_blocked(playerpos)):
-                        goaldict = self.distanceToGoal[goal]
-                        if goaldict[boxpos] == float('inf'):
-                            goaldict[boxpos] = goaldict[pos] + 1
-                            queue[:0] = (boxpos),
-
-        self.simpledeadlocks = []
-        positions = dict()
+                    if inside_range(boxpos, self.size) and inside_range(playerpos, self.size) and (
+                        not self.wallmask[self.cell(boxpos)] and not self.wallmask[self.cell(playerpos)]):
+                        self.pulls[y * self.width + x].append((self.cell(boxpos), self.cell(playerpos)))
+
+        # distancias (em empurroes) de cada celula a cada objetivo: matriz objetivos x celulas,
+        # calculada por fronteiras para todos os objetivos em simultaneo
+        self.distanceToGoal = [array('d', [float('inf')]) * ncells for goal in self.goals]
+        frontiers = []
+        for goal, row in zip(self.goals, self.distanceToGoal):
+            row[self.cell(goal)] = 0
+            frontiers.append([self.cell(goal)])
+        depth = 0
+        while any(frontiers):
+            depth += 1
+            for idx, row in enumerate(self.distanceToGoal):
+                frontier = []
+                for cell in frontiers[idx]:
+                    for boxcell, _ in self.pulls[cell]:
+                        if row[boxcell] == float('inf'):
+                            row[boxcell] = depth
+                            frontier.append(boxcell)
+                frontiers[idx] = frontier
+
+        # celulas de onde nenhuma caixa chega a um objetivo
+        self.deadmask = bytearray(ncells)
         for pos in self.floor:
-            positions[pos] = True
-        for goal in self.distanceToGoal:
-            dicio = self.distanceToGoal[goal]
-            for pos in dicio:
-                if dicio[pos] != float('inf'):
-                    positions[pos] = False
-
-        for pos in positions:
-            if positions[pos]:
-                self.simpledeadlocks.append(pos)
-
-        reachablegoals = dict()
-        self.areas = dict()
-
+            cell = self.cell(pos)
+            if all(row[cell] == float('inf') for row in self.distanceToGoal):
+                self.deadmask[cell] = 1
+
+        # areas: celulas livres agrupadas pelo conjunto de objetivos alcancaveis
+        self.area = array('l', [-1]) * ncells
+        self.areasizes = []
+        areaids = dict()
         for pos in self.floor:
-            if pos not in self.simpledeadlocks:
-                reachablegoals[pos] = []
-        
-        for pos in reachablegoals:
-            for goal in self.goals:
-                if self.distanceToGoal[goal][pos] != float('inf'):
-                    (reachablegoals[pos]).append(goal)
-            goals = frozenset(reachablegoals[pos])
-            reachablegoals[pos] = goals
-            if goals not in self.areas:
-                self.areas[goals] =  [pos]
-            else:
-                self.areas[goals] += [pos]
+            cell = self.cell(pos)
+            if self.deadmask[cell]:
+                continue
+            goals = frozenset(idx for idx, row in enumerate(self.distanceToGoal) if row[cell] != float('inf'))
+            if goals not in areaids:
+                areaids[goals] = len(self.areasizes)
+                self.areasizes.append(0)
+            self.area[cell] = areaids[goals]
+            self.areasizes[areaids[goals]] += 1
+
+        # vizinhos livres de cada celula (direcao, celula), para os caminhos do keeper
+        self.neighbours = [[(dir, self.cell(new_pos((x, y), dir))) for dir in directions()
+                            if inside_range(new_pos((x, y), dir), self.size) and not self.wallmask[self.cell(new_pos((x, y), dir))]]
+                           for y in range(self.size[1]) for x in range(self.width)]
+
+        # objetivos alcancaveis por empurroes a partir de cada celula, do mais proximo ao mais longe
+        self.reachable_goals = [sorted([goal for goal, row in enumerate(self.distanceToGoal) if row[cell] != float('inf')],
+                                       key=lambda goal: self.distanceToGoal[goal][cell]) for cell in range(ncells)]
+
+    # as caches nao seguem o dominio quando e serializado (processos, snapshots)
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['regions']   = LRUCache(self.regions.maxsize)
+        state['paths']     = LRUCache(self.paths.maxsize)
+        state['matchings'] = LRUCache(self.matchings.maxsize)
+        state['frozen_rows'] = LRUCache(self.frozen_rows.maxsize)
+        state['pattern_rests'] = LRUCache(self.pattern_rests.maxsize)
+        return state
+
+    def cell(self, pos):
+        return pos[1] * self.width + pos[0]
+
+    def blocked_cells(self, boxes):
+        blocked = bytearray(self.wallmask)
+        for box in boxes:
+            blocked[self.cell(box)] = 1
+        return blocked
 
-        self.visitedkeepers = {}
+    def reachability(self, state):
+        '''
+        @param state, the state whose boxes define the obstacles
+        returns, for every cell, the smallest cell reachable from it (-1 for walls
+        and boxes), so two cells are in the same keeper region iff their labels match;
+        the labels are cached by the Zobrist key of the boxes
+        '''
+        key = self.boxes_key(state)
+        labels = self.regions.get(key)
+        if labels is None:
+            blocked = self.blocked_cells(state[1])
+            labels = array('i', [-1]) * len(blocked)
+            for start in range(len(blocked)):
+                if blocked[start]:
+                    continue
+                blocked[start] = 1
+                frontier = [start]
+                while frontier:
+                    cell = frontier.pop()
+                    labels[cell] = start
+                    for _, neighbour in self.neighbours[cell]:
+                        if not blocked[neighbour]:
+                            blocked[neighbour] = 1
+                            frontier.append(neighbour)
+            self.regions.put(key, labels)
+        return labels
+
+    def keeper_region(self, state):
+        '''
+        @param state, a state [keeper, boxes, ...]
+        returns the smallest cell the keeper can walk to, which identifies
+        the region of the map the keeper is in
+        '''
+        return self.reachability(state)[self.cell(state[0])]
+
+    def walking_tree(self, state):
+        '''
+        @param state, the state whose keeper starts walking
+        returns the breadth-first tree of keeper moves from the keeper position,
+        as (parent cell, move) per cell, cached by box key and keeper cell
+        '''
+        key = (self.boxes_key(state), self.cell(state[0]))
+        tree = self.paths.get(key)
+        if tree is None:
+            blocked = self.blocked_cells(state[1])
+            parents = array('i', [-1]) * len(blocked)
+            moves = [None] * len(blocked)
+            start = key[1]
+            blocked[start] = 1
+            parents[start] = start
+            frontier = [start]
+            while frontier:
+                nextfrontier = []
+                for cell in frontier:
+                    for dir, neighbour in self.neighbours[cell]:
+                        if not blocked[neighbour]:
+                            blocked[neighbour] = 1
+                            parents[neighbour] = cell
+                            moves[neighbour] = dir
+                            nextfrontier.append(neighbour)
+                frontier = nextfrontier
+            tree = (parents, moves)
+            self.paths.put(key, tree)
+        return tree
+
+    def boxes_key(self, state):
+        '''
+        @param state, a state [keeper, boxes] or [keeper, boxes, boxes key]
+        returns the Zobrist key of the boxes, carried by the states built in result
+        '''
+        if len(state) > 2:
+            return state[2]
+        key = 0
+        for box in state[1]:
+            key ^= self.zobrist_box[self.cell(box)]
+        return key
 
-    def is_movable(self, boxes, walls, box, direction):
+    def is_movable(self, boxes, frozen, box, direction):
         '''
         @param boxes, the boxes that define a state, including the box that will move
-        @param walls, the walls of a specified state
+        @param frozen, boxes treated as extra walls, besides the walls of the map
         @param box, the box that will move
         @param direction, the direction in which the box will move
         Function who analyses if a box is movable in a certain direction
         The function returns True if it can be moved, False otherwise
         '''
-        obstacles  = self.get_other_boxes(boxes, box) + walls
         newbox = new_pos(box, direction)
-        return inside_range(newbox, self.size) and (
-            newbox not in obstacles + self.simpledeadlocks) and (
-            prior_pos(box, direction) not in obstacles)
+        prior  = prior_pos(box, direction)
+        if not inside_range(newbox, self.size):
+            return False
+        newcell = self.cell(newbox)
+        if self.wallmask[newcell] or self.deadmask[newcell]:
+            return False
+        if inside_range(prior, self.size) and self.wallmask[self.cell(prior)]:
+            return False
+        return newbox not in boxes and prior not in boxes and (
+            newbox not in frozen) and prior not in frozen
 
     def keeper_plan(self, boxes, initial, goal):
         '''
@@ -133,15 +313,29 @@ class BoxDomain(SearchDomain):
         return the keeper plan(the movements he does to reach the goal),
         which also means the goal is reachable from that certain state, or None otherwise
         '''
-        domain  = KeeperDomain(boxes + self.walls, self.size)
-        problem = SearchProblem(domain, initial, goal)
-        tree    = SearchTree(problem, "greedy")
-        if tree.search():
-            return tree.plan
-        return None
+        if not inside_range(goal, self.size):
+            return None
+        return self.walk(self.walking_tree([initial, boxes]), goal)
 
-    def freeze_deadlock_detection(self, boxes, walls, box):
-        if len([dir for dir in directions() if self.is_movable(boxes, walls, box, dir)]) == 0:
+    def walk(self, tree, goal):
+        '''
+        @param tree, a keeper walking tree built by walking_tree
+        @param goal, the keeper goal position
+        returns the moves from the root of the tree to the goal, or None if unreachable
+        '''
+        parents, moves = tree
+        cell = self.cell(goal)
+        if parents[cell] == -1:
+            return None
+        plan = []
+        while parents[cell] != cell:
+            plan.append(moves[cell])
+            cell = parents[cell]
+        plan.reverse()
+        return plan
+
+    def freeze_deadlock_detection(self, boxes, frozen, box):
+        if len([dir for dir in directions() if self.is_movable(boxes, frozen, box, dir)]) == 0:
             countbox      = 0
             countdeadlock = 0
             for dir in directions():
@@ -149,19 +343,161 @@ class BoxDomain(SearchDomain):
                 if(newbox in boxes):
                     countbox += 1
                     newboxes = self.get_other_boxes(boxes, box)
-                    newwalls = walls + [box]
-                    if self.freeze_deadlock_detection(newboxes, newwalls, newbox):
+                    newfrozen = frozen + [box]
+                    if self.freeze_deadlock_detection(newboxes, newfrozen, newbox):
                         countdeadlock += 1
             if(countbox == countdeadlock):
                 return True
         return False
 
     def areadeadlock_detection(self, boxes):
-        for area in self.areas:
-            if sum([1 for box in boxes if box in self.areas[area]]) > len(self.areas[area]):
-                return True
+        counts = [0] * len(self.areasizes)
+        for box in boxes:
+            area = self.area[self.cell(box)]
+            if area != -1:
+                counts[area] += 1
+                if counts[area] > self.areasizes[area]:
+                    return True
         return False
+
+    def frozen_goals(self, boxes):
+        '''
+        @param boxes, the boxes that define a state
+        returns the frozenset of the cells of the boxes on goals that can never move
+        again: blocked on both axes by walls or by other such boxes (greatest fixpoint,
+        starting from every box on a goal)
+        '''
+        frozen = set(cell for cell in (self.cell(box) for box in boxes) if self.goalmask[cell])
+        changed = True
+        while changed and frozen:
+            changed = False
+            for cell in list(frozen):
+                free = set(dir for dir, neighbour in self.neighbours[cell] if neighbour not in frozen)
+                if ('a' in free and 'd' in free) or ('w' in free and 's' in free):
+                    frozen.discard(cell)
+                    changed = True
+        return frozenset(frozen)
+
+    def frozen_distances(self, frozen):
+        '''
+        @param frozen, the cells of the boxes fixed on goals, as given by frozen_goals
+        returns (rows, deadmask): the distances to the goals left free with the frozen
+        boxes treated as walls (one row per goal, the rows of the frozen goals are not
+        used) and the cells from where no box reaches those goals; only the rows whose
+        pulls went through a frozen cell are recomputed, cached by the frozen set
+        '''
+        if not frozen:
+            return self.distanceToGoal, self.deadmask
+        cached = self.frozen_rows.get(frozen)
+        if cached is not None:
+            return cached
+
+        blocked = bytearray(self.wallmask)
+        for cell in frozen:
+            blocked[cell] = 1
+
+        rows = []
+        for goal, row in zip(self.goals, self.distanceToGoal):
+            start = self.cell(goal)
+            # a linha so muda se uma caixa fixa estava no caminho de uma caixa ou do keeper
+            if start in frozen or not any(row[cell] != float('inf') or
+                                          any(row[neighbour] != float('inf') for _, neighbour in self.neighbours[cell])
+                                          for cell in frozen):
+                rows.append(row)
+                continue
+            row = array('d', [float('inf')]) * len(blocked)
+            row[start] = 0
+            frontier = [start]
+            depth = 0
+            while frontier:
+                depth += 1
+                newfrontier = []
+                for cell in frontier:
+                    for boxcell, playercell in self.pulls[cell]:
+                        if row[boxcell] == float('inf') and not blocked[boxcell] and not blocked[playercell]:
+                            row[boxcell] = depth
+                            newfrontier.append(boxcell)
+                frontier = newfrontier
+            rows.append(row)
+
+        live = [row for goal, row in zip(self.goals, rows) if self.cell(goal) not in frozen]
+        deadmask = bytearray(self.deadmask)
+        for pos in self.floor:
+            cell = self.cell(pos)
+            if not blocked[cell] and all(row[cell] == float('inf') for row in live):
+                deadmask[cell] = 1
+        self.frozen_rows.put(frozen, (rows, deadmask))
+        return rows, deadmask
                                 
+    def augment(self, cell, matched, owners, visited):
+        '''
+        @param cell, the cell of an unmatched box
+        @param matched, the goal matched to each box cell
+        @param owners, the box cell matched to each goal (-1 if free)
+        @param visited, goals already tried in this search
+        looks for an augmenting path from the box, updating the matching;
+        returns True if the box was matched
+        '''
+        for goal in self.reachable_goals[cell]:
+            if goal in visited:
+                continue
+            visited.add(goal)
+            if owners[goal] == -1 or self.augment(owners[goal], matched, owners, visited):
+                owners[goal] = cell
+                matched[cell] = goal
+                return True
+        return False
+
+    def matching(self, state):
+        '''
+        @param state, a state [keeper, boxes, ...]
+        returns a perfect matching (goal per box cell, box cell per goal) of the
+        boxes with goals they can be pushed to, or None if there is none;
+        cached by the Zobrist key of the boxes
+        '''
+        key = self.boxes_key(state)
+        result = self.matchings.get(key)
+        if result is None:
+            matched, owners = dict(), [-1] * len(self.goals)
+            for box in state[1]:
+                if not self.augment(self.cell(box), matched, owners, set()):
+                    matched = None
+                    break
+            result = (matched, owners) if matched is not None else False
+            self.matchings.put(key, result)
+        return result or None
+
+    def matching_deadlock_detection(self, state, box, direction):
+        '''
+        @param state, the state before the push
+        @param box, the box that will move
+        @param direction, the direction the box will move
+        repairs the matching of the state after the push, with a single
+        augmenting path when the box loses its goal, and caches it for the
+        new state; returns True if the boxes can't all be matched to goals
+        '''
+        parent = self.matching(state)
+        if parent is None:
+            return True
+        oldcell = self.cell(box)
+        newcell = self.cell(new_pos(box, direction))
+        key = self.boxes_key(state) ^ self.zobrist_box[oldcell] ^ self.zobrist_box[newcell]
+        result = self.matchings.get(key)
+        if result is None:
+            matched, owners = dict(parent[0]), list(parent[1])
+            goal = matched.pop(oldcell)
+            owners[goal] = -1
+            if self.distanceToGoal[goal][newcell] != float('inf'):
+                matched[newcell] = goal
+                owners[goal] = newcell
+                result = (matched, owners)
+            elif self.augment(newcell, matched, owners, set()):
+                result = (matched, owners)
+            else:
+                result = False
+            self.matchings.put(key, result)
+        return not result
+
     def deadlock_detection(self, boxes, box, direction):
         '''
         @param boxes, the boxes that define a state, including the box that will move
@@ -177,31 +513,24 @@ class BoxDomain(SearchDomain):
 
         newbox = new_pos(box, direction)
         if not newbox in self.goals:
-            if self.freeze_deadlock_detection(newboxes, self.walls, newbox):
+            if self.freeze_deadlock_detection(newboxes, [], newbox):
                 return True
         return False
 
-    def visitable(self, state):
-        key = frozenset(state[1])
-        if key in self.visitedkeepers:
-            for visitedpos in self.visitedkeepers[key]:
-                plan = self.keeper_plan(state[1], state[0], visitedpos)
-                if not plan is None:
-                    return True
-        return False
-
     def allowed(self, state, box, dir):
-        if not self.is_movable(state[1], self.walls, box, dir):
+        if not self.is_movable(state[1], [], box, dir):
             return False
         if self.deadlock_detection(state[1], box, dir):
             return False
+        if self.matching_deadlocks and self.matching_deadlock_detection(state, box, dir):
+            return False
         return True
 
     def get_newboxes(self, boxes, box, direction):
         return self.get_other_boxes(boxes, box) + [new_pos(box, direction)]
 
     def get_other_boxes(self, boxes, box):
-        other_boxes = copy.deepcopy(boxes)
+        other_boxes = list(boxes)
         other_boxes.remove(box)
         return other_boxes
 
@@ -212,66 +541,81 @@ class BoxDomain(SearchDomain):
         '''
         return sorted(boxes, key=lambda pos: (pos[0], pos[1]))
 
-    def greedy_distance(self, boxes, infinite=100000000):
-        edges = sorted([((goal, box), self.distanceToGoal[goal][box]) 
-            for box in boxes for goal in self.goals], key=lambda p: p[1])
-        for idx in range(len(edges)):
-            edge = edges[idx]
-            if edge[1] == float('inf'):
-                edges[idx] = (edge[0], infinite)
-    
-        matches = []
+    def greedy_distance(self, boxes, infinite=100000000, rows=None, goals=None):
+        '''
+        @param boxes, the boxes to place on goals
+        @param rows, the distance rows, one per goal (distanceToGoal by default)
+        @param goals, the indexes of the goals to match (every goal by default)
+        returns the sum of the distances of a greedy matching of the boxes with the goals
+        '''
+        rows  = self.distanceToGoal if rows is None else rows
+        goals = range(len(rows)) if goals is None else goals
+        cells = [self.cell(box) for box in boxes]
+        edges = sorted([(goal, box, rows[goal][cell])
+            for box, cell in enumerate(cells) for goal in goals], key=lambda e: e[2])
+
+        total = 0
         matchedBoxes = set()
         matchedGoals = set()
-        for tmp in edges:
-            goal = tmp[0][0]
-            box = tmp[0][1]
+        for goal, box, distance in edges:
             if(not (goal in matchedGoals) and not(box in matchedBoxes)):
-                matches += [tmp]
+                total += infinite if distance == float('inf') else distance
                 matchedBoxes.add(box)
                 matchedGoals.add(goal)
 
-        for box in boxes:
+        for box, cell in enumerate(cells):
             if box not in matchedBoxes:
                 closestgoal = None
-                for goal in [goal for goal in self.goals if goal not in matchedGoals]:
-                    if (box in self.distanceToGoal[goal]) and (
-                        closestgoal is None or self.distanceToGoal[goal][box] < self.distanceToGoal[closestgoal][box]):
+                for goal in [goal for goal in goals if goal not in matchedGoals]:
+                    if closestgoal is None or rows[goal][cell] < rows[closestgoal][cell]:
                         closestgoal = goal
-                matches += [((closestgoal, box), self.distanceToGoal[closestgoal][box])]
+                if closestgoal is None:
+                    continue
+                total += rows[closestgoal][cell]
                 matchedBoxes.add(box)
                 matchedGoals.add(closestgoal)
 
-        return sum([idx[1] for idx in matches])
+        return total
 
 
     def actions(self,state):
-
-        if self.visitable(state):
-            return -1
-
-        if frozenset(state[1]) in self.visitedkeepers:
-            self.visitedkeepers[frozenset(state[1])].append(state[0])
-        else:
-            self.visitedkeepers[frozenset(state[1])] = [state[0]]
-
+        labels = self.reachability(state)
+        region = labels[self.cell(state[0])]
+        tree   = None
         actlist = []
+        # celulas mortas tendo em conta as caixas fixas em objetivos
+        _, deadmask = self.frozen_distances(self.frozen_goals(state[1]))
         for box in state[1]:
-            for direction in [dir for dir in directions() if self.allowed(state, box, dir)]:
-                plan = self.keeper_plan(state[1], state[0], prior_pos(box, direction))
-                if not plan is None:
+            for direction in [dir for dir in directions() if self.allowed(state, box, dir)
+                              and not deadmask[self.cell(new_pos(box, dir))]]:
+                prior = prior_pos(box, direction)
+                if inside_range(prior, self.size) and labels[self.cell(prior)] == region:
+                    if tree is None:
+                        tree = self.walking_tree(state)
+                    plan = self.walk(tree, prior)
                     actlist += [(box, plan + [direction])]
         return actlist
 
     def result(self, state, action):
         box, path = action
-        return [box, self.get_newboxes(state[1], box, path[-1])]
+        newbox = new_pos(box, path[-1])
+        return [box, self.get_newboxes(state[1], box, path[-1]),
+                self.boxes_key(state) ^ self.zobrist_box[self.cell(box)] ^ self.zobrist_box[self.cell(newbox)]]
 
     def cost(self, state, action):
         return len(action[1])
 
     def heuristic(self, state, goal):
-        return self.greedy_distance(state[1])
+        # as caixas fixas em objetivos ficam fora do emparelhamento, e as restantes
+        # usam as distancias em que essas caixas sao paredes
+        frozen = self.frozen_goals(state[1])
+        rows, _ = self.frozen_distances(frozen)
+        distance = self.greedy_distance([box for box in state[1] if self.cell(box) not in frozen], rows=rows,
+                                        goals=[idx for idx, goal in enumerate(self.goals) if self.cell(goal) not in frozen])
+        if self.patterns:
+            return max(distance, self.patterns.estimate([self.cell(box) for box in state[1]],
+                                                        rests=self.pattern_rests, key=self.boxes_key(state)))
+        return distance
 
     def equivalent(self,state1,state2):
         return (self.sorting(state1[1])==self.sorting(state2[1])) and state1[0] == state2[0]
@@ -279,46 +623,17 @@ class BoxDomain(SearchDomain):
     def satisfies(self, state, goal):
         return (self.sorting(state[1])==self.sorting(goal[1]))
 
+    # chave de Zobrist das caixas combinada com a da zona do keeper:
+    # estados com as mesmas caixas e o keeper na mesma zona sao equivalentes
     def hash(self, state):
-        return (str([state[0]]+self.sorting(state[1])))
-
-class KeeperDomain(SearchDomain):
-    def __init__(self, obstacles, size):
-        '''
-        @param obstacles: positions in the map in which you can not set the keeper because
-        it has either a wall or a box from a specific state.
-        @param size: tuple (x,y) with the vertical and horizontal size of the map
-        '''
-        self.size = size
-        self.obstacles = obstacles
+        return self.boxes_key(state) ^ self.zobrist_keeper[self.keeper_region(state)]
 
-    def is_movable(self, pos, direction):
-        '''
-        @param pos: the current keeper position
-        @param direction: the direction in which the keeper will move
-        checks if keeper can move in the specified direction
-        return True if it is possible, False otherwise
-        '''
-        newpos = new_pos(pos, direction)
-        return inside_range(newpos, self.size) and newpos not in self.obstacles
-
-    def actions(self,state):
-        return [dir for dir in directions() if self.is_movable(state, dir)]
+    # estado guardado como celulas: keeper seguido das caixas
+    def pack(self, state):
+        return array(self.celltype, [self.cell(state[0])] + [self.cell(box) for box in state[1]]).tobytes()
 
-    def result(self,state,action):
-        return new_pos(state, action)
-        
-    def cost(self, state, action):
-        return 1
-
-    def heuristic(self, state, goal):
-        return manhattan_distance(state, goal)
-
-    def equivalent(self,state1,state2):
-        return state1==state2
-
-    def satisfies(self, state, goal):
-        return self.equivalent(state, goal)
-
-    def hash(self, state):
-        return str(state)
\ No newline at end of file
+    def unpack(self, data):
+        cells = array(self.celltype)
+        cells.frombytes(data)
+        positions = [(cell % self.width, cell // self.width) for cell in cells]
+        return [positions[0], positions[1:]]
@@ -0,0 +1,321 @@
+# Module: solver
+#
+# Choice of the solver configuration of a level before the search starts:
+#    features        - cheap measures of a level (boxes, free cells, rooms
+#                      with goals, tunnels, dead squares, push distance)
+#    DifficultyModel - linear model of the log of the nodes expanded by
+#                      the default configuration, fitted by least squares
+#    SolverConfig    - strategy, heuristic, deadlock tests, workers and
+#                      memory budget of one search
+#    configure       - the configuration of the difficulty class of a level,
+#                      from CONFIGS or from the file written by autotune.py,
+#                      with workers for the nodes predicted and the cpus
+#    KnownStatesProblem - a SearchProblem that also ends at states from
+#                         where the rest of a plan is already known
+#    solve           - builds the domain and runs the configured search
+#
+# The model is calibrated from batch results, `python3 solver.py --calibrate
+# model.json levels/*.xsb`, which solves every level with the default
+# configuration over a process pool and fits the weights; without a model
+# file the weights below are used, fitted on the bundled levels solved
+# within a minute.
+
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import sys
+import time
+
+from consts import Tiles
+from external_search import ExternalSearch
+from hierarchy import Decomposition, HierarchicalSearch
+from mapa import Map
+from parallel_search import ParallelSearch
+from pattern_database import PatternDatabase
+from sokoban_domain import BoxDomain
+from tree_search import SearchProblem, SearchTree
+
+FEATURES = ['boxes', 'free', 'goal_rooms', 'tunnels', 'dead', 'distance', 'density']
+
+# pesos de log(1 + nos expandidos), pela ordem de FEATURES, com o termo independente no fim
+DEFAULT_WEIGHTS = [1.2171, -0.0206, -0.6819, 0.5143, -5.6021, 0.1074, -30.4864, 7.9896]
+
+# limites (nos expandidos previstos) das classes de dificuldade
+CLASSES = [('easy', 1000), ('medium', 5000), ('hard', None)]
+
+NODE_BYTES = 2000       # memoria estimada por no guardado (estado, no, visitados, caches)
+PARALLEL_NODES = 5000   # nos previstos por worker: abaixo disto o arranque dos processos pesa mais
+
+def features(mapa, domain):
+    '''
+    @param mapa, the parsed Map of the level
+    @param domain, the BoxDomain of the level
+    returns a dict with the measures in FEATURES: number of boxes, free cells
+    reachable by the keeper, rooms with goals, fraction of tunnel cells, fraction
+    of dead cells, mean push distance of the boxes to the goals and boxes per
+    free cell
+    '''
+    # celulas livres alcancaveis pelo keeper: o interior do nivel
+    start = domain.cell(mapa.keeper)
+    inside = {start}
+    frontier = [start]
+    while frontier:
+        cell = frontier.pop()
+        for _, neighbour in domain.neighbours[cell]:
+            if neighbour not in inside:
+                inside.add(neighbour)
+                frontier.append(neighbour)
+
+    decomposition = Decomposition(domain)
+    boxes = mapa.boxes
+    goal_rooms = set(decomposition.room_of[domain.cell(goal)] for goal in domain.goals)
+    return {
+        'boxes'     : len(boxes),
+        'free'      : len(inside),
+        'goal_rooms': len(goal_rooms),
+        'tunnels'   : sum(decomposition.tunnel[cell] for cell in inside) / len(inside),
+        'dead'      : sum(domain.deadmask[cell] for cell in inside) / len(inside),
+        'distance'  : domain.greedy_distance(boxes) / max(len(boxes), 1),
+        'density'   : len(boxes) / len(inside),
+    }
+
+# resolve o sistema a x = b por eliminacao de Gauss com pivot parcial
+def solve_linear(a, b):
+    n = len(b)
+    rows = [list(a[i]) + [b[i]] for i in range(n)]
+    for col in range(n):
+        pivot = max(range(col, n), key=lambda row: abs(rows[row][col]))
+        rows[col], rows[pivot] = rows[pivot], rows[col]
+        if rows[col][col] == 0:
+            continue
+        for row in range(n):
+            if row != col:
+                factor = rows[row][col] / rows[col][col]
+                rows[row] = [x - factor * y for x, y in zip(rows[row], rows[col])]
+    return [rows[i][n] / rows[i][i] if rows[i][i] else 0.0 for i in range(n)]
+
+class DifficultyModel:
+    '''
+    @param weights, the weights of the features and the bias, as in DEFAULT_WEIGHTS
+    '''
+    def __init__(self, weights=DEFAULT_WEIGHTS):
+        self.weights = list(weights)
+
+    @staticmethod
+    def vector(measures):
+        return [float(measures[name]) for name in FEATURES] + [1.0]
+
+    # nos expandidos previstos para a configuracao por omissao
+    def predict(self, measures):
+        value = sum(w * x for w, x in zip(self.weights, self.vector(measures)))
+        return math.expm1(min(max(value, 0.0), 50.0))
+
+    def classify(self, measures):
+        nodes = self.predict(measures)
+        for name, limit in CLASSES:
+            if limit is None or nodes < limit:
+                return name
+
+    @staticmethod
+    def fit(samples, ridge=1e-3):
+        '''
+        @param samples, a list of (features, expanded nodes) of solved levels
+        returns the DifficultyModel fitted by (ridge) least squares on log(1 + nodes)
+        '''
+        size = len(FEATURES) + 1
+        ata = [[0.0] * size for _ in range(size)]
+        atb = [0.0] * size
+        for measures, nodes in samples:
+            x = DifficultyModel.vector(measures)
+            y = math.log1p(nodes)
+            for i in range(size):
+                atb[i] += x[i] * y
+                for j in range(size):
+                    ata[i][j] += x[i] * x[j]
+        for i in range(size - 1):
+            ata[i][i] += ridge
+        return DifficultyModel(solve_linear(ata, atb))
+
+    def save(self, filename):
+        with open(filename, 'w') as outfile:
+            json.dump({'features': FEATURES, 'weights': self.weights}, outfile, indent=1)
+
+    @staticmethod
+    def load(filename):
+        with open(filename) as infile:
+            data = json.load(infile)
+        assert data['features'] == FEATURES, f"{filename} was fitted on other features"
+        return DifficultyModel(data['weights'])
+
+class SolverConfig:
+    '''
+    @param strategy, the SearchTree strategy
+    @param pattern_size, boxes per pattern of the PatternDatabase heuristic (0 for none)
+    @param matching, whether pushes are checked with the box-goal matching deadlock test
+    @param hierarchy, whether the level is solved in stages, room by room
+    @param workers, processes of a ParallelSearch (1 searches in this process)
+    @param memory, nodes kept in memory by an ExternalSearch (None searches in memory)
+    '''
+    def __init__(self, strategy='greedy', pattern_size=0, matching=True, hierarchy=False, workers=1, memory=None):
+        self.strategy     = strategy
+        self.pattern_size = pattern_size
+        self.matching     = matching
+        self.hierarchy    = hierarchy
+        self.workers      = workers
+        self.memory       = memory
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+    @staticmethod
+    def from_dict(data):
+        return SolverConfig(**data)
+
+    def __repr__(self):
+        return f"SolverConfig({', '.join(f'{name}={value!r}' for name, value in self.__dict__.items())})"
+
+# configuracoes de cada classe de dificuldade: os niveis dificeis sao resolvidos
+# por salas, o que nos niveis 'hard' incluidos resolve os mesmos que a pesquisa
+# global e mais depressa (a* nao resolve quase nenhum em 60s); sem base de dados
+# de padroes, que os estagios nao usam e que so atrasa a pesquisa global de recurso
+CONFIGS = {
+    'easy'  : SolverConfig(matching=False),
+    'medium': SolverConfig(pattern_size=3),
+    'hard'  : SolverConfig(hierarchy=True),
+}
+
+# Problema que tambem termina nos estados de onde ja se conhece o resto do plano
+class KnownStatesProblem(SearchProblem):
+    '''
+    @param known, the hashes (domain.hash) of the states where the search may stop
+    '''
+    def __init__(self, domain, initial, goal, known):
+        super().__init__(domain, initial, goal)
+        self.known = known
+
+    def goal_test(self, state):
+        return self.domain.hash(state) in self.known or super().goal_test(state)
+
+# nos que cabem na memoria fisica
+def memory_nodes():
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') // NODE_BYTES
+    except (ValueError, OSError, AttributeError):
+        return 1000000
+
+def load_configs(filename):
+    '''
+    @param filename, a file written by autotune.py
+    returns the SolverConfig of each difficulty class, the default one for the
+    classes missing from the file
+    '''
+    with open(filename) as infile:
+        data = json.load(infile)
+    configs = dict(CONFIGS)
+    for name, config in data['configs'].items():
+        configs[name] = SolverConfig.from_dict(config)
+    return configs
+
+def configure(mapa, domain, model=None, configs=CONFIGS, cpus=None):
+    '''
+    @param mapa, the parsed Map of the level
+    @param domain, the BoxDomain of the level
+    @param model, the DifficultyModel (the default weights if None)
+    @param configs, the SolverConfig of each difficulty class
+    @param cpus, processors the search may use (os.cpu_count() if None)
+    returns (difficulty class, predicted nodes, SolverConfig); levels whose
+    prediction doesn't fit in memory are searched on disk, without stages
+    (the global search a hierarchical one falls back to is kept in memory),
+    and the others get a worker per PARALLEL_NODES predicted nodes, up to cpus
+    '''
+    model = model or DifficultyModel()
+    measures = features(mapa, domain)
+    nodes = model.predict(measures)
+    difficulty = model.classify(measures)
+    config = SolverConfig.from_dict(configs[difficulty].to_dict())
+    budget = memory_nodes()
+    if nodes > budget:
+        config.hierarchy = False
+        config.memory = budget // 2
+    elif not config.memory:
+        cpus = cpus or os.cpu_count() or 1
+        config.workers = max(config.workers, min(cpus, int(nodes // PARALLEL_NODES)))
+    return difficulty, nodes, config
+
+def solve(filename, config=None, model=None, configs=CONFIGS, domain=None, initial=None, known=None, cpus=None):
+    '''
+    @param filename, the level file
+    @param config, the SolverConfig to use (chosen by configure if None)
+    @param model, the DifficultyModel used by configure
+    @param configs, the SolverConfig of each difficulty class used by configure
+    @param domain, the BoxDomain of the level, reused with its tables and caches (built if None)
+    @param initial, the state [keeper, boxes] to search from (the start of the level if None)
+    @param known, hashes of states from where the rest of a plan is known: the
+    search also ends there (see KnownStatesProblem)
+    @param cpus, processors the search may use, given to configure
+    returns the search after running it; its plan is None if the level wasn't solved
+    '''
+    mapa = Map(filename)
+    domain = domain or BoxDomain(filename)
+    if config is None:
+        _, _, config = configure(mapa, domain, model, configs, cpus)
+
+    # o dominio ja construido e ajustado a configuracao, sem refazer as distancias
+    domain.matching_deadlocks = config.matching
+    if config.pattern_size and domain.patterns is None:
+        domain.patterns = PatternDatabase(domain, config.pattern_size)
+
+    initial = initial or [mapa.keeper, mapa.boxes]
+    goal = [None, mapa.filter_tiles([Tiles.MAN_ON_GOAL, Tiles.BOX_ON_GOAL, Tiles.GOAL])]
+    if known:
+        problem = KnownStatesProblem(domain, initial, goal, known)
+    else:
+        problem = SearchProblem(domain, initial, goal)
+    if config.hierarchy:
+        search = HierarchicalSearch(problem, config.strategy, config.workers)
+    elif config.memory:
+        search = ExternalSearch(problem, config.strategy, config.memory)
+    elif config.workers > 1:
+        search = ParallelSearch(problem, config.strategy, config.workers)
+    else:
+        search = SearchTree(problem, config.strategy)
+    search.search()
+    return search
+
+# resolve um nivel com a configuracao por omissao, para a calibracao
+def _sample(filename):
+    mapa = Map(filename)
+    domain = BoxDomain(filename)
+    measures = features(mapa, domain)
+    start = time.time()
+    search = solve(filename, SolverConfig())
+    return filename, measures, search.visited_ones, search.plan is not None, time.time() - start
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("levels", nargs="+", help="level files")
+    parser.add_argument("--calibrate", help="solve the levels and write the fitted model to this file")
+    parser.add_argument("--model", help="model file used to configure the levels")
+    parser.add_argument("--processes", help="worker processes of the calibration", type=int)
+    args = parser.parse_args()
+
+    if args.calibrate:
+        samples = []
+        with multiprocessing.Pool(args.processes) as pool:
+            for filename, measures, nodes, solved, elapsed in pool.imap_unordered(_sample, args.levels):
+                print(f"{filename}: {nodes} nodes, {elapsed:.2f}s{'' if solved else ', unsolved'}")
+                if solved:
+                    samples.append((measures, nodes))
+        model = DifficultyModel.fit(samples)
+        model.save(args.calibrate)
+        print(f"{len(samples)} levels, weights {[round(w, 4) for w in model.weights]}")
+        sys.exit(0)
+
+    model = DifficultyModel.load(args.model) if args.model else None
+    for filename in args.levels:
+        mapa = Map(filename)
+        domain = BoxDomain(filename)
+        difficulty, nodes, config = configure(mapa, domain, model)
+        print(f"{filename}: {difficulty}, {nodes:.0f} nodes predicted, {config}")
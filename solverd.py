@@ -0,0 +1,356 @@
+"""Local solver daemon: one warm pool of solver processes shared by many clients.
+
+Clients connect to a Unix socket and send one JSON request per line:
+
+    {"cmd": "solve", "id": 1, "map": "<xsb text>", "priority": 0, "deadline": 30}
+    {"cmd": "stats"}
+
+and get one JSON reply per line, {"id": 1, "status": ..., "keys": "...", ...},
+with status "solved", "unsolved", "timeout" or "error". A request may carry a
+"config" (SolverConfig fields), otherwise the solver picks one for the level.
+
+Identical requests (same map text and config) share a single solve while it
+is in flight, and results are kept in an LRU solution cache, optionally
+backed by a directory. Pending solves are run by priority (higher first) and
+then by deadline; a solve still running when every request waiting for it
+has expired is killed and its worker replaced. Workers are long-lived, so
+what they load (pattern databases, parsed levels) stays warm across requests.
+"""
+import argparse
+import asyncio
+import hashlib
+import heapq
+import itertools
+import json
+import logging
+import math
+import multiprocessing
+import os
+import socket
+import tempfile
+import time
+
+from sokoban_domain import LRUCache
+from solver import SolverConfig, solve
+
+logging.basicConfig(
+    level=logging.DEBUG, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+)
+logger = logging.getLogger("Solverd")
+logger.setLevel(logging.INFO)
+
+SOCKET_PATH = os.path.join(tempfile.gettempdir(), "solverd.sock")
+DEFAULT_DEADLINE = 60
+
+
+def _serve(conn):
+    """Worker process loop: solve (filename, config) tasks sent through conn."""
+    while True:
+        try:
+            filename, config = conn.recv()
+        except EOFError:
+            return
+        start = time.time()
+        try:
+            # one process per solve: the daemon already runs a worker per cpu
+            search = solve(filename, SolverConfig.from_dict(config) if config else None, cpus=1)
+            keys = None
+            if search.plan is not None:
+                keys = "".join(key for _, path in search.plan for key in path)
+            conn.send(
+                {
+                    "status": "solved" if keys is not None else "unsolved",
+                    "keys": keys,
+                    "expanded": search.visited_ones,
+                    "elapsed": time.time() - start,
+                }
+            )
+        except Exception as error:  # the worker must survive a bad map
+            conn.send({"status": "error", "reason": str(error)})
+
+
+def number(request, field, default):
+    """Numeric field of a request, default when missing or null; ValueError if it isn't a finite number."""
+    value = request.get(field)
+    if value is None:
+        return default
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{field} must be a number")
+    if not math.isfinite(value):
+        raise ValueError(f"{field} must be a finite number")
+    return value
+
+
+class Worker:
+    """A solver process and the pipe used to hand it tasks."""
+
+    def __init__(self):
+        self.spawn()
+
+    def spawn(self):
+        # not daemonic: a solve may start processes of its own (pools, parallel search)
+        self.conn, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_serve, args=(child,))
+        self.process.start()
+        child.close()
+
+    def close(self):
+        """Stop the worker: it exits when its pipe closes, or is terminated."""
+        self.conn.close()
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+
+    def restart(self):
+        self.process.terminate()
+        self.process.join()
+        self.conn.close()
+        self.spawn()
+
+    async def run(self, filename, config, cancelled):
+        """Solve in the worker; None if cancelled() turns true first (the worker is restarted)."""
+        loop = asyncio.get_event_loop()
+        readable = asyncio.Event()
+        fd = self.conn.fileno()
+        loop.add_reader(fd, readable.set)
+        try:
+            self.conn.send((filename, config))
+            while not readable.is_set() and not cancelled():
+                try:
+                    await asyncio.wait_for(readable.wait(), 0.1)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            loop.remove_reader(fd)
+
+        if not readable.is_set():
+            self.restart()
+            return None
+        try:
+            return self.conn.recv()
+        except EOFError:
+            self.restart()
+            return {"status": "error", "reason": "worker died"}
+
+
+class Job:
+    """A solve in flight and the requests waiting for it."""
+
+    def __init__(self, key, filename, config, priority, deadline):
+        self.key = key
+        self.filename = filename
+        self.config = config
+        self.priority = priority
+        self.deadline = deadline
+        self.waiters = 0
+        self.started = False
+        self.future = asyncio.get_event_loop().create_future()
+
+    def expired(self):
+        return self.waiters == 0 or time.monotonic() > self.deadline
+
+
+class SolverDaemon:
+    """Queue, dedupe and cache of solve requests over a pool of Workers."""
+
+    def __init__(self, workers=None, cache_size=1024, cache_dir=None, map_dir=None):
+        self.workers = [Worker() for _ in range(workers or multiprocessing.cpu_count())]
+        self.cache = LRUCache(cache_size)
+        self.cache_dir = cache_dir
+        self.map_dir = map_dir or tempfile.mkdtemp(prefix="solverd-")
+        self.inflight = {}
+        self.pending = []  # heap of (-priority, deadline, seq, job)
+        self.counter = itertools.count()
+        self.wakeup = asyncio.Event()
+        self.stats = {"requests": 0, "cached": 0, "deduped": 0, "solved": 0, "timeouts": 0}
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def request_key(text, config):
+        digest = hashlib.sha1(text.encode())
+        digest.update(json.dumps(config, sort_keys=True).encode())
+        return digest.hexdigest()
+
+    def cached(self, key):
+        result = self.cache.get(key)
+        if result is None and self.cache_dir:
+            path = os.path.join(self.cache_dir, f"{key}.json")
+            if os.path.isfile(path):
+                with open(path) as infile:
+                    result = json.load(infile)
+                self.cache.put(key, result)
+        return result
+
+    def store(self, key, result):
+        self.cache.put(key, result)
+        if self.cache_dir:
+            path = os.path.join(self.cache_dir, f"{key}.json")
+            with open(f"{path}.tmp", "w") as outfile:
+                json.dump(result, outfile)
+            os.replace(f"{path}.tmp", path)
+
+    async def solve(self, text, config=None, priority=0, deadline=DEFAULT_DEADLINE):
+        """Result of solving the map text, shared with identical requests in flight."""
+        self.stats["requests"] += 1
+        key = self.request_key(text, config)
+        result = self.cached(key)
+        if result is not None:
+            self.stats["cached"] += 1
+            return dict(result, cached=True)
+
+        expires = time.monotonic() + deadline
+        job = self.inflight.get(key)
+        if job is None:
+            filename = os.path.join(self.map_dir, f"{key}.xsb")
+            with open(filename, "w") as outfile:
+                outfile.write(text)
+            job = self.inflight[key] = Job(key, filename, config, priority, expires)
+            heapq.heappush(self.pending, (-priority, expires, next(self.counter), job))
+            self.wakeup.set()
+        else:
+            self.stats["deduped"] += 1
+            job.deadline = max(job.deadline, expires)
+            if priority > job.priority:
+                # push it again with the new priority, the stale entry is skipped when popped
+                job.priority = priority
+                heapq.heappush(self.pending, (-priority, job.deadline, next(self.counter), job))
+                self.wakeup.set()
+
+        job.waiters += 1
+        try:
+            result = await asyncio.wait_for(asyncio.shield(job.future), max(expires - time.monotonic(), 0))
+        except asyncio.TimeoutError:
+            self.stats["timeouts"] += 1
+            return {"status": "timeout", "cached": False}
+        finally:
+            job.waiters -= 1
+        return dict(result, cached=False)
+
+    def next_job(self):
+        while self.pending:
+            job = heapq.heappop(self.pending)[3]
+            if job.future.done() or self.inflight.get(job.key) is not job or job.started:
+                continue
+            if job.expired():
+                self.finish(job, {"status": "timeout"})
+                continue
+            return job
+        return None
+
+    def finish(self, job, result):
+        if self.inflight.get(job.key) is job:
+            del self.inflight[job.key]
+        if not job.future.done():
+            job.future.set_result(result)
+        try:
+            os.remove(job.filename)
+        except OSError:
+            pass
+
+    async def run_worker(self, worker):
+        while True:
+            job = self.next_job()
+            if job is None:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            job.started = True
+            result = await worker.run(job.filename, job.config, job.expired)
+            if result is None:
+                logger.info("Solve %s dropped, no request is waiting for it", job.key[:8])
+                result = {"status": "timeout"}
+            elif result["status"] in ("solved", "unsolved"):
+                self.stats["solved"] += 1
+                self.store(job.key, result)
+            self.finish(job, result)
+
+    async def handle(self, reader, writer):
+        """Serve one client connection: JSON requests and replies, one per line."""
+        requests = []
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                except ValueError:
+                    writer.write(b'{"status": "error", "reason": "invalid json"}\n')
+                    continue
+                requests.append(asyncio.ensure_future(self.reply(request, writer)))
+        finally:
+            for task in requests:
+                task.cancel()
+
+    async def reply(self, request, writer):
+        """Answer one request; anything that goes wrong is still answered, as an error."""
+        try:
+            result = await self.answer(request)
+        except asyncio.CancelledError:
+            raise
+        except Exception as error:
+            logger.exception("Request failed: %s", request)
+            result = {"status": "error", "reason": str(error)}
+        if isinstance(request, dict) and "id" in request:
+            result["id"] = request["id"]
+        writer.write((json.dumps(result) + "\n").encode())
+
+    async def answer(self, request):
+        if not isinstance(request, dict):
+            return {"status": "error", "reason": "request must be an object"}
+        if request.get("cmd") == "stats":
+            return dict(self.stats, pending=len(self.inflight))
+        if request.get("cmd") != "solve" or not isinstance(request.get("map"), str):
+            return {"status": "error", "reason": "unknown command"}
+        try:
+            priority = number(request, "priority", 0)
+            deadline = number(request, "deadline", DEFAULT_DEADLINE)
+        except ValueError as error:
+            return {"status": "error", "reason": str(error)}
+        return await self.solve(request["map"], request.get("config"), priority, deadline)
+
+    async def serve(self, path=SOCKET_PATH):
+        if os.path.exists(path):
+            os.remove(path)
+        server = await asyncio.start_unix_server(self.handle, path)
+        logger.info("Serving on %s with %s workers", path, len(self.workers))
+        await asyncio.gather(*[self.run_worker(worker) for worker in self.workers])
+        server.close()
+
+    def close(self):
+        for worker in self.workers:
+            worker.close()
+
+
+def request(text, path=SOCKET_PATH, config=None, priority=0, deadline=DEFAULT_DEADLINE):
+    """Blocking client call: solve a map text through the daemon, returns its reply."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        conn.connect(path)
+        message = {"cmd": "solve", "map": text, "priority": priority, "deadline": deadline}
+        if config:
+            message["config"] = config
+        conn.sendall((json.dumps(message) + "\n").encode())
+        with conn.makefile("r") as reply:
+            return json.loads(reply.readline())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--socket", help="Unix socket path", default=SOCKET_PATH)
+    parser.add_argument("--workers", help="solver processes", type=int)
+    parser.add_argument("--cache-size", help="solutions kept in memory", type=int, default=1024)
+    parser.add_argument("--cache-dir", help="directory where solutions are also kept")
+    args = parser.parse_args()
+
+    daemon = SolverDaemon(args.workers, args.cache_size, args.cache_dir)
+    loop = asyncio.get_event_loop()
+    try:
+        loop.run_until_complete(daemon.serve(args.socket))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.close()
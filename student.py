@@ -5,57 +5,207 @@ import os
 import websockets
 from threading import Thread
 from mapa import Map
-from tree_search import *
-import mapa
-from sokoban_domain import BoxDomain
-from consts import Tiles, TILES
+from sokoban_domain import BoxDomain, new_pos, prior_pos
+from protocol import PROTOCOL_VERSION, StateDecoder
+from solver import CONFIGS, configure, load_configs, solve
+import solverd
+
+LOOKAHEAD = 8  # estados do plano procurados a frente do ultimo confirmado (frames perdidos)
+
+# estados (keeper, caixas) apos cada tecla de um plano, a partir de start
+def simulate(start, keys):
+    keeper, boxes = start
+    boxes = set(boxes)
+    states = [(keeper, frozenset(boxes))]
+    for key in keys:
+        keeper = new_pos(keeper, key)
+        if keeper in boxes:
+            boxes.remove(keeper)
+            boxes.add(new_pos(keeper, key))
+        states.append((keeper, frozenset(boxes)))
+    return states
 
 class Client:
     def __init__(self):
         self.plan = None
+        self.uploaded = False  # a plan is being played by the server
+        self.filename = None
+        self.start = None      # estado de onde parte o plano a enviar
+        self.expected = None   # estados esperados durante o plano enviado
+        self.progress = 0      # indice do ultimo estado esperado confirmado pelo servidor
+        self.domain = None     # dominio do nivel, com as caches da pesquisa
+        self.config = None     # configuracao do solver escolhida para o nivel
+        self.pushes = None     # empurroes do plano: (estado antes, caixa, caminho)
+        self.replanning = False
+        # configuracoes do solver por classe de dificuldade, afinadas pelo autotune.py
+        config_file = os.environ.get("SOLVER_CONFIG")
+        self.configs = load_configs(config_file) if config_file else CONFIGS
 
     async def agent_loop(self, server_address, agent_name):
         async with websockets.connect(f"ws://{server_address}/player") as websocket:
             # Receive information about static game properties
-            await websocket.send(json.dumps({"cmd": "join", "name": agent_name}))
+            await websocket.send(json.dumps({"cmd": "join", "name": agent_name, "protocol": PROTOCOL_VERSION}))
+            decoder = StateDecoder()
 
             while True:
                 try:
-                    update = json.loads(
+                    update = decoder.update(json.loads(
                         await websocket.recv()
-                    )  # receive game update, this must be called timely or your game will get out of sync with the server
+                    ))  # receive game update, this must be called timely or your game will get out of sync with the server
                     
-                    if "map" in update:
+                    if update is None:
+                        pass  # delta received before a keyframe
+                    elif "plan" in update:
+                        # the server reports how far the uploaded plan got
+                        self.uploaded = update["plan"]["remaining"] > 0
+                    elif "map" in update:
                         # we got a new level
                         game_properties = update
                         print("Novo nível: ", update["map"])
+                        self.expected = None
+                        self.domain = self.config = self.pushes = None
                         mythread = Thread(target=self.sokobanSolver, args=(update["map"],))
                         mythread.start()
 
                     else:
                         # we got a current map state update
                         state = update
+                        if self.diverged(state):
+                            print("Estado diferente do esperado, a replanear")
+                            self.expected = None
+                            if not self.replan(state):
+                                # o plano antigo e parado enquanto se procura outro
+                                await websocket.send(json.dumps({"cmd": "plan", "keys": ""}))
+                                self.uploaded = False
 
-                    if self.plan==[] or self.plan==None:
-                        key=''
-                    else:
-                        key = self.plan[0]
-                        self.plan = self.plan[1:]    
-                    await websocket.send(
-                        json.dumps({"cmd": "key", "key": key})
-                    )
+                    if self.plan:
+                        # upload the whole plan at once, the server plays one key per frame
+                        # (replacing the one being played, if any)
+                        await websocket.send(
+                            json.dumps({"cmd": "plan", "keys": "".join(self.plan)})
+                        )
+                        self.expected = simulate(self.start, self.plan)
+                        self.progress = 0
+                        self.plan = []
+                        self.uploaded = True
+                    elif not self.uploaded:
+                        await websocket.send(
+                            json.dumps({"cmd": "key", "key": ''})
+                        )
                     
                 except websockets.exceptions.ConnectionClosedOK:
                     print("Server has cleanly disconnected us")
                     return
+
+    def diverged(self, state):
+        '''
+        @param state, a state update of the server
+        returns True if the keeper and boxes aren't the ones expected at the
+        last confirmed point of the plan or a few keys after it
+        '''
+        if self.expected is None or "keeper" not in state:
+            return False
+        actual = (tuple(state["keeper"]), frozenset(tuple(box) for box in state["boxes"]))
+        for idx in range(self.progress, min(self.progress + LOOKAHEAD, len(self.expected))):
+            if self.expected[idx] == actual:
+                self.progress = idx
+                return False
+        return True
+
+    def replan(self, state):
+        '''
+        @param state, the state update where the game left the plan
+        repairs the plan when the boxes are as before one of its pushes: the
+        keeper walks to that push and the rest of the plan is kept; otherwise
+        searches again from the actual state, in a thread, with the solver
+        configuration and the domain of the level (see search_from).
+        returns True if the repaired plan is already in self.plan
+        '''
+        keeper = tuple(state["keeper"])
+        boxes  = [tuple(box) for box in state["boxes"]]
+        self.start = (keeper, boxes)
+        if self.domain is None:
+            # plano do solverd: sem dominio nem empurroes nao ha reparacao, so nova pesquisa
+            print("Plano do solverd, sem empurroes para reparar: nova pesquisa local")
+        elif self.pushes:
+            key = self.domain.boxes_key([keeper, boxes])
+            for idx, (before, box, path) in enumerate(self.pushes):
+                if self.domain.boxes_key(before) != key:
+                    continue
+                walk = self.domain.keeper_plan(boxes, keeper, prior_pos(box, path[-1]))
+                if walk is None:
+                    continue
+                self.set_pushes([([keeper, boxes], box, walk + path[-1:])] + self.pushes[idx+1:])
+                return True
+
+        if not self.replanning:
+            self.replanning = True
+            Thread(target=self.search_from, args=(keeper, boxes)).start()
+        return False
+
+    def search_from(self, keeper, boxes):
+        '''
+        @param keeper, the actual keeper position
+        @param boxes, the actual boxes
+        searches with the solver configuration of the level, reusing its domain
+        (distances, caches and pattern database); the states before the pushes
+        of the old plan are known to reach the goals, so the search also stops
+        at them and the rest of the old plan is kept from there
+        '''
+        try:
+            if self.domain is None:
+                self.domain = BoxDomain(self.filename)
+                _, _, self.config = configure(Map(self.filename), self.domain, configs=self.configs)
+            pushes = self.pushes or []
+            known = {self.domain.hash(before): idx for idx, (before, _, _) in enumerate(pushes)}
+            t = solve(self.filename, self.config, domain=self.domain, initial=[keeper, boxes], known=known)
+            if t.plan is None:
+                return
+            newpushes = [(before, box, path) for before, (box, path) in zip(t.path, t.plan)]
+            end = t.path[-1]
+            idx = known.get(self.domain.hash(end))
+            if idx is not None:
+                # o keeper esta na mesma zona que antes do empurrao idx: anda ate ele
+                _, box, path = pushes[idx]
+                walk = self.domain.keeper_plan(end[1], end[0], prior_pos(box, path[-1]))
+                newpushes += [(end, box, walk + path[-1:])] + pushes[idx+1:]
+            self.set_pushes(newpushes)
+        finally:
+            self.replanning = False
+
+    # guarda os empurroes de um plano, para reparacoes futuras, e o plano a enviar
+    def set_pushes(self, pushes):
+        self.pushes = pushes
+        if pushes:
+            self.start = (pushes[0][0][0], list(pushes[0][0][1]))
+        self.plan = [key for _, _, path in pushes for key in path]
+
+    # guarda o plano de uma pesquisa e os empurroes
+    def use_plan(self, t):
+        if t.plan is None:
+            return
+        self.domain = t.problem.domain
+        self.set_pushes([(before, box, path) for before, (box, path) in zip(t.path, t.plan)])
+
     def sokobanSolver(self, filename):
-        mapa = Map(filename)
-        initial = [mapa.keeper, mapa.boxes]
-        goal = [None, mapa.filter_tiles([Tiles.MAN_ON_GOAL, Tiles.BOX_ON_GOAL, Tiles.GOAL])]
-        t = SearchTree(SearchProblem(BoxDomain(filename), initial, goal), "greedy")
+        self.filename = filename
+        if os.environ.get("SOLVERD"):
+            # resolvido pelo daemon partilhado (solverd.py) no socket dado
+            with open(filename) as infile:
+                reply = solverd.request(infile.read(), os.environ["SOLVERD"])
+            if reply["status"] == "solved":
+                mapa = Map(filename)
+                self.start = (mapa.keeper, list(mapa.boxes))
+                self.plan = list(reply["keys"])
+                return reply
+            print("solverd:", reply)
 
-        t.search()
-        self.plan = [idx for path in [idx[1] for idx in t.plan] for idx in path]
+        # a configuracao (estrategia, heuristica, ...) e escolhida pela dificuldade prevista do nivel
+        mapa = Map(filename)
+        domain = BoxDomain(filename)
+        _, _, self.config = configure(mapa, domain, configs=self.configs)
+        t = solve(filename, self.config, domain=domain)
+        self.use_plan(t)
         return t
 
 # DO NOT CHANGE THE LINES BELLOW
@@ -0,0 +1,83 @@
+"""ExternalSearch with its runs on a local disk directory."""
+import os
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from consts import Tiles  # noqa: E402
+from external_search import CLOSED, ExternalSearch, state_key  # noqa: E402
+from mapa import Map  # noqa: E402
+from sokoban_domain import BoxDomain  # noqa: E402
+from tree_search import SearchProblem, SearchTree  # noqa: E402
+
+
+def problem(level):
+    """SearchProblem of a level, from its start to its goals."""
+    filename = f"levels/{level}.xsb"
+    mapa = Map(filename)
+    goal = [None, mapa.filter_tiles([Tiles.MAN_ON_GOAL, Tiles.BOX_ON_GOAL, Tiles.GOAL])]
+    return SearchProblem(BoxDomain(filename), [mapa.keeper, mapa.boxes], goal)
+
+
+class TestExternalSearch(unittest.TestCase):
+    def setUp(self):
+        cwd = os.getcwd()
+        os.chdir(ROOT)
+        self.addCleanup(os.chdir, cwd)
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def test_spilled_search_finds_a_plan(self):
+        for level in (1, 2, 3, 5):
+            with self.subTest(level=level):
+                search = ExternalSearch(problem(level), "a*", memory=8, directory=self.directory.name, max_runs=2)
+                path = search.search()
+                self.assertIsNotNone(path)
+                self.assertTrue(search.problem.goal_test(path[-1]))
+                self.assertEqual(len(path), len(search.plan) + 1)
+
+                tree = SearchTree(problem(level), "a*")
+                tree.search()
+                self.assertEqual(search.cost, tree.cost)
+
+    def test_runs_are_removed(self):
+        search = ExternalSearch(problem(2), "greedy", memory=4, directory=self.directory.name)
+        self.assertIsNotNone(search.search())
+        self.assertEqual(os.listdir(self.directory.name), [])
+
+    def closed_run(self, search, records):
+        """Points the search at one closed run holding the (key, parent key) records."""
+        search.workdir = self.directory.name
+        path = os.path.join(self.directory.name, "closed.run")
+        with open(path, "wb") as outfile:
+            for record in sorted(records):
+                outfile.write(CLOSED.pack(*record))
+        search.closed = [path]
+
+    def test_rebuild_fails_without_an_action(self):
+        level = problem(2)
+        tree = SearchTree(level, "a*")
+        tree.search()
+        root = state_key(level.domain, level.initial)
+        goal = state_key(level.domain, tree.path[-1])
+
+        search = ExternalSearch(level)
+        self.closed_run(search, [(root, root), (goal, root)])
+        with self.assertRaises(RuntimeError):
+            search._rebuild(goal)
+
+    def test_rebuild_fails_without_a_closed_record(self):
+        level = problem(2)
+        root = state_key(level.domain, level.initial)
+
+        search = ExternalSearch(level)
+        self.closed_run(search, [(root, root)])
+        with self.assertRaises(RuntimeError):
+            search._rebuild(root ^ 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
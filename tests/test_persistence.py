@@ -0,0 +1,125 @@
+"""GradingUploader against a stub grading server."""
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from persistence import GradingUploader  # noqa: E402
+
+
+class StubGrading(BaseHTTPRequestHandler):
+    """Grading server keeping the posted records, failing the first `failures` posts."""
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        server = self.server
+        with server.lock:
+            if server.failures > 0:
+                server.failures -= 1
+                self.send_response(500)
+            else:
+                server.records.append(json.loads(body))
+                self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class TestGradingUploader(unittest.TestCase):
+    def setUp(self):
+        self.server = HTTPServer(("127.0.0.1", 0), StubGrading)
+        self.server.records = []
+        self.server.failures = 0
+        self.server.lock = threading.Lock()
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = f"http://127.0.0.1:{self.server.server_port}/game"
+
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.spool = os.path.join(self.tmpdir.name, "grading.spool")
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.addCleanup(self.loop.close)
+
+    def uploader(self):
+        return GradingUploader(self.url, self.spool, batch=3, timeout=2, retry_delay=0.01)
+
+    def run_until(self, uploaders, count, timeout=10):
+        """Run the uploaders until the stub server holds count records."""
+        tasks = [asyncio.ensure_future(uploader.run()) for uploader in uploaders]
+
+        async def wait():
+            while len(self.server.records) < count:
+                await asyncio.sleep(0.01)
+            await asyncio.sleep(0.1)  # let a duplicate show up, if any
+
+        try:
+            self.loop.run_until_complete(asyncio.wait_for(wait(), timeout))
+        finally:
+            for task in tasks:
+                task.cancel()
+            self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+
+    def spooled(self):
+        with open(self.spool) as infile:
+            return [json.loads(line) for line in infile if line.strip()]
+
+    def test_upload_in_order(self):
+        uploader = self.uploader()
+        records = [{"player": "p", "game": i} for i in range(7)]
+        for record in records:
+            uploader.submit(record)
+        self.run_until([uploader], len(records))
+        self.assertEqual(self.server.records, records)
+        self.assertEqual(self.spooled(), [])
+
+    def test_retry_after_failures(self):
+        self.server.failures = 2
+        uploader = self.uploader()
+        records = [{"player": "p", "game": i} for i in range(4)]
+        for record in records:
+            uploader.submit(record)
+        self.run_until([uploader], len(records))
+        self.assertEqual(self.server.records, records)
+
+    def test_spool_survives_restart(self):
+        self.server.failures = 1000
+        uploader = self.uploader()
+        records = [{"player": "p", "game": i} for i in range(5)]
+        for record in records:
+            uploader.submit(record)
+        with self.assertRaises(asyncio.TimeoutError):
+            self.run_until([uploader], 1, timeout=0.5)
+        self.assertEqual(self.spooled(), records)
+
+        self.server.failures = 0
+        self.run_until([self.uploader()], len(records))
+        self.assertEqual(self.server.records, records)
+
+    def test_shared_spool_uploads_each_record_once(self):
+        uploaders = [self.uploader() for _ in range(3)]
+        records = []
+        for i in range(30):
+            record = {"player": f"p{i % 3}", "game": i}
+            uploaders[i % 3].submit(record)
+            records.append(record)
+        self.run_until(uploaders, len(records))
+        self.assertEqual(len(self.server.records), len(records))
+        self.assertCountEqual(self.server.records, records)
+        self.assertEqual(self.spooled(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
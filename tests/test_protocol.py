@@ -0,0 +1,88 @@
+"""Round trip of the version 2 state stream through StateDecoder."""
+import asyncio
+import json
+import os
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from consts import GameStatus, Tiles  # noqa: E402
+from game import Game  # noqa: E402
+from mapa import Map  # noqa: E402
+from protocol import DELTAS, FULL_STATES, KEYFRAME_INTERVAL, Frame, StateDecoder  # noqa: E402
+from sokoban_domain import BoxDomain  # noqa: E402
+from tree_search import SearchProblem, SearchTree  # noqa: E402
+
+
+def solution(level):
+    """Keys that solve a level."""
+    filename = f"levels/{level}.xsb"
+    mapa = Map(filename)
+    goal = [None, mapa.filter_tiles([Tiles.MAN_ON_GOAL, Tiles.BOX_ON_GOAL, Tiles.GOAL])]
+    search = SearchTree(SearchProblem(BoxDomain(filename), [mapa.keeper, mapa.boxes], goal))
+    search.search()
+    return "".join(key for _, path in search.plan for key in path)
+
+
+def normalized(state):
+    """State with its boxes sorted, the order of the boxes isn't kept by deltas."""
+    return dict(state, boxes=sorted(state["boxes"])) if state else state
+
+
+class TestStateDecoder(unittest.TestCase):
+    def setUp(self):
+        cwd = os.getcwd()
+        os.chdir(ROOT)
+        self.addCleanup(os.chdir, cwd)
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+
+    def frames(self, game, keys):
+        """Frames of a game as the server builds them, from the first one."""
+        keys = list(keys)
+        keyframe = True
+        while game.running and (keys or game.step < KEYFRAME_INTERVAL + 5):
+            if keys:
+                game.keypress(keys.pop(0))
+            status = self.loop.run_until_complete(game.next_frame(wait=False))
+            yield Frame(
+                game,
+                keyframe or status == GameStatus.NEW_MAP or game.step % KEYFRAME_INTERVAL == 0,
+            )
+            keyframe = False
+
+    def test_round_trip_from_first_frame(self):
+        game = Game(1, player="tester")
+        decoder = StateDecoder()
+        count = 0
+        for frame in self.frames(game, solution(1)):
+            state = decoder.update(json.loads(frame.encode(DELTAS)))
+            self.assertEqual(normalized(state), normalized(json.loads(frame.encode(FULL_STATES))))
+            count += 1
+        self.assertEqual(game.level, 2)
+        self.assertGreater(count, KEYFRAME_INTERVAL)
+
+    def test_delta_without_keyframe_is_dropped(self):
+        game = Game(1, player="tester")
+        self.loop.run_until_complete(game.next_frame(wait=False))
+        decoder = StateDecoder()
+        self.assertIsNone(decoder.update(json.loads(game.delta)))
+
+    def test_lost_frame_waits_for_keyframe(self):
+        game = Game(1, player="tester")
+        decoder = StateDecoder()
+        frames = self.frames(game, "")
+        decoder.update(json.loads(next(frames).encode(DELTAS)))
+        next(frames)  # lost
+        for frame in frames:
+            state = decoder.update(json.loads(frame.encode(DELTAS)))
+            if frame.keyframe:
+                break
+            self.assertIsNone(state)
+        self.assertEqual(normalized(state), normalized(json.loads(frame.encode(FULL_STATES))))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+"""Replies of the solver daemon to malformed requests."""
+import asyncio
+import json
+import os
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from solverd import DEFAULT_DEADLINE, SolverDaemon  # noqa: E402
+
+
+class Writer:
+    """Collects what the daemon writes to a client."""
+
+    def __init__(self):
+        self.lines = []
+
+    def write(self, data):
+        self.lines.append(json.loads(data))
+
+
+class TestReply(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.addCleanup(self.loop.close)
+        self.daemon = SolverDaemon(workers=1)
+        self.addCleanup(self.daemon.close)
+
+    def reply(self, request):
+        writer = Writer()
+        self.loop.run_until_complete(self.daemon.reply(request, writer))
+        self.assertEqual(len(writer.lines), 1)
+        return writer.lines[0]
+
+    def test_bad_numbers(self):
+        for field, value in (("deadline", "soon"), ("priority", "high"), ("deadline", "nan"), ("priority", [1])):
+            with self.subTest(field=field, value=value):
+                result = self.reply({"cmd": "solve", "id": 7, "map": "#####", field: value})
+                self.assertEqual(result["status"], "error")
+                self.assertEqual(result["id"], 7)
+        self.assertEqual(self.daemon.inflight, {})
+        self.assertEqual(self.daemon.pending, [])
+
+    def test_numeric_strings(self):
+        async def solve(text, config, priority, deadline):
+            return {"status": "solved", "priority": priority, "deadline": deadline}
+
+        self.daemon.solve = solve
+        result = self.reply({"cmd": "solve", "id": 1, "map": "#####", "priority": "2", "deadline": "30"})
+        self.assertEqual((result["priority"], result["deadline"], result["id"]), (2, 30, 1))
+        result = self.reply({"cmd": "solve", "map": "#####", "priority": None, "deadline": None})
+        self.assertEqual((result["priority"], result["deadline"]), (0, DEFAULT_DEADLINE))
+
+    def test_failure_is_answered(self):
+        async def solve(*args):
+            raise OSError("disk full")
+
+        self.daemon.solve = solve
+        result = self.reply({"cmd": "solve", "id": 3, "map": "#####"})
+        self.assertEqual(result, {"status": "error", "reason": "disk full", "id": 3})
+
+    def test_not_an_object(self):
+        self.assertEqual(self.reply([1, 2])["status"], "error")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -6,14 +6,28 @@
 #    SearchDomain  - problem domains
 #    SearchProblem - concrete problems to be solved
 #    SearchNode    - search tree nodes
+#    NodeStore     - compact storage of the search tree nodes
 #    SearchTree    - search tree with the necessary methods for searhing
 #
+# A long search can be checkpointed: search(checkpoint=filename) saves
+# a snapshot of the tree every interval seconds, and
+# SearchTree.resume(filename) loads it back, possibly on another
+# machine, so that search() goes on from where the snapshot was taken.
+#
 #  (c) Luis Seabra Lopes
 #  Introducao a Inteligencia Artificial, 2012-2019,
 #  Inteligência Artificial, 2014-2019
 
 from abc import ABC, abstractmethod
+from array import array
 import heapq
+import os
+import pickle
+import time
+import zlib
+
+SNAPSHOT_MAGIC   = b'STREE'
+SNAPSHOT_VERSION = 2
 
 # Dominios de pesquisa
 # Permitem calcular
@@ -60,6 +74,14 @@ class SearchDomain(ABC):
     def hash(self, state):
         pass
 
+    # representacao compacta de um estado em bytes, para guardar em disco
+    def pack(self, state):
+        return pickle.dumps(state, pickle.HIGHEST_PROTOCOL)
+
+    # estado a partir da sua representacao em bytes
+    def unpack(self, data):
+        return pickle.loads(data)
+
 
 # Problemas concretos a resolver
 # dentro de um determinado dominio
@@ -76,8 +98,11 @@ class SearchProblem:
         return self.domain.satisfies_box(box, self.goal)
 
 # Nos de uma arvore de pesquisa
+# (vistas sobre os nos guardados num NodeStore)
 class SearchNode:
-    def __init__(self,state,parent, depth, cost, heuristic=0, action=None): 
+    __slots__ = ("state", "parent", "depth", "cost", "heuristic", "action", "children", "index")
+
+    def __init__(self,state,parent, depth, cost, heuristic=0, action=None, index=None): 
         self.state     = state
         self.parent    = parent
         self.depth     = depth
@@ -85,29 +110,112 @@ class SearchNode:
         self.heuristic = heuristic
         self.action    = action
         self.children  = None
+        self.index     = index
     
     def in_parent(self, state, equals):
-        if self.parent == None:
-            return False
-        return equals(state, self.parent.state) or self.parent.in_parent(state, equals)
+        node = self.parent
+        while node != None:
+            if equals(state, node.state):
+                return True
+            node = node.parent
+        return False
 
     def __str__(self):
         return f"no({str(self.state)},{str(self.parent)}, {str(self.action)})"
     def __repr__(self):
         return str(self)
 
+# Armazem de nos em "struct-of-arrays":
+# o no i e descrito pela entrada i de cada buffer
+# e o seu pai e referenciado pelo indice (-1 na raiz);
+# os estados ficam compactados pelo dominio (pack) num unico buffer
+# e as accoes sao a sua posicao na lista de accoes do estado pai
+class NodeStore:
+    __slots__ = ("domain", "data", "offsets", "actions", "keys", "parents", "depths", "costs", "heuristics")
+
+    def __init__(self, domain):
+        self.domain     = domain
+        self.data       = bytearray()
+        self.offsets    = array('Q', [0])   # o estado i ocupa data[offsets[i]:offsets[i+1]]
+        self.actions    = array('l')        # -1 na raiz
+        self.keys       = array('Q')        # lista se o dominio usar outras chaves
+        self.parents    = array('q')
+        self.depths     = array('l')
+        self.costs      = array('d')
+        self.heuristics = array('d')
+
+    def __len__(self):
+        return len(self.parents)
+
+    def add(self, state, parent, depth, cost, heuristic, action, key):
+        '''
+        @param action, the position of the action in domain.actions of the parent state (-1 at the root)
+        '''
+        self.data      += self.domain.pack(state)
+        self.offsets.append(len(self.data))
+        self.actions.append(action)
+        try:
+            self.keys.append(key)
+        except (TypeError, OverflowError):
+            self.keys = list(self.keys)
+            self.keys.append(key)
+        self.parents.append(parent)
+        self.depths.append(depth)
+        self.costs.append(cost)
+        self.heuristics.append(heuristic)
+        return len(self.parents) - 1
+
+    def state(self, index):
+        return self.domain.unpack(self.data[self.offsets[index]:self.offsets[index+1]])
+
+    # accao que levou ao no, refeita a partir do estado pai (None na raiz)
+    def action(self, index):
+        if self.parents[index] == -1:
+            return None
+        return self.domain.actions(self.state(self.parents[index]))[self.actions[index]]
+
+    # indices dos nos desde a raiz ate ao no dado (iterativo)
+    def lineage(self, index):
+        indexes = []
+        while index != -1:
+            indexes.append(index)
+            index = self.parents[index]
+        indexes.reverse()
+        return indexes
+
+    # testa se o estado aparece nos antecessores do pai do no dado; so os
+    # antecessores com a mesma chave sao descompactados e comparados
+    def in_parent(self, index, state, key, equals):
+        index = self.parents[index]
+        while index != -1:
+            if self.keys[index] == key and equals(state, self.state(index)):
+                return True
+            index = self.parents[index]
+        return False
+
+    # constroi a vista SearchNode de um no, ligada as vistas dos antecessores
+    def node(self, index):
+        node = None
+        for idx in self.lineage(index):
+            node = SearchNode(self.state(idx), node, self.depths[idx], self.costs[idx],
+                              self.heuristics[idx], self.action(idx), idx)
+        return node
+
 # Arvores de pesquisa
 class SearchTree:
 
     # construtor
     def __init__(self,problem, strategy='breadth'): 
         self.problem          = problem
-        self.root             = SearchNode(problem.initial, None, 0, 0, self.problem.domain.heuristic(
-                                self.problem.initial, self.problem.goal))
-        self.open_nodes       = [(0,0,self.root)]
+        self.nodes            = NodeStore(problem.domain)
+        self.nodes.add(problem.initial, -1, 0, 0, self.problem.domain.heuristic(
+                       self.problem.initial, self.problem.goal), -1, self.problem.domain.hash(problem.initial))
+        self.root             = self.nodes.node(0)
+        self.open_nodes       = [(0,0,0)]
         heapq.heapify(self.open_nodes)
         self.strategy         = strategy
         self.solution         = None
+        self.node_counter     = 0
 
         self.visited_nodes = set()
 
@@ -142,71 +250,138 @@ class SearchTree:
 
     # obter o caminho (sequencia de estados) da raiz ate um no
     def get_path(self,node):
-        if node.parent == None:
-            return [node.state]
-        return self.get_path(node.parent) + [node.state]
+        return [self.nodes.state(idx) for idx in self.nodes.lineage(node.index)]
 
     def get_plan(self,node):
-        if node.parent == None:
-            return []
-        return self.get_plan(node.parent) + [node.action]
+        return [self.nodes.action(idx) for idx in self.nodes.lineage(node.index)[1:]]
 
     def visited(self, state):
         return self.problem.domain.hash(state) in self.visited_nodes
 
-    def instantiate_state(self, node, action):
-        newstate = self.problem.domain.result(node.state,action)
-        newnode  = SearchNode(newstate,node, node.depth+1, node.cost+self.problem.domain.cost(node.state, action), self.problem.domain.heuristic(newstate,self.problem.goal), action)
-        return newstate, newnode
-
-    # procurar a solucao
-    def search(self):
-        node_counter = 0
+    # no filho do no index pela accao na posicao position das accoes do seu estado
+    def instantiate_state(self, index, state, newstate, action, position, key):
+        nodes = self.nodes
+        return nodes.add(newstate, index, nodes.depths[index]+1,
+                         nodes.costs[index]+self.problem.domain.cost(state, action),
+                         self.problem.domain.heuristic(newstate,self.problem.goal), position, key)
+
+    # guardar um snapshot da pesquisa: arvore, fronteira, visitados e contadores,
+    # com os buffers do NodeStore tal como estao; escrito atomicamente
+    def checkpoint(self, filename):
+        nodes  = self.nodes
+        snapshot = {
+            'problem'   : self.problem,
+            'strategy'  : self.strategy,
+            'counter'   : self.node_counter,
+            'data'      : nodes.data,
+            'offsets'   : nodes.offsets,
+            'actions'   : nodes.actions,
+            'keys'      : nodes.keys,
+            'parents'   : nodes.parents,
+            'depths'    : nodes.depths,
+            'costs'     : nodes.costs,
+            'heuristics': nodes.heuristics,
+            'open'      : self.open_nodes,
+            'visited'   : self.visited_nodes,
+        }
+        data = SNAPSHOT_MAGIC + bytes([SNAPSHOT_VERSION]) + zlib.compress(
+            pickle.dumps(snapshot, pickle.HIGHEST_PROTOCOL), 1)
+        tmpfile = filename + '.tmp'
+        with open(tmpfile, 'wb') as outfile:
+            outfile.write(data)
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        os.replace(tmpfile, filename)
+
+    # reconstroi uma arvore a partir de um snapshot
+    @staticmethod
+    def resume(filename):
+        with open(filename, 'rb') as infile:
+            data = infile.read()
+        header = len(SNAPSHOT_MAGIC)
+        if data[:header] != SNAPSHOT_MAGIC or data[header] != SNAPSHOT_VERSION:
+            raise ValueError(f"{filename} is not a search snapshot")
+        snapshot = pickle.loads(zlib.decompress(data[header+1:]))
+
+        problem = snapshot['problem']
+        tree = SearchTree.__new__(SearchTree)
+        tree.problem          = problem
+        tree.strategy         = snapshot['strategy']
+        tree.solution         = None
+        tree.node_counter     = snapshot['counter']
+        tree.nodes            = NodeStore(problem.domain)
+        tree.nodes.data       = snapshot['data']
+        tree.nodes.offsets    = snapshot['offsets']
+        tree.nodes.actions    = snapshot['actions']
+        tree.nodes.keys       = snapshot['keys']
+        tree.nodes.parents    = snapshot['parents']
+        tree.nodes.depths     = snapshot['depths']
+        tree.nodes.costs      = snapshot['costs']
+        tree.nodes.heuristics = snapshot['heuristics']
+        tree.root             = tree.nodes.node(0)
+        tree.open_nodes       = snapshot['open']
+        tree.visited_nodes    = snapshot['visited']
+        return tree
+
+    # procurar a solucao; com checkpoint, guarda um snapshot a cada interval segundos
+    def search(self, checkpoint=None, interval=300):
+        nodes = self.nodes
+        last_checkpoint = time.monotonic()
         while self.open_nodes != []:
-            node = heapq.heappop(self.open_nodes)[2]
+            if checkpoint and time.monotonic() - last_checkpoint >= interval:
+                self.checkpoint(checkpoint)
+                last_checkpoint = time.monotonic()
 
-            if self.visited(node.state):
+            index = heapq.heappop(self.open_nodes)[2]
+            if nodes.keys[index] in self.visited_nodes:
                 continue
 
-            self.visited_nodes.add(self.problem.domain.hash(node.state))
+            self.visited_nodes.add(nodes.keys[index])
+            state = nodes.state(index)
 
-            if self.problem.goal_test(node.state):
-                self.solution = node
+            if self.problem.goal_test(state):
+                self.solution = nodes.node(index)
                 return self.path
 
-            node.children = []
-
-            actions = self.problem.domain.actions(node.state)
+            actions = self.problem.domain.actions(state)
             if actions == -1:
                 continue
 
-            for action in actions:
-                newstate, newnode = self.instantiate_state(node, action)
-                if not node.in_parent(newstate, self.problem.domain.equivalent) and (not self.visited(newstate)):
-                    node.children.append(newnode)
+            for position, action in enumerate(actions):
+                newstate = self.problem.domain.result(state,action)
+                key      = self.problem.domain.hash(newstate)
+                if (not key in self.visited_nodes) and not nodes.in_parent(index, newstate, key, self.problem.domain.equivalent):
+                    newindex = self.instantiate_state(index, state, newstate, action, position, key)
                     value = 0
                     if self.strategy == 'breadth':
-                        value = node_counter
+                        value = self.node_counter
                     elif self.strategy == 'uniform':
-                        value = newnode.cost
+                        value = nodes.costs[newindex]
                     elif self.strategy == 'greedy':
-                        value = newnode.heuristic
+                        value = nodes.heuristics[newindex]
                     elif self.strategy == 'a*':
-                        value = newnode.heuristic + newnode.cost
-                    heapq.heappush(self.open_nodes,(value,node_counter,newnode))
-                    node_counter += 1
+                        value = nodes.heuristics[newindex] + nodes.costs[newindex]
+                    heapq.heappush(self.open_nodes,(value,self.node_counter,newindex))
+                    self.node_counter += 1
         return None
 
-    def show(self,node=None,indent=''):
-        if node==None:
-            self.show(self.root)
-            print('-----------------------------------------------------------------------')
-        else:
-            if(self.problem.domain.equivalent(node.state, self.root.state)):
-                print(indent+str(node.state))
+    # filhos de cada no, obtidos numa so passagem pelos indices dos pais
+    def children(self):
+        children = [[] for _ in range(len(self.nodes))]
+        for idx in range(1, len(self.nodes)):
+            children[self.nodes.parents[idx]].append(idx)
+        return children
+
+    # mostra a subarvore do no dado (a raiz se None), em profundidade e sem recursao
+    def show(self,index=None,indent=''):
+        children = self.children()
+        stack = [(0 if index==None else index, indent)]
+        while stack:
+            idx, prefix = stack.pop()
+            if(self.problem.domain.equivalent(self.nodes.state(idx), self.root.state)):
+                print(prefix+str(self.nodes.state(idx)))
             else:
-                print(indent+str(node.action))
-            if node.children==None:
-                return
-            for n in node.children:
-                self.show(n,indent+'--')
+                print(prefix+str(self.nodes.action(idx)))
+            stack.extend((child, prefix+'--') for child in reversed(children[idx]))
+        if index==None:
+            print('-----------------------------------------------------------------------')
@@ -12,6 +12,7 @@ import pygame
 from consts import RANKS, Tiles
 from mapa import Map
 from game import reduce_score
+from protocol import PROTOCOL_VERSION, StateDecoder
 from scores import HighScoresFetch
 
 logging.basicConfig(level=logging.DEBUG)
@@ -76,12 +77,13 @@ COLORS = {
 }
 SPRITES = None
 SCREEN = None
+BACKGROUNDS = {}  # map file -> pre-rendered background of the level
 
 
 async def messages_handler(websocket_path, queue):
     """Handles server side messages, putting them into a queue."""
     async with websockets.connect(websocket_path) as websocket:
-        await websocket.send(json.dumps({"cmd": "join"}))
+        await websocket.send(json.dumps({"cmd": "join", "protocol": PROTOCOL_VERSION}))
 
         while True:
             update = await websocket.recv()
@@ -251,8 +253,47 @@ def center_text_margin(canvas_width, text_width):
     return (canvas_width-text_width)/2+text_width
     
 
+def cell_rect(pos):
+    """Screen area covered by the sprite of a map cell."""
+    return pygame.Rect(scale(pos) + CHAR_SIZE)
+
+
+def level_background(mapa, mapfile):
+    """Pre-rendered static background of a level, drawn once per level."""
+    if mapfile not in BACKGROUNDS:
+        BACKGROUNDS[mapfile] = draw_background(mapa)
+    return BACKGROUNDS[mapfile]
+
+
+async def next_updates(queue, decoder, timeout):
+    """Wait for messages and return every decoded update queued meanwhile.
+
+    All messages go through the decoder, which needs each delta, but the
+    caller only has to draw the outcome of the whole batch when behind.
+    """
+    updates = []
+    try:
+        message = await asyncio.wait_for(queue.get(), timeout)
+    except asyncio.TimeoutError:
+        return updates
+    while True:
+        update = decoder.update(json.loads(message))
+        if update is not None:  # None while waiting for a keyframe
+            updates.append(update)
+        try:
+            message = queue.get_nowait()
+        except asyncio.queues.QueueEmpty:
+            return updates
+
+
 async def main_loop(queue):
-    """Processes events from server and display's."""
+    """Processes events from server and display's.
+
+    Only the screen areas that changed are redrawn: the cells whose keeper or
+    box occupancy changed and the side panel when its content changes. When
+    the viewer falls behind, queued states are coalesced and only the latest
+    one is drawn.
+    """
     global SPRITES, SCREEN
 
     main_group = pygame.sprite.LayeredUpdates()
@@ -264,17 +305,20 @@ async def main_loop(queue):
     newgame_json = json.loads(state)
 
     GAME_SPEED = newgame_json["fps"]
+    mapfile = newgame_json.get("map", "levels/1.xsb")
     try:
-        mapa = Map(newgame_json["map"])
-    except (KeyError, FileNotFoundError):
-        mapa = Map("levels/1.xsb")  # Fallback to initial map
+        mapa = Map(mapfile)
+    except FileNotFoundError:
+        mapfile = "levels/1.xsb"
+        mapa = Map(mapfile)  # Fallback to initial map
     map_x, map_y = mapa.size
     SCREEN = pygame.display.set_mode(scale((map_x+MAP_X_INCREASE, map_y+MAP_Y_INCREASE)))
     SPRITES = pygame.image.load("data/sokoban.png").convert_alpha()
 
-    BACKGROUND = draw_background(mapa)
-    SCREEN.blit(BACKGROUND, (0, 0))
-    main_group.add(Keeper(pos=mapa.keeper))
+    BACKGROUND = level_background(mapa, mapfile)
+    keeper_pos = mapa.keeper
+    main_group.add(Keeper(pos=keeper_pos))
+    boxes = {}  # position -> Box sprite, for the boxes on screen
 
     state = {
         "score": 0,
@@ -284,6 +328,9 @@ async def main_loop(queue):
     }
 
     new_event = True
+    redraw = True  # the whole screen must be drawn
+    panel = None  # content drawn on the side panel
+    decoder = StateDecoder()
 
     player = last_player = state['player']
 
@@ -294,137 +341,167 @@ async def main_loop(queue):
         if "player" in state:
             curr_player = state['player']
 
-        SCREEN.blit(BACKGROUND, (0, 0))
         pygame.event.pump()
         if pygame.key.get_pressed()[pygame.K_ESCAPE]:
             asyncio.get_event_loop().stop()
 
-        main_group.clear(SCREEN, clear_callback)
-        boxes_group.clear(SCREEN, clear_callback)
+        dirty = []  # screen areas to update
+        if redraw:
+            SCREEN.blit(BACKGROUND, (0, 0))
+            dirty.append(SCREEN.get_rect())
+            panel = None
 
         # size of each square
         map_square_size = (SCREEN.get_width()/(map_x+MAP_X_INCREASE), SCREEN.get_height()/(map_y+MAP_Y_INCREASE))
         # width of extra space added to the map, except the separating black wall
         extra_available_space_width = map_square_size[0]*(MAP_X_INCREASE-1)
 
-        if "score" in state and "player" in state:
-            if last_player != curr_player:
-                hs = HighScoresFetch(name=state['player'])
+        content = (str(state.get("score")), state.get("level"), state.get("player"), "highscores" in state)
+        if content != panel:
+            panel = content
+            panel_rect = pygame.Rect(scale((map_x, 0)), (SCREEN.get_width() - scale((map_x, 0))[0], SCREEN.get_height()))
+            SCREEN.blit(BACKGROUND, panel_rect, panel_rect)
+            dirty.append(panel_rect)
 
-                if hs.data != []:
-                    best_entry = hs.get_best_entry(type="max", key="score")
+            if "score" in state and "player" in state:
+                if last_player != curr_player:
+                    hs = HighScoresFetch(name=state['player'])
 
-                    split_timestamp = best_entry["timestamp"].split("T")
-                    
-                    # adjust best_entry dict
-                    best_entry["timestamp"] = split_timestamp[0]
-                    best_entry["timestamp2"] = split_timestamp[1]
+                    if hs.data != []:
+                        best_entry = hs.get_best_entry(type="max", key="score")
 
-                    formated_col_l, formated_col_r = [SCORE_INFO[d] for d in DATA_INDEX_BEST_ROUND], [str(best_entry[info]) for info in DATA_INDEX_BEST_ROUND]
-                    fixed_width = get_largest_width_for_table(formated_col_l, formated_col_r, BEST_ROUND_TITLE)+RIGHT_INFO_MARGIN_RIGHT
+                        split_timestamp = best_entry["timestamp"].split("T")
 
-                player = state['player']
+                        # adjust best_entry dict
+                        best_entry["timestamp"] = split_timestamp[0]
+                        best_entry["timestamp2"] = split_timestamp[1]
 
-                last_player = curr_player
-            
-            # draw player info
-            player_h_from_top = SCREEN.get_height() - RIGHT_INFO_MARGIN_BOTTOM
-            player_w, _ = get_draw_size(player)
-            draw_info(SCREEN, player, (SCREEN.get_width()-player_w-RIGHT_INFO_MARGIN_RIGHT, player_h_from_top), COLORS["light_blue"])
-            draw_info(SCREEN, "Player: ", (SCREEN.get_width()-player_w-get_draw_size("Player: ")[0]-RIGHT_INFO_MARGIN_RIGHT-5, player_h_from_top), COLORS["white"])
-   
-            current_height = RIGHT_INFO_MARGIN_TOP
-
-            if hs != None and hs.data != []:
-                # table for best round
-                current_height = draw_table_right_top(SCREEN, extra_available_space_width, (formated_col_l, COLORS["black"]), (formated_col_r, COLORS["white"]), (BEST_ROUND_TITLE, COLORS["yellow"]), fixed_width, (RIGHT_INFO_MARGIN_LEFT, current_height, RIGHT_INFO_MARGIN_RIGHT))
-            
-            # some conditions to coop with state['score']
-            if not isinstance(state['score'], int) and len(state['score']) > len(DATA_INDEX_CURR_ROUND):
-                curr_round_data_fetch = [str(state['score'][i+1]) for i in range(len(DATA_INDEX_CURR_ROUND))]
+                        formated_col_l, formated_col_r = [SCORE_INFO[d] for d in DATA_INDEX_BEST_ROUND], [str(best_entry[info]) for info in DATA_INDEX_BEST_ROUND]
+                        fixed_width = get_largest_width_for_table(formated_col_l, formated_col_r, BEST_ROUND_TITLE)+RIGHT_INFO_MARGIN_RIGHT
 
-                # if there is no data from best round, adapt the fixed size to the data of current round
-                if hs.data == []:
-                    fixed_width = get_largest_width_for_table(curr_round_data_fetch, DATA_INDEX_CURR_ROUND, CURR_ROUND_TITLE)+RIGHT_INFO_MARGIN_RIGHT
-                else:
-                    # if there is best round table, then create a separation with the current round table
-                    current_height+= RIGHT_INFO_MARGIN_TOP
-
-                # table for current round
-                current_height = draw_table_right_top(SCREEN, extra_available_space_width, (DATA_INDEX_CURR_ROUND, COLORS["black"]), (curr_round_data_fetch, COLORS["white"]), (CURR_ROUND_TITLE, COLORS["red"]), fixed_width, (RIGHT_INFO_MARGIN_LEFT, current_height, RIGHT_INFO_MARGIN_RIGHT))
-
-        if "level" in state:
-            draw_info(
-                SCREEN,
-                f"{state['level']}",
-                (SCREEN.get_width()-extra_available_space_width+RIGHT_INFO_MARGIN_LEFT, current_height+RIGHT_INFO_MARGIN_TOP),
-                color=COLORS["white"], size=50
-            )
-        
-        if "level" not in state and "highscores" not in state:
-            for i, word in enumerate(["Run a client  ", "to see scores!"]):
-                word_w, word_h = get_draw_size(word)
-                draw_info(SCREEN, word, (SCREEN.get_width()-center_text_margin(extra_available_space_width, word_w), RIGHT_INFO_MARGIN_TOP+word_h+i*20), COLORS["white"])
+                    player = state['player']
 
-        if "boxes" in state:
-            boxes_group.empty()
-            for box in state["boxes"]:
-                boxes_group.add(
-                    Box(
-                        pos=box,
-                        stored=mapa.get_tile(box) in [Tiles.GOAL, Tiles.BOX_ON_GOAL],
-                    )
+                    last_player = curr_player
+
+                # draw player info
+                player_h_from_top = SCREEN.get_height() - RIGHT_INFO_MARGIN_BOTTOM
+                player_w, _ = get_draw_size(player)
+                draw_info(SCREEN, player, (SCREEN.get_width()-player_w-RIGHT_INFO_MARGIN_RIGHT, player_h_from_top), COLORS["light_blue"])
+                draw_info(SCREEN, "Player: ", (SCREEN.get_width()-player_w-get_draw_size("Player: ")[0]-RIGHT_INFO_MARGIN_RIGHT-5, player_h_from_top), COLORS["white"])
+
+                current_height = RIGHT_INFO_MARGIN_TOP
+
+                if hs != None and hs.data != []:
+                    # table for best round
+                    current_height = draw_table_right_top(SCREEN, extra_available_space_width, (formated_col_l, COLORS["black"]), (formated_col_r, COLORS["white"]), (BEST_ROUND_TITLE, COLORS["yellow"]), fixed_width, (RIGHT_INFO_MARGIN_LEFT, current_height, RIGHT_INFO_MARGIN_RIGHT))
+
+                # some conditions to coop with state['score']
+                if not isinstance(state['score'], int) and len(state['score']) > len(DATA_INDEX_CURR_ROUND):
+                    curr_round_data_fetch = [str(state['score'][i+1]) for i in range(len(DATA_INDEX_CURR_ROUND))]
+
+                    # if there is no data from best round, adapt the fixed size to the data of current round
+                    if hs.data == []:
+                        fixed_width = get_largest_width_for_table(curr_round_data_fetch, DATA_INDEX_CURR_ROUND, CURR_ROUND_TITLE)+RIGHT_INFO_MARGIN_RIGHT
+                    else:
+                        # if there is best round table, then create a separation with the current round table
+                        current_height+= RIGHT_INFO_MARGIN_TOP
+
+                    # table for current round
+                    current_height = draw_table_right_top(SCREEN, extra_available_space_width, (DATA_INDEX_CURR_ROUND, COLORS["black"]), (curr_round_data_fetch, COLORS["white"]), (CURR_ROUND_TITLE, COLORS["red"]), fixed_width, (RIGHT_INFO_MARGIN_LEFT, current_height, RIGHT_INFO_MARGIN_RIGHT))
+
+            if "level" in state:
+                draw_info(
+                    SCREEN,
+                    f"{state['level']}",
+                    (SCREEN.get_width()-extra_available_space_width+RIGHT_INFO_MARGIN_LEFT, current_height+RIGHT_INFO_MARGIN_TOP),
+                    color=COLORS["white"], size=50
                 )
 
-        boxes_group.draw(SCREEN)
-        main_group.draw(SCREEN)
+            if "level" not in state and "highscores" not in state:
+                for i, word in enumerate(["Run a client  ", "to see scores!"]):
+                    word_w, word_h = get_draw_size(word)
+                    draw_info(SCREEN, word, (SCREEN.get_width()-center_text_margin(extra_available_space_width, word_w), RIGHT_INFO_MARGIN_TOP+word_h+i*20), COLORS["white"])
 
-        # Highscores Board
-        if "highscores" in state and "player" in state:
-            if new_event:
-                highscores = state["highscores"]
-                highscores.append(
-                    (f"<{state['player']}>", reduce_score(*state["score"]))
+        # cells whose occupancy changed since the last drawing
+        cells = []
+        if "boxes" in state:
+            positions = {tuple(box) for box in state["boxes"]}
+            for pos in set(boxes) - positions:
+                boxes.pop(pos).kill()
+                cells.append(pos)
+            for pos in positions - set(boxes):
+                boxes[pos] = Box(
+                    pos=pos,
+                    stored=mapa.get_tile(pos) in [Tiles.GOAL, Tiles.BOX_ON_GOAL],
                 )
+                boxes_group.add(boxes[pos])
+                cells.append(pos)
+
+        if "keeper" in state and tuple(state["keeper"]) != keeper_pos:
+            cells.append(keeper_pos)
+            keeper_pos = tuple(state["keeper"])
+            main_group.update(keeper_pos)
+            cells.append(keeper_pos)
+
+        if redraw:
+            boxes_group.draw(SCREEN)
+            main_group.draw(SCREEN)
+        elif cells:
+            rects = [cell_rect(pos) for pos in cells]
+            for rect in rects:
+                SCREEN.blit(BACKGROUND, rect, rect)
+            for sprite in boxes_group.sprites() + main_group.sprites():
+                if sprite.rect.collidelist(rects) != -1:
+                    SCREEN.blit(sprite.image, sprite.rect)
+            dirty += rects
+
+        # Highscores Board
+        if "highscores" in state and "player" in state and new_event:
+            highscores = state["highscores"]
+            highscores.append(
+                (f"<{state['player']}>", reduce_score(*state["score"]))
+            )
 
-                highscores = sorted(highscores, key=lambda s: s[1])
-                highscores = highscores[: len(RANKS)]
+            highscores = sorted(highscores, key=lambda s: s[1])
+            highscores = highscores[: len(RANKS)]
 
-                HIGHSCORES = pygame.Surface((256, 280))
-                HIGHSCORES.fill((30, 30, 30))
+            HIGHSCORES = pygame.Surface((256, 280))
+            HIGHSCORES.fill((30, 30, 30))
 
-                COLS = [20, 80, 150]
+            COLS = [20, 80, 150]
 
-                draw_info(HIGHSCORES, "THE 10 BEST PLAYERS", (20, 10), COLORS["white"])
-                for value, column in zip(["RANK", "SCORE", "NAME"], COLS):
-                    draw_info(HIGHSCORES, value, (column, 30), COLORS["orange"])
+            draw_info(HIGHSCORES, "THE 10 BEST PLAYERS", (20, 10), COLORS["white"])
+            for value, column in zip(["RANK", "SCORE", "NAME"], COLS):
+                draw_info(HIGHSCORES, value, (column, 30), COLORS["orange"])
 
-                for i, highscore in enumerate(highscores):
-                    color = (
-                        random.randrange(66, 222),
-                        random.randrange(66, 222),
-                        random.randrange(66, 222),
-                    )
-                    for value, column in zip(
-                        [RANKS[i + 1], str(highscore[1]), highscore[0]], COLS
-                    ):
-                        draw_info(HIGHSCORES, value, (column, 60 + i * 20), color)
+            for i, highscore in enumerate(highscores):
+                color = (
+                    random.randrange(66, 222),
+                    random.randrange(66, 222),
+                    random.randrange(66, 222),
+                )
+                for value, column in zip(
+                    [RANKS[i + 1], str(highscore[1]), highscore[0]], COLS
+                ):
+                    draw_info(HIGHSCORES, value, (column, 60 + i * 20), color)
 
-            SCREEN.blit(
+            dirty.append(SCREEN.blit(
                 HIGHSCORES,
                 (
                     (SCREEN.get_width() - HIGHSCORES.get_width()) / 2,
                     (SCREEN.get_height() - HIGHSCORES.get_height()) / 2,
                 ),
-            )
+            ))
 
-        if "keeper" in state:
-            main_group.update(state["keeper"])
+        if redraw:
+            pygame.display.flip()
+        elif dirty:
+            pygame.display.update(dirty)
+        redraw = new_event = False
 
-        pygame.display.flip()
-
-        try:
-            state = json.loads(queue.get_nowait())
+        # when behind, only the latest state of the queued ones is drawn
+        for update in await next_updates(queue, decoder, 1.0 / GAME_SPEED):
+            state = update
             new_event = True
             if "map" in state:
                 logger.debug("New Level!")
@@ -437,20 +514,17 @@ async def main_loop(queue):
                         state["level"],
                     )
                     continue
-                map_x, map_y = mapa.size
-                SCREEN = pygame.display.set_mode(scale((map_x+MAP_X_INCREASE, map_y+MAP_Y_INCREASE)))
-                BACKGROUND = draw_background(mapa)
-                SCREEN.blit(BACKGROUND, (0, 0))
+                if (map_x, map_y) != mapa.size:
+                    map_x, map_y = mapa.size
+                    SCREEN = pygame.display.set_mode(scale((map_x+MAP_X_INCREASE, map_y+MAP_Y_INCREASE)))
+                BACKGROUND = level_background(mapa, state["map"])
 
                 boxes_group.empty()
+                boxes.clear()
                 main_group.empty()
-                main_group.add(Keeper(pos=mapa.keeper))
-                pygame.display.flip()
-
-        except asyncio.queues.QueueEmpty:
-            await asyncio.sleep(1.0 / GAME_SPEED)
-            new_event = False
-            continue
+                keeper_pos = mapa.keeper
+                main_group.add(Keeper(pos=keeper_pos))
+                redraw = True
 
 if __name__ == "__main__":
     SERVER = os.environ.get("SERVER", "localhost")